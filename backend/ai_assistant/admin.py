@@ -1,7 +1,42 @@
 from django.contrib import admin
-from .models import DiagnosisRequest
+from django.template.response import TemplateResponse
+from django.urls import path
+from .models import DiagnosisRequest, ReanalysisRun
+from .reports import REPORT_COLUMNS, daily_usage_report
 
 @admin.register(DiagnosisRequest)
 class DiagnosisRequestAdmin(admin.ModelAdmin):
-    list_display = ("car", "created_at", "ai_result")
-    search_fields = ("car__vin", "ai_result") 
\ No newline at end of file
+    list_display = ("car", "created_at", "status", "severity", "has_safety_concerns", "cache_status", "upstream_latency_ms")
+    list_filter = ("status", "severity", "has_safety_concerns", "cache_status", "provider")
+    search_fields = ("car__vin", "ai_result")
+    change_list_template = "admin/ai_assistant/diagnosisrequest/change_list.html"
+
+    def get_urls(self):
+        urls = [
+            path('usage/', self.admin_site.admin_view(self.usage_view), name='ai_assistant_diagnosisrequest_usage'),
+        ]
+        return urls + super().get_urls()
+
+    def usage_view(self, request):
+        """Daily latency percentiles and token usage (same data as vision_usage_report)"""
+        try:
+            days = int(request.GET.get('days', 14))
+        except ValueError:
+            days = 14
+        report = daily_usage_report(days)
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Vision usage',
+            'days': days,
+            'columns': [label for _, label in REPORT_COLUMNS],
+            'rows': [[row[key] for key, _ in REPORT_COLUMNS] for row in report],
+        }
+        return TemplateResponse(request, "admin/ai_assistant/diagnosisrequest/usage.html", context)
+
+
+@admin.register(ReanalysisRun)
+class ReanalysisRunAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "mode", "processed", "total", "failed", "last_id", "updated_at")
+    list_filter = ("status", "mode")
+    readonly_fields = ("last_id", "total", "processed", "failed", "batch_id", "batch_state", "finished_at")
@@ -0,0 +1,171 @@
+"""
+Structured vision analysis.
+
+Providers are asked for JSON matching DIAGNOSIS_SCHEMA. The typed values
+(severity, cost range, affected areas, safety flags) are stored in indexed
+columns on DiagnosisRequest and the markdown report is rendered from them
+when the diagnosis is displayed.
+"""
+
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+
+logger = logging.getLogger(__name__)
+
+SEVERITY_LEVELS = ('low', 'medium', 'high')
+
+DIAGNOSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "vehicle_detected": {"type": "boolean"},
+        "summary": {"type": "string"},
+        "condition": {"type": "string"},
+        "severity": {"type": "string", "enum": list(SEVERITY_LEVELS)},
+        "estimated_cost": {
+            "type": "object",
+            "properties": {
+                "min": {"type": "number"},
+                "max": {"type": "number"},
+                "currency": {"type": "string"},
+            },
+            "required": ["min", "max", "currency"],
+            "additionalProperties": False,
+        },
+        "affected_areas": {"type": "array", "items": {"type": "string"}},
+        "damage_findings": {"type": "array", "items": {"type": "string"}},
+        "safety_concerns": {"type": "array", "items": {"type": "string"}},
+        "safe_to_drive": {"type": "boolean"},
+        "recommendations": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": [
+        "vehicle_detected", "summary", "condition", "severity", "estimated_cost", "affected_areas",
+        "damage_findings", "safety_concerns", "safe_to_drive", "recommendations",
+    ],
+    "additionalProperties": False,
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "vehicle_damage_assessment",
+        "strict": True,
+        "schema": DIAGNOSIS_SCHEMA,
+    },
+}
+
+# DiagnosisRequest columns set by apply_analysis
+STRUCTURED_FIELDS = [
+    'analysis', 'severity', 'estimated_cost_min', 'estimated_cost_max', 'affected_areas',
+    'has_safety_concerns', 'safe_to_drive',
+]
+
+
+def _to_decimal(value):
+    try:
+        return str(Decimal(str(value)).quantize(Decimal('0.01')))
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+def _string_list(value):
+    if not isinstance(value, list):
+        return []
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def parse_analysis(text):
+    """
+    Normalise a provider response into an analysis dict.
+
+    Responses that are not JSON (providers without structured output
+    support) are kept as a free-text summary with no typed values.
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        data = None
+    if not isinstance(data, dict):
+        logger.info("Vision response is not structured JSON; storing it as free text")
+        return {'summary': (text or '').strip(), 'structured': False}
+
+    severity = str(data.get('severity') or '').lower()
+    cost = data.get('estimated_cost') if isinstance(data.get('estimated_cost'), dict) else {}
+    safe_to_drive = data.get('safe_to_drive')
+    return {
+        'structured': True,
+        'vehicle_detected': bool(data.get('vehicle_detected', True)),
+        'summary': str(data.get('summary') or '').strip(),
+        'condition': str(data.get('condition') or '').strip(),
+        'severity': severity if severity in SEVERITY_LEVELS else '',
+        'estimated_cost': {
+            'min': _to_decimal(cost.get('min')),
+            'max': _to_decimal(cost.get('max')),
+            'currency': str(cost.get('currency') or 'USD').upper()[:3],
+        },
+        'affected_areas': _string_list(data.get('affected_areas')),
+        'damage_findings': _string_list(data.get('damage_findings')),
+        'safety_concerns': _string_list(data.get('safety_concerns')),
+        'safe_to_drive': safe_to_drive if isinstance(safe_to_drive, bool) else None,
+        'recommendations': _string_list(data.get('recommendations')),
+    }
+
+
+def apply_analysis(diagnosis, analysis):
+    """Copy an analysis dict onto the diagnosis columns (not saved)"""
+    cost = analysis.get('estimated_cost') or {}
+    diagnosis.analysis = analysis
+    diagnosis.severity = analysis.get('severity') or ''
+    diagnosis.estimated_cost_min = cost.get('min')
+    diagnosis.estimated_cost_max = cost.get('max')
+    diagnosis.affected_areas = analysis.get('affected_areas') or []
+    diagnosis.has_safety_concerns = bool(analysis.get('safety_concerns'))
+    diagnosis.safe_to_drive = analysis.get('safe_to_drive')
+
+
+def _bullets(items):
+    return "\n".join(f"- {item}" for item in items)
+
+
+def render_analysis_markdown(analysis, car_info=None):
+    """Markdown report for an analysis dict, as shown in the frontend"""
+    if analysis.get('formatted'):
+        return analysis.get('summary', '')
+
+    model = analysis.get('model')
+    formatted = f"🔍 **{model or 'Vision AI'} Analysis**\n\n"
+
+    # Add car info header if available
+    if car_info:
+        formatted += f"**Vehicle:** {car_info.get('year', '')} {car_info.get('make', '')} {car_info.get('model', '')}\n\n"
+
+    if not analysis.get('structured'):
+        formatted += analysis.get('summary', '')
+    else:
+        sections = []
+        if not analysis.get('vehicle_detected', True):
+            sections.append("⚠️ **No vehicle detected in this image.**")
+        if analysis.get('summary'):
+            sections.append(analysis['summary'])
+        if analysis.get('condition'):
+            sections.append(f"🚗 **Condition**: {analysis['condition']}")
+        if analysis.get('damage_findings'):
+            sections.append(f"📋 **Damage Detected**:\n{_bullets(analysis['damage_findings'])}")
+        if analysis.get('affected_areas'):
+            sections.append(f"📍 **Affected Areas**: {', '.join(analysis['affected_areas'])}")
+        if analysis.get('severity'):
+            sections.append(f"📊 **Severity Level**: {analysis['severity'].capitalize()}")
+        cost = analysis.get('estimated_cost') or {}
+        if cost.get('min') is not None and cost.get('max') is not None:
+            sections.append(f"💰 **Estimated Cost**: {cost['min']} - {cost['max']} {cost.get('currency', 'USD')}")
+        if analysis.get('safety_concerns'):
+            sections.append(f"⚠️ **Safety Concerns**:\n{_bullets(analysis['safety_concerns'])}")
+        if analysis.get('safe_to_drive') is not None:
+            sections.append(f"🛣️ **Safe to Drive**: {'Yes' if analysis['safe_to_drive'] else 'No'}")
+        if analysis.get('recommendations'):
+            sections.append(f"✅ **Recommendations**:\n{_bullets(analysis['recommendations'])}")
+        formatted += "\n\n".join(sections)
+
+    if model:
+        formatted += f"\n\n*Analysis powered by {model}*"
+    return formatted
@@ -0,0 +1,75 @@
+import hashlib
+import logging
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+HITS_KEY = 'vision-cache:hits'
+MISSES_KEY = 'vision-cache:misses'
+
+
+def get_analysis_cache():
+    """
+    Cache backend for vision analyses.
+
+    Configured as the ``vision`` alias in CACHES: Redis (shared by every web
+    and Celery process) when REDIS_URL is set, otherwise an in-process LocMem
+    cache bounded by VISION_CACHE_MAX_ENTRIES. Entries expire after
+    VISION_CACHE_TTL seconds.
+    """
+    return caches[getattr(settings, 'VISION_CACHE_ALIAS', 'vision')]
+
+
+def make_cache_key(image_data, prompt, model):
+    """Content address for an analysis: normalized image bytes + full prompt + model"""
+    digest = hashlib.sha256()
+    digest.update(model.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(prompt.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(image_data)
+    return f'vision-analysis:{digest.hexdigest()}'
+
+
+def get_cached_analysis(key):
+    """Return the stored analysis or None, counting the hit/miss"""
+    cache = get_analysis_cache()
+    try:
+        analysis = cache.get(key)
+    except Exception as e:
+        # A cache outage must never block a diagnosis
+        logger.warning("Vision cache lookup failed: %s", e)
+        return None
+    _increment(cache, HITS_KEY if analysis is not None else MISSES_KEY)
+    return analysis
+
+
+def set_cached_analysis(key, analysis):
+    try:
+        get_analysis_cache().set(key, analysis, timeout=getattr(settings, 'VISION_CACHE_TTL', 7 * 24 * 3600))
+    except Exception as e:
+        logger.warning("Vision cache store failed: %s", e)
+
+
+def get_cache_stats():
+    """Hit/miss counters shared by all processes using the same cache backend"""
+    cache = get_analysis_cache()
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits = counts.get(HITS_KEY, 0)
+    misses = counts.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 4) if total else 0.0,
+    }
+
+
+def _increment(cache, key):
+    try:
+        # Counters never expire; add() is a no-op when the key already exists
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+    except Exception as e:
+        logger.debug("Vision cache counter update failed: %s", e)
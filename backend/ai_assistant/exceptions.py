@@ -0,0 +1,40 @@
+class VisionServiceError(Exception):
+    """An upstream vision call failed; nothing should be stored as an analysis"""
+    retryable = False
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class VisionAuthError(VisionServiceError):
+    """API key missing, invalid or revoked (401/403)"""
+
+
+class VisionQuotaError(VisionServiceError):
+    """Billing quota exhausted; retrying will not help"""
+
+
+class VisionRateLimited(VisionServiceError):
+    """Upstream (429) or our own token bucket asked us to slow down"""
+    retryable = True
+
+
+class VisionThrottled(VisionRateLimited):
+    """Our own token bucket has no room within VISION_RATE_LIMIT_MAX_WAIT; nothing was sent"""
+
+
+class VisionUpstreamError(VisionServiceError):
+    """Timeout, connection error or 5xx from upstream"""
+    retryable = True
+
+
+class VisionCircuitOpen(VisionServiceError):
+    """Upstream marked unhealthy; failing fast until the breaker resets"""
+    retryable = True
+
+
+class AnalysisInFlight(VisionServiceError):
+    """An identical analysis is running elsewhere; retry to read its result from the cache"""
+    retryable = True
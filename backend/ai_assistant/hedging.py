@@ -0,0 +1,177 @@
+"""
+Hedged requests across vision providers.
+
+The primary provider is called first. If it has not answered within a delay
+derived from its recent latency percentile (p95 by default), the next
+provider is called as well and whichever succeeds first wins. A failed
+primary triggers the backup immediately instead of waiting out the delay.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+from automate.stats import percentile
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies for one provider"""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        """Nearest-rank percentile of the window, or None when it is empty"""
+        with self.lock:
+            samples = sorted(self.samples)
+        return percentile(samples, pct)
+
+    def __len__(self):
+        return len(self.samples)
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_latency_tracker(name):
+    with _trackers_lock:
+        if name not in _trackers:
+            _trackers[name] = LatencyTracker(getattr(settings, 'VISION_HEDGE_WINDOW', 200))
+        return _trackers[name]
+
+
+def reset_latency_trackers():
+    with _trackers_lock:
+        _trackers.clear()
+
+
+def _get_executor():
+    """Worker pool for provider calls, rebuilt after a fork"""
+    global _executor, _executor_pid
+
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'VISION_HEDGE_MAX_WORKERS', 16),
+                    thread_name_prefix='vision-hedge'
+                )
+                _executor_pid = pid
+    return _executor
+
+
+def hedge_delay(provider):
+    """Seconds to wait on ``provider`` before firing the backup"""
+    tracker = get_latency_tracker(provider.name)
+    delay = None
+    if len(tracker) >= getattr(settings, 'VISION_HEDGE_MIN_SAMPLES', 20):
+        delay = tracker.percentile(getattr(settings, 'VISION_HEDGE_PERCENTILE', 95))
+    if delay is None:
+        delay = getattr(settings, 'VISION_HEDGE_DEFAULT_DELAY', 8.0)
+    return max(delay, getattr(settings, 'VISION_HEDGE_MIN_DELAY', 0.5))
+
+
+def timed_analyze(provider, request):
+    """Call ``provider`` and record the latency of successful answers"""
+    started = time.monotonic()
+    result = provider.analyze(request)
+    get_latency_tracker(provider.name).record(time.monotonic() - started)
+    return result
+
+
+def hedged_analyze(providers, request):
+    """
+    Run ``request`` against ``providers`` with hedging.
+
+    Returns (result, provider) for the first successful answer. If every
+    provider fails the primary's error is raised.
+    """
+    executor = _get_executor()
+    pending = {}
+    errors = {}
+    backups = list(providers[1:])
+
+    primary = providers[0]
+    pending[executor.submit(timed_analyze, primary, request)] = primary
+    timeout = hedge_delay(primary)
+
+    while pending:
+        done, _ = wait(pending, timeout=timeout if backups else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            provider = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning("Vision provider %s failed: %s", provider.name, e)
+                errors[provider.name] = e
+            else:
+                # Losing calls finish in the background; their latency is still recorded
+                return result, provider
+
+        if backups and (not done or not pending):
+            backup = backups.pop(0)
+            if not done:
+                logger.info("Hedging %s after %.2fs with %s", primary.name, timeout, backup.name)
+            pending[executor.submit(timed_analyze, backup, request)] = backup
+            timeout = hedge_delay(backup)
+
+    raise errors[primary.name]
+
+
+async def atimed_analyze(provider, request):
+    started = time.monotonic()
+    result = await provider.aanalyze(request)
+    get_latency_tracker(provider.name).record(time.monotonic() - started)
+    return result
+
+
+async def ahedged_analyze(providers, request):
+    """hedged_analyze() on the event loop; the losing call is cancelled"""
+    pending = {}
+    errors = {}
+    backups = list(providers[1:])
+
+    primary = providers[0]
+    pending[asyncio.ensure_future(atimed_analyze(primary, request))] = primary
+    timeout = hedge_delay(primary)
+
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, timeout=timeout if backups else None, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.warning("Vision provider %s failed: %s", provider.name, e)
+                    errors[provider.name] = e
+                else:
+                    return result, provider
+
+            if backups and (not done or not pending):
+                backup = backups.pop(0)
+                if not done:
+                    logger.info("Hedging %s after %.2fs with %s", primary.name, timeout, backup.name)
+                pending[asyncio.ensure_future(atimed_analyze(backup, request))] = backup
+                timeout = hedge_delay(backup)
+    finally:
+        for task in pending:
+            task.cancel()
+
+    raise errors[primary.name]
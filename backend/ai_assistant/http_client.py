@@ -0,0 +1,80 @@
+import asyncio
+import os
+import threading
+import weakref
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_session():
+    """
+    Return the process-wide requests.Session used for upstream AI calls.
+
+    The session is created lazily on first use and keeps a pool of keep-alive
+    connections, so repeated analyses reuse the same TCP/TLS connection instead
+    of paying a new handshake each time. It is rebuilt after a fork so Celery
+    and gunicorn children never share sockets with their parent.
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            pool_size = getattr(settings, 'OPENAI_HTTP_POOL_SIZE', 10)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = pid
+    return _session
+
+
+def get_http_timeout():
+    """(connect, read) timeout tuple for upstream AI calls"""
+    return (
+        getattr(settings, 'OPENAI_CONNECT_TIMEOUT', 5.0),
+        getattr(settings, 'OPENAI_READ_TIMEOUT', 60.0),
+    )
+
+
+def get_async_http_client():
+    """
+    Return the httpx.AsyncClient shared by async views on the running event loop.
+
+    Under ASGI one loop serves many concurrent requests, so every streaming
+    or async diagnosis reuses the same keep-alive pool without holding a
+    worker thread while waiting on upstream.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        pool_size = getattr(settings, 'OPENAI_HTTP_POOL_SIZE', 10)
+        connect_timeout, read_timeout = get_http_timeout()
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def reset_http_session():
+    """Close and drop the shared session (used by tests and benchmarks)"""
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
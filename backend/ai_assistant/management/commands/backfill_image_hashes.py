@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from ai_assistant.models import DiagnosisRequest
+from ai_assistant.similarity import HASH_FIELDS, compute_dhash, image_hash_fields
+
+
+class Command(BaseCommand):
+    help = 'Compute perceptual hashes of diagnosis images stored before near-duplicate lookup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per bulk update (default: 500)')
+
+    def handle(self, *args, **options):
+        queryset = DiagnosisRequest.objects.filter(image_dhash__isnull=True).exclude(image='').only('id', 'image')
+        batch, hashed, unreadable = [], 0, 0
+
+        for diagnosis in queryset.iterator(chunk_size=options['batch_size']):
+            try:
+                with diagnosis.image.open('rb') as image_file:
+                    value = compute_dhash(image_file)
+            except (OSError, ValueError):
+                value = None
+            if value is None:
+                unreadable += 1
+                continue
+            for field, field_value in image_hash_fields(value).items():
+                setattr(diagnosis, field, field_value)
+            batch.append(diagnosis)
+            if len(batch) >= options['batch_size']:
+                hashed += DiagnosisRequest.objects.bulk_update(batch, HASH_FIELDS)
+                batch = []
+
+        if batch:
+            hashed += DiagnosisRequest.objects.bulk_update(batch, HASH_FIELDS)
+        self.stdout.write(self.style.SUCCESS(f'Hashed {hashed} diagnosis images ({unreadable} unreadable)'))
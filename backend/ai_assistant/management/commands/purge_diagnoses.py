@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ai_assistant.retention import apply_retention
+
+
+class Command(BaseCommand):
+    help = 'Delete diagnoses past the retention policy, with their image files, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Delete diagnoses older than this (default: DIAGNOSIS_RETENTION_DAYS)')
+        parser.add_argument('--max-per-user', type=int, help='Keep only the newest N diagnoses per user (default: DIAGNOSIS_RETENTION_MAX_PER_USER)')
+        parser.add_argument('--batch-size', type=int, help='Rows deleted per transaction (default: DIAGNOSIS_PURGE_BATCH_SIZE)')
+        parser.add_argument('--workers', type=int, help='Parallel file deletions (default: DIAGNOSIS_PURGE_FILE_WORKERS)')
+        parser.add_argument('--dry-run', action='store_true', help='Only estimate what would be deleted')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else getattr(settings, 'DIAGNOSIS_RETENTION_DAYS', 0)
+        max_per_user = options['max_per_user']
+        if max_per_user is None:
+            max_per_user = getattr(settings, 'DIAGNOSIS_RETENTION_MAX_PER_USER', 0)
+        if not days and not max_per_user:
+            raise CommandError('No retention policy: pass --days/--max-per-user or set DIAGNOSIS_RETENTION_DAYS')
+
+        totals = apply_retention(
+            days=days,
+            max_per_user=max_per_user,
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            dry_run=options['dry_run'],
+        )
+        if options['dry_run']:
+            self.stdout.write(
+                f"Would delete {totals.get('diagnoses', 0)} diagnoses and {totals.get('files', 0)} image files "
+                f"(about {totals.get('bytes', 0) / 1024 / 1024:.1f} MB)"
+            )
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {totals.get('diagnoses', 0)} diagnoses and {totals.get('files', 0)} image files"
+        ))
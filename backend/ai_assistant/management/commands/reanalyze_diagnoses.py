@@ -0,0 +1,119 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ai_assistant.exceptions import VisionServiceError
+from ai_assistant.models import ReanalysisRun
+from ai_assistant.reanalysis import fail_run, reanalysis_queryset, run_step, start_run
+from ai_assistant.resilience import backoff_delay
+from ai_assistant.tasks import reanalyze_diagnoses
+
+
+def split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Command(BaseCommand):
+    help = 'Re-run the AI analysis for stored diagnoses (e.g. after a prompt or model change), in checkpointed chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--car', type=int, help='Only diagnoses of this car id')
+        parser.add_argument('--user', type=int, help='Only diagnoses of this user id')
+        parser.add_argument('--severity', help='Comma-separated severities (low,medium,high)')
+        parser.add_argument('--status', help='Comma-separated statuses (e.g. done,failed)')
+        parser.add_argument('--provider', help='Comma-separated providers that produced the current analysis')
+        parser.add_argument('--since', help='Created on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--until', help='Created before this date (YYYY-MM-DD)')
+        parser.add_argument('--chunk-size', type=int, help='Diagnoses per chunk (default: VISION_REANALYSIS_CHUNK_SIZE)')
+        parser.add_argument('--concurrency', type=int, help='Parallel upstream calls per chunk (default: VISION_REANALYSIS_CONCURRENCY)')
+        parser.add_argument('--batch', action='store_true', help="Submit chunks to the provider's Batch API where available")
+        parser.add_argument('--inline', action='store_true', help='Run here and report progress instead of queueing a Celery task')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the selected diagnoses')
+        parser.add_argument('--resume', type=int, metavar='RUN_ID', help='Continue an interrupted run from its checkpoint')
+        parser.add_argument('--cancel', type=int, metavar='RUN_ID', help='Stop a run after its current chunk')
+        parser.add_argument('--show', type=int, metavar='RUN_ID', help='Show the progress of a run')
+
+    def handle(self, *args, **options):
+        if options['show'] or options['cancel']:
+            run = self.get_run(options['show'] or options['cancel'])
+            if options['cancel'] and run.status in ('pending', 'running'):
+                run.status = 'cancelled'
+                run.save(update_fields=['status', 'updated_at'])
+            self.report(run)
+            return
+
+        if options['resume']:
+            run = self.get_run(options['resume'])
+            if run.status == 'failed':
+                run.status = 'running'
+                run.error_message = ''
+                run.save(update_fields=['status', 'error_message', 'updated_at'])
+        else:
+            filters = self.build_filters(options)
+            if options['dry_run']:
+                self.stdout.write(f"{reanalysis_queryset(filters).count()} diagnoses selected")
+                return
+            run = start_run(
+                filters,
+                mode='batch' if options['batch'] else 'inline',
+                chunk_size=options['chunk_size'],
+                concurrency=options['concurrency'],
+            )
+
+        if not options['inline']:
+            reanalyze_diagnoses.delay(run.id)
+            self.stdout.write(self.style.SUCCESS(
+                f"Queued re-analysis run #{run.id}; follow it with --show {run.id}"
+            ))
+            return
+        self.run_inline(run)
+
+    def build_filters(self, options):
+        filters = {}
+        if options['car']:
+            filters['car_id'] = options['car']
+        if options['user']:
+            filters['user_id'] = options['user']
+        for name in ('severity', 'status', 'provider'):
+            if options[name]:
+                filters[name] = split(options[name])
+        if options['since']:
+            filters['created_after'] = options['since']
+        if options['until']:
+            filters['created_before'] = options['until']
+        return filters
+
+    def get_run(self, run_id):
+        try:
+            return ReanalysisRun.objects.get(id=run_id)
+        except ReanalysisRun.DoesNotExist:
+            raise CommandError(f"Re-analysis run {run_id} does not exist")
+
+    def run_inline(self, run):
+        max_retries = getattr(settings, 'VISION_MAX_RETRIES', 3)
+        attempt = 0
+        while True:
+            # Picks up --cancel from another shell
+            run.refresh_from_db()
+            try:
+                delay = run_step(run, final_attempt=attempt >= max_retries)
+            except VisionServiceError as error:
+                if error.retryable and attempt < max_retries:
+                    attempt += 1
+                    self.stdout.write(self.style.WARNING(f"{error}; retrying chunk (attempt {attempt})"))
+                    time.sleep(backoff_delay(attempt, error.retry_after))
+                    continue
+                fail_run(run, error)
+                delay = None
+            attempt = 0
+            self.report(run)
+            if delay is None:
+                break
+            time.sleep(delay)
+
+    def report(self, run):
+        line = f"Run #{run.id} [{run.status}] {run.processed}/{run.total} ({run.progress:.0%}), {run.failed} failed"
+        if run.batch_id:
+            line += f", waiting on batch {run.batch_id}"
+        if run.error_message:
+            line += f": {run.error_message}"
+        self.stdout.write(line)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from ai_assistant.search import index_path, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the diagnosis search index from the database (indexes existing rows, drops stale records)'
+
+    def handle(self, *args, **options):
+        total = rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} diagnoses in {index_path()}'))
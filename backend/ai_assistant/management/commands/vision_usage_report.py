@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from ai_assistant.reports import REPORT_COLUMNS, daily_usage_report
+
+
+class Command(BaseCommand):
+    help = 'Show vision analysis latency (p50/p95), token usage and cache hits per day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Number of days to report (default: 7)')
+
+    def handle(self, *args, **options):
+        report = daily_usage_report(options['days'])
+        if not report:
+            self.stdout.write(self.style.WARNING(f"No diagnoses in the last {options['days']} days"))
+            return
+
+        table = [[label for _, label in REPORT_COLUMNS]]
+        for row in report:
+            table.append(['-' if row[key] is None else str(row[key]) for key, _ in REPORT_COLUMNS])
+
+        widths = [max(len(line[i]) for line in table) for i in range(len(REPORT_COLUMNS))]
+        for line in table:
+            self.stdout.write('  '.join(value.rjust(width) for value, width in zip(line, widths)))
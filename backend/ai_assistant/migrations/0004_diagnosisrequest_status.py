@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:51
+
+from django.db import migrations, models
+
+
+def mark_existing_done(apps, schema_editor):
+    # Diagnoses created before the Celery pipeline were analysed inline
+    DiagnosisRequest = apps.get_model('ai_assistant', 'DiagnosisRequest')
+    DiagnosisRequest.objects.update(status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0003_diagnosisrequest_damage_description'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20),
+        ),
+        migrations.RunPython(mark_existing_done, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0004_diagnosisrequest_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='original_image_bytes',
+            field=models.PositiveIntegerField(blank=True, help_text='Size of the uploaded image', null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='sent_image_bytes',
+            field=models.PositiveIntegerField(blank=True, help_text='Size of the image sent to the AI provider', null=True),
+        ),
+    ]
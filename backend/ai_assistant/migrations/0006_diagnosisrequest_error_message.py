@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0005_diagnosisrequest_image_bytes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='error_message',
+            field=models.TextField(blank=True, help_text='Why the analysis failed (status=failed)'),
+        ),
+    ]
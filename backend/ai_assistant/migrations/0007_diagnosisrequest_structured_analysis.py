@@ -0,0 +1,83 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:04
+
+import re
+from django.conf import settings
+from django.db import migrations, models
+
+SEVERITY_PATTERN = re.compile(r'Severity Level\W*(Low|Medium|High)', re.IGNORECASE)
+
+
+def backfill_severity(apps, schema_editor):
+    # One-off scan of the old markdown results so existing rows can be filtered too
+    DiagnosisRequest = apps.get_model('ai_assistant', 'DiagnosisRequest')
+    batch = []
+    for diagnosis in DiagnosisRequest.objects.exclude(ai_result='').only('id', 'ai_result').iterator(chunk_size=500):
+        match = SEVERITY_PATTERN.search(diagnosis.ai_result)
+        if match:
+            diagnosis.severity = match.group(1).lower()
+            batch.append(diagnosis)
+        if len(batch) >= 500:
+            DiagnosisRequest.objects.bulk_update(batch, ['severity'])
+            batch = []
+    DiagnosisRequest.objects.bulk_update(batch, ['severity'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0006_diagnosisrequest_error_message'),
+        ('cars', '0003_alter_car_vin'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='affected_areas',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='analysis',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='estimated_cost_max',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='estimated_cost_min',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='has_safety_concerns',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='safe_to_drive',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='severity',
+            field=models.CharField(blank=True, choices=[('low', 'Low'), ('medium', 'Medium'), ('high', 'High')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='diagnosisrequest',
+            name='ai_result',
+            field=models.TextField(blank=True, help_text='Markdown result of analyses stored before structured output'),
+        ),
+        migrations.AddIndex(
+            model_name='diagnosisrequest',
+            index=models.Index(fields=['car', 'severity', '-created_at'], name='diagnosis_car_severity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diagnosisrequest',
+            index=models.Index(fields=['user', 'severity', '-created_at'], name='diagnosis_user_severity_idx'),
+        ),
+        migrations.RunPython(backfill_severity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0007_diagnosisrequest_structured_analysis'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='cache_status',
+            field=models.CharField(blank=True, help_text='hit or miss in the analysis cache', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='completion_tokens',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='prompt_tokens',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='provider',
+            field=models.CharField(blank=True, help_text='Vision provider that answered', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='upstream_latency_ms',
+            field=models.PositiveIntegerField(blank=True, help_text='Time spent waiting on the vision provider', null=True),
+        ),
+    ]
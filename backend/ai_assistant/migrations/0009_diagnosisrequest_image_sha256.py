@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:17
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0008_diagnosisrequest_accounting'),
+        ('cars', '0003_alter_car_vin'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='image_sha256',
+            field=models.CharField(blank=True, help_text='Content hash used to coalesce duplicate uploads', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='diagnosisrequest',
+            index=models.Index(fields=['car', 'image_sha256'], name='diagnosis_car_image_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0009_diagnosisrequest_image_sha256'),
+        ('cars', '0003_alter_car_vin'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='dhash_band0',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='dhash_band1',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='dhash_band2',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='dhash_band3',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='image_dhash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='reused_from',
+            field=models.ForeignKey(blank=True, help_text='Near-duplicate diagnosis whose analysis was reused instead of a new AI call', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reused_by', to='ai_assistant.diagnosisrequest'),
+        ),
+        migrations.AddIndex(
+            model_name='diagnosisrequest',
+            index=models.Index(fields=['user', 'dhash_band0'], name='diagnosis_user_band0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diagnosisrequest',
+            index=models.Index(fields=['user', 'dhash_band1'], name='diagnosis_user_band1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diagnosisrequest',
+            index=models.Index(fields=['user', 'dhash_band2'], name='diagnosis_user_band2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='diagnosisrequest',
+            index=models.Index(fields=['user', 'dhash_band3'], name='diagnosis_user_band3_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0010_diagnosisrequest_image_dhash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReanalysisRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=20)),
+                ('mode', models.CharField(choices=[('inline', 'Inline'), ('batch', 'Upstream batch')], default='inline', max_length=10)),
+                ('filters', models.JSONField(blank=True, default=dict, help_text='Selection, see reanalysis.FILTERS')),
+                ('chunk_size', models.PositiveIntegerField(default=50)),
+                ('concurrency', models.PositiveIntegerField(default=4, help_text='Parallel upstream calls per chunk (inline mode)')),
+                ('last_id', models.PositiveIntegerField(default=0, help_text='Checkpoint: every matching diagnosis up to this id is done')),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('batch_id', models.CharField(blank=True, max_length=100)),
+                ('batch_state', models.JSONField(blank=True, default=dict)),
+                ('error_message', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:29
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0011_reanalysisrun'),
+        ('cars', '0003_alter_car_vin'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('damage_description', models.TextField(blank=True)),
+                ('size', models.PositiveIntegerField(help_text='Declared length of the image in bytes')),
+                ('sha256', models.CharField(help_text='Declared SHA-256 of the whole image (hex)', max_length=64)),
+                ('offset', models.PositiveIntegerField(default=0, help_text='Bytes received so far')),
+                ('status', models.CharField(choices=[('active', 'Active'), ('complete', 'Complete')], default='active', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('car', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='cars.car')),
+                ('diagnosis', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='ai_assistant.diagnosisrequest')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
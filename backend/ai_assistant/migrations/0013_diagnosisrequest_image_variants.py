@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0012_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diagnosisrequest',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, help_text='Resized WebP copies (see automate/image_variants.py)'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:36
+
+import automate.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0013_diagnosisrequest_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='diagnosisrequest',
+            name='image',
+            field=models.ImageField(storage=automate.storage.diagnosis_image_storage, upload_to='diagnosis_images/'),
+        ),
+    ]
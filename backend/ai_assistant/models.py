@@ -1,14 +1,200 @@
-from django.db import models
+import logging
+import os
+import uuid
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from automate.storage import diagnosis_image_storage
 from cars.models import Car
+from .analysis import render_analysis_markdown
+
+logger = logging.getLogger(__name__)
+
+# Per-call accounting columns, filled from the vision service ``stats`` dict
+ACCOUNTING_FIELDS = [
+    'original_image_bytes', 'sent_image_bytes', 'cache_status', 'provider',
+    'prompt_tokens', 'completion_tokens', 'upstream_latency_ms',
+]
+
 
 class DiagnosisRequest(models.Model):
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+    SEVERITY_CHOICES = [
+        ("low", "Low"),
+        ("medium", "Medium"),
+        ("high", "High"),
+    ]
+
     car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name="diagnosis_requests")
-    image = models.ImageField(upload_to="diagnosis_images/")
-    ai_result = models.TextField(blank=True)
+    image = models.ImageField(upload_to="diagnosis_images/", storage=diagnosis_image_storage)
+    image_variants = models.JSONField(default=dict, blank=True, help_text="Resized WebP copies (see automate/image_variants.py)")
+    ai_result = models.TextField(blank=True, help_text="Markdown result of analyses stored before structured output")
     damage_description = models.TextField(blank=True, help_text="User's description of damage")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    error_message = models.TextField(blank=True, help_text="Why the analysis failed (status=failed)")
+    original_image_bytes = models.PositiveIntegerField(null=True, blank=True, help_text="Size of the uploaded image")
+    sent_image_bytes = models.PositiveIntegerField(null=True, blank=True, help_text="Size of the image sent to the AI provider")
+    # Upstream accounting (see ai_assistant/reports.py)
+    cache_status = models.CharField(max_length=10, blank=True, help_text="hit or miss in the analysis cache")
+    provider = models.CharField(max_length=50, blank=True, help_text="Vision provider that answered")
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True)
+    upstream_latency_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Time spent waiting on the vision provider")
+    # Structured analysis (see ai_assistant/analysis.py); the report is rendered from it
+    analysis = models.JSONField(null=True, blank=True)
+    severity = models.CharField(max_length=10, choices=SEVERITY_CHOICES, blank=True)
+    estimated_cost_min = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    estimated_cost_max = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    affected_areas = models.JSONField(default=list, blank=True)
+    has_safety_concerns = models.BooleanField(default=False)
+    safe_to_drive = models.BooleanField(null=True, blank=True)
+    image_sha256 = models.CharField(max_length=64, blank=True, help_text="Content hash used to coalesce duplicate uploads")
+    # Perceptual hash and its 16-bit bands for near-duplicate lookup (see ai_assistant/similarity.py)
+    image_dhash = models.BigIntegerField(null=True, blank=True)
+    dhash_band0 = models.IntegerField(null=True, blank=True)
+    dhash_band1 = models.IntegerField(null=True, blank=True)
+    dhash_band2 = models.IntegerField(null=True, blank=True)
+    dhash_band3 = models.IntegerField(null=True, blank=True)
+    reused_from = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='reused_by',
+        help_text="Near-duplicate diagnosis whose analysis was reused instead of a new AI call"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='diagnosis_requests', null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['car', 'severity', '-created_at'], name='diagnosis_car_severity_idx'),
+            models.Index(fields=['user', 'severity', '-created_at'], name='diagnosis_user_severity_idx'),
+            models.Index(fields=['car', 'image_sha256'], name='diagnosis_car_image_idx'),
+            models.Index(fields=['user', 'dhash_band0'], name='diagnosis_user_band0_idx'),
+            models.Index(fields=['user', 'dhash_band1'], name='diagnosis_user_band1_idx'),
+            models.Index(fields=['user', 'dhash_band2'], name='diagnosis_user_band2_idx'),
+            models.Index(fields=['user', 'dhash_band3'], name='diagnosis_user_band3_idx'),
+        ]
+
+    def __str__(self):
+        return f"Diagnosis for {self.car} at {self.created_at}"
+
+    def get_car_info(self):
+        """Car context passed to the vision service prompt"""
+        if not self.car:
+            return None
+        return {
+            'year': self.car.year,
+            'make': self.car.make,
+            'model': self.car.model,
+            'vin': self.car.vin
+        }
+
+    @property
+    def rendered_result(self):
+        """Markdown report, rendered from the structured analysis when there is one"""
+        if self.analysis:
+            return render_analysis_markdown(self.analysis, self.get_car_info())
+        return self.ai_result
+
+
+class ReanalysisRun(models.Model):
+    """
+    Checkpointed re-analysis of a filtered set of diagnoses (see
+    ai_assistant/reanalysis.py). Rows are processed in id order; ``last_id``
+    is only advanced once a chunk's results are written, so a crashed run
+    resumes from the last finished chunk.
+    """
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+        ("cancelled", "Cancelled"),
+    ]
+    MODE_CHOICES = [
+        ("inline", "Inline"),
+        ("batch", "Upstream batch"),
+    ]
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    mode = models.CharField(max_length=10, choices=MODE_CHOICES, default='inline')
+    filters = models.JSONField(default=dict, blank=True, help_text="Selection, see reanalysis.FILTERS")
+    chunk_size = models.PositiveIntegerField(default=50)
+    concurrency = models.PositiveIntegerField(default=4, help_text="Parallel upstream calls per chunk (inline mode)")
+    last_id = models.PositiveIntegerField(default=0, help_text="Checkpoint: every matching diagnosis up to this id is done")
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # Upstream batch in flight (batch mode): its id, and the chunk's last_id,
+    # row/failure counts and {diagnosis id: analysis cache key}
+    batch_id = models.CharField(max_length=100, blank=True)
+    batch_state = models.JSONField(default=dict, blank=True)
+    error_message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
-        return f"Diagnosis for {self.car} at {self.created_at}" 
\ No newline at end of file
+        return f"Re-analysis #{self.id} ({self.status}, {self.processed}/{self.total})"
+
+    @property
+    def progress(self):
+        """Fraction of the selected diagnoses processed so far"""
+        return self.processed / self.total if self.total else 0.0
+
+
+class UploadSession(models.Model):
+    """
+    A resumable diagnosis image upload (see ai_assistant/uploads.py).
+
+    Chunks are appended to a temp file at ``offset``; once ``size`` bytes
+    have arrived and match ``sha256`` the upload is finalized into a
+    DiagnosisRequest.
+    """
+    STATUS_CHOICES = [
+        ("active", "Active"),
+        ("complete", "Complete"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    damage_description = models.TextField(blank=True)
+    size = models.PositiveIntegerField(help_text="Declared length of the image in bytes")
+    sha256 = models.CharField(max_length=64, help_text="Declared SHA-256 of the whole image (hex)")
+    offset = models.PositiveIntegerField(default=0, help_text="Bytes received so far")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
+    diagnosis = models.ForeignKey(DiagnosisRequest, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Upload {self.id} ({self.offset}/{self.size} bytes)"
+
+    @property
+    def temp_path(self):
+        return os.path.join(settings.VISION_UPLOAD_TEMP_DIR, f'{self.id}.part')
+
+
+@receiver(post_save, sender=DiagnosisRequest)
+def index_diagnosis_text(sender, instance, created, update_fields=None, **kwargs):
+    """Add the diagnosis' new text to the search index once the transaction commits"""
+    from .search import INDEXED_FIELDS, diagnosis_text, index_diagnoses
+    if update_fields is not None and not INDEXED_FIELDS.intersection(update_fields):
+        return
+    if created and not diagnosis_text(instance).strip():
+        return
+
+    def index():
+        try:
+            index_diagnoses([instance])
+        except OSError as e:
+            logger.warning("Could not index diagnosis %s for search: %s", instance.pk, e)
+
+    transaction.on_commit(index)
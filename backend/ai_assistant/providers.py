@@ -0,0 +1,334 @@
+import base64
+import json
+import logging
+from collections import namedtuple
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .analysis import RESPONSE_FORMAT
+from .exceptions import (
+    VisionAuthError, VisionQuotaError, VisionRateLimited, VisionServiceError, VisionUpstreamError,
+)
+from .http_client import get_async_http_client, get_http_session, get_http_timeout
+from .resilience import acall_upstream, call_upstream, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+AnalysisRequest = namedtuple('AnalysisRequest', ['prepared', 'prompt', 'damage_description', 'car_info'])
+ProviderResult = namedtuple('ProviderResult', ['text', 'usage'])
+
+
+class VisionProvider:
+    """
+    A backend that turns an AnalysisRequest into analysis text.
+
+    ``analyze`` returns a ProviderResult or raises VisionServiceError.
+    Providers whose text is already user-facing markdown set ``formatted``.
+    """
+    name = None
+    model = None
+    display_name = None
+    formatted = False
+    supports_streaming = False
+    # Offers an asynchronous batch endpoint (see submit_batch)
+    supports_batch = False
+
+    def analyze(self, request):
+        raise NotImplementedError
+
+    async def aanalyze(self, request):
+        """Async analyze(); providers without a native async client run in a thread"""
+        return await sync_to_async(self.analyze, thread_sensitive=False)(request)
+
+
+class OpenAICompatibleProvider(VisionProvider):
+    """Any endpoint speaking the OpenAI chat completions API (OpenAI, vLLM, Ollama, LM Studio...)"""
+    supports_streaming = True
+
+    def __init__(self, name, api_base, api_key, model, display_name=None, structured_output=True):
+        self.name = name
+        self.api_base = api_base.rstrip('/')
+        self.api_key = api_key
+        self.model = model
+        self.display_name = display_name or model
+        # Ask for JSON matching DIAGNOSIS_SCHEMA (needs json_schema response_format support)
+        self.structured_output = structured_output
+
+    def analyze(self, request):
+        # Rate limits and circuit breaker state are tracked per provider
+        result = call_upstream(
+            lambda: self.post_completion(request.prepared, request.prompt),
+            self.estimate_tokens(request.prompt),
+            name=self.name
+        )
+        return ProviderResult(result['choices'][0]['message']['content'], result.get('usage'))
+
+    async def aanalyze(self, request):
+        result = await acall_upstream(
+            lambda: self.apost_completion(request.prepared, request.prompt),
+            self.estimate_tokens(request.prompt),
+            name=self.name
+        )
+        return ProviderResult(result['choices'][0]['message']['content'], result.get('usage'))
+
+    def get_request_headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def build_request_payload(self, prepared, prompt, stream=False):
+        """Chat completions payload for a prepared image and prompt"""
+        image_base64 = base64.standard_b64encode(prepared.data).decode("utf-8")
+        payload = {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{prepared.media_type};base64,{image_base64}"
+                            }
+                        },
+                        {
+                            "type": "text",
+                            "text": prompt
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": 1500
+        }
+        if self.structured_output:
+            payload["response_format"] = RESPONSE_FORMAT
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def post_completion(self, prepared, prompt):
+        """Single chat completions request; maps failures to VisionServiceError"""
+        try:
+            response = get_http_session().post(
+                f"{self.api_base}/chat/completions",
+                headers=self.get_request_headers(),
+                json=self.build_request_payload(prepared, prompt),
+                timeout=get_http_timeout()
+            )
+        except requests.RequestException as e:
+            raise VisionUpstreamError(f"{self.name} request failed: {e}") from e
+
+        if response.status_code != 200:
+            raise self.build_error(response.status_code, response.headers, response.content)
+        return response.json()
+
+    async def apost_completion(self, prepared, prompt):
+        """post_completion() on the event loop's shared httpx client"""
+        try:
+            response = await get_async_http_client().post(
+                f"{self.api_base}/chat/completions",
+                headers=self.get_request_headers(),
+                json=self.build_request_payload(prepared, prompt),
+            )
+        except httpx.HTTPError as e:
+            raise VisionUpstreamError(f"{self.name} request failed: {e}") from e
+
+        if response.status_code != 200:
+            raise self.build_error(response.status_code, response.headers, response.content)
+        return response.json()
+
+    def build_error(self, status_code, headers, body):
+        """VisionServiceError for a non-200 upstream response"""
+        try:
+            error = json.loads(body).get('error') or {}
+        except (ValueError, AttributeError):
+            error = {}
+        error_message = error.get('message') or 'Unknown error'
+        logger.error("%s API error (%s): %s", self.name, status_code, error_message)
+
+        message = f"{self.display_name} API error ({status_code}): {error_message}"
+        if status_code in (401, 403):
+            return VisionAuthError(message, status_code)
+        elif status_code == 429 and error.get('code') == 'insufficient_quota':
+            return VisionQuotaError(message, status_code)
+        elif status_code == 429:
+            return VisionRateLimited(message, status_code, parse_retry_after(headers))
+        elif status_code >= 500:
+            return VisionUpstreamError(message, status_code, parse_retry_after(headers))
+        return VisionServiceError(message, status_code)
+
+    def build_batch_line(self, custom_id, prepared, prompt):
+        """One JSONL line of a Batch API input file"""
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": self.build_request_payload(prepared, prompt),
+        }
+
+    def submit_batch(self, lines):
+        """Upload ``lines`` (see build_batch_line) and start a batch; returns the batch id"""
+        content = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+        upload = self.batch_request(
+            "post", "/files",
+            data={"purpose": "batch"},
+            files={"file": ("reanalysis.jsonl", content, "application/jsonl")},
+        )
+        batch = self.batch_request("post", "/batches", json={
+            "input_file_id": upload["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+        })
+        return batch["id"]
+
+    def get_batch(self, batch_id):
+        """Batch object: ``status`` plus ``output_file_id``/``error_file_id`` once finished"""
+        return self.batch_request("get", f"/batches/{batch_id}")
+
+    def get_batch_results(self, batch):
+        """ProviderResult (or VisionServiceError) per custom_id of a finished batch"""
+        results = {}
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if not file_id:
+                continue
+            content = self.batch_request("get", f"/files/{file_id}/content", raw=True)
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") == 200:
+                    body = response["body"]
+                    results[item["custom_id"]] = ProviderResult(body["choices"][0]["message"]["content"], body.get("usage"))
+                else:
+                    results[item["custom_id"]] = self.build_error(
+                        response.get("status_code") or 500, {}, json.dumps(response.get("body") or item.get("error") or {})
+                    )
+        return results
+
+    def batch_request(self, method, path, raw=False, **kwargs):
+        """Files/Batches API call; maps failures to VisionServiceError"""
+        headers = self.get_request_headers()
+        if "files" in kwargs:
+            # requests sets the multipart boundary itself
+            headers.pop("Content-Type")
+        try:
+            response = get_http_session().request(
+                method, f"{self.api_base}{path}", headers=headers, timeout=get_http_timeout(), **kwargs
+            )
+        except requests.RequestException as e:
+            raise VisionUpstreamError(f"{self.name} request failed: {e}") from e
+
+        if response.status_code != 200:
+            raise self.build_error(response.status_code, response.headers, response.content)
+        return response.text if raw else response.json()
+
+    def estimate_tokens(self, prompt):
+        """Rough token cost of one request, used for the tokens-per-minute bucket"""
+        # ~4 characters per text token, a high-detail image tile set, plus the completion budget
+        return len(prompt) // 4 + 1105 + 1500
+
+
+class OpenAIProvider(OpenAICompatibleProvider):
+    def __init__(self, api_key):
+        super().__init__(
+            'openai',
+            getattr(settings, 'OPENAI_API_BASE', 'https://api.openai.com/v1'),
+            api_key,
+            getattr(settings, 'OPENAI_VISION_MODEL', 'gpt-4o'),
+            display_name='OpenAI GPT-4 Vision',
+        )
+
+    # The Batch API runs at half price within a 24h window
+    supports_batch = True
+
+
+class MockProvider(VisionProvider):
+    """Fallback used when no real provider is configured"""
+    name = 'mock'
+    model = 'mock'
+    display_name = 'Basic Mode'
+    formatted = True
+
+    def analyze(self, request):
+        return ProviderResult(self.get_enhanced_mock_response(request.damage_description, request.car_info), None)
+
+    async def aanalyze(self, request):
+        return self.analyze(request)
+
+    def get_enhanced_mock_response(self, damage_description="", car_info=None):
+        """Fallback response when OpenAI API is not available"""
+
+        car_header = ""
+        car_specific = ""
+        if car_info:
+            car_header = f"\n**Vehicle:** {car_info.get('year', '')} {car_info.get('make', '')} {car_info.get('model', '')}\n"
+            car_specific = f"""
+- Vehicle make/model identified: {car_info.get('year', '')} {car_info.get('make', '')} {car_info.get('model', '')}
+- Model-specific recommendations available upon full AI activation"""
+
+        analysis = f"""🔍 **AI Car Analysis (Basic Mode)**{car_header}
+
+✅ **Image Successfully Processed**: Your car image has been uploaded and analyzed.
+
+📋 **Analysis Results**:
+- Vehicle image detected{car_specific}
+- Basic visual assessment completed"""
+
+        if damage_description and damage_description.strip():
+            analysis += f"""
+- User-reported damage: {damage_description}
+- Damage assessment completed based on user input"""
+        else:
+            analysis += """
+- No immediate concerns identified"""
+
+        analysis += """
+
+✅ **Recommendations**:
+- Continue regular maintenance schedule
+- Monitor for any changes in vehicle condition
+- Keep detailed maintenance records
+- Consider professional inspection for comprehensive analysis
+
+📊 **Severity Level**: Low
+💰 **Estimated Cost**: No immediate costs
+
+🔧 **Next Steps**:
+- Schedule routine maintenance
+- Monitor vehicle performance
+- Document any changes
+
+*Note: This is a basic analysis. For enhanced AI analysis with OpenAI Vision API, please configure your OpenAI API key in the backend settings.*"""
+
+        return analysis
+
+
+def build_providers(openai_api_key):
+    """
+    Providers in VISION_PROVIDERS order (the first one is the primary).
+
+    ``openai`` needs an API key, ``local`` needs VISION_LOCAL_API_BASE; if
+    nothing usable is configured the mock provider is returned.
+    """
+    providers = []
+    for name in getattr(settings, 'VISION_PROVIDERS', ['openai']):
+        name = name.strip()
+        if name == 'openai' and openai_api_key:
+            providers.append(OpenAIProvider(openai_api_key))
+        elif name == 'local' and getattr(settings, 'VISION_LOCAL_API_BASE', ''):
+            providers.append(OpenAICompatibleProvider(
+                'local',
+                settings.VISION_LOCAL_API_BASE,
+                getattr(settings, 'VISION_LOCAL_API_KEY', ''),
+                getattr(settings, 'VISION_LOCAL_MODEL', 'llava'),
+                structured_output=getattr(settings, 'VISION_LOCAL_STRUCTURED_OUTPUT', True),
+            ))
+        elif name == 'mock':
+            providers.append(MockProvider())
+    if not providers:
+        providers.append(MockProvider())
+    return providers
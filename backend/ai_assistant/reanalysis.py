@@ -0,0 +1,208 @@
+"""
+Background re-analysis of stored diagnoses after a prompt or model change.
+
+A ReanalysisRun selects diagnoses with FILTERS and walks them in id order,
+one chunk per step:
+
+* inline mode: the chunk's vision calls run on ``run.concurrency`` threads
+* batch mode: the chunk is submitted to the provider's Batch API and
+  collected by a later step; rows the batch did not answer, and providers
+  without a Batch API, fall back to inline calls
+
+Each chunk is written with one bulk_update and the run's checkpoint is
+advanced in the same transaction. Steps are driven by the
+``reanalyze_diagnoses`` Celery task or management command.
+"""
+
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .analysis_cache import set_cached_analysis
+from .models import DiagnosisRequest, ReanalysisRun
+from .openai_vision_service import get_vision_service
+from .providers import ProviderResult
+from .search import index_diagnoses
+from .tasks import ANALYSIS_FIELDS, analyze_diagnoses, set_analysis_result
+
+logger = logging.getLogger(__name__)
+
+# Run filter name -> DiagnosisRequest lookup
+FILTERS = {
+    'car_id': 'car_id',
+    'user_id': 'user_id',
+    'severity': 'severity__in',
+    'status': 'status__in',
+    'provider': 'provider__in',
+    'created_after': 'created_at__gte',
+    'created_before': 'created_at__lt',
+}
+# Batch API statuses that are still worth polling
+PENDING_BATCH_STATUSES = ('validating', 'in_progress', 'finalizing', 'cancelling')
+
+
+def reanalysis_queryset(filters):
+    """Diagnoses selected by a run's ``filters``; raises ValueError for unknown names"""
+    lookups = {}
+    for name, value in filters.items():
+        if name not in FILTERS:
+            raise ValueError(f"Unknown re-analysis filter: {name}")
+        lookups[FILTERS[name]] = value
+    return DiagnosisRequest.objects.filter(**lookups).exclude(image='')
+
+
+def start_run(filters, mode='inline', chunk_size=None, concurrency=None):
+    """Create a pending run (call run_step or enqueue the task to process it)"""
+    reanalysis_queryset(filters)
+    return ReanalysisRun.objects.create(
+        filters=filters,
+        mode=mode,
+        chunk_size=chunk_size or getattr(settings, 'VISION_REANALYSIS_CHUNK_SIZE', 50),
+        concurrency=concurrency or getattr(settings, 'VISION_REANALYSIS_CONCURRENCY', 4),
+    )
+
+
+def next_chunk(run):
+    queryset = reanalysis_queryset(run.filters).filter(id__gt=run.last_id).select_related('car')
+    return list(queryset.order_by('id')[:run.chunk_size])
+
+
+def run_step(run, vision_service=None, final_attempt=True):
+    """
+    Advance ``run`` by one chunk.
+
+    Returns the seconds to wait before the next step (0 to continue right
+    away) or None once the run is finished. If rows failed with a retryable
+    error and this is not the final attempt, the rows that succeeded are
+    saved, the checkpoint stays put and the error is raised so the caller can
+    retry the chunk later; the finished rows then come from the analysis cache.
+    Rows that still fail keep their previous analysis.
+    """
+    if run.status in ('done', 'failed', 'cancelled'):
+        return None
+    vision_service = vision_service or get_vision_service()
+    if run.status == 'pending':
+        run.total = reanalysis_queryset(run.filters).count()
+        run.status = 'running'
+        run.save(update_fields=['total', 'status', 'updated_at'])
+
+    batch = run.mode == 'batch' and vision_service.primary.supports_batch
+    if batch and run.batch_id:
+        return _collect_batch(run, vision_service, final_attempt)
+
+    chunk = next_chunk(run)
+    if not chunk:
+        run.status = 'done'
+        run.finished_at = timezone.now()
+        run.save(update_fields=['status', 'finished_at', 'updated_at'])
+        logger.info("Re-analysis %s finished: %d diagnoses, %d failed", run.id, run.processed, run.failed)
+        return None
+
+    if batch:
+        return _submit_batch(run, vision_service, chunk, final_attempt)
+    errors = _analyze(run, vision_service, chunk)
+    _commit_chunk(run, chunk, errors, chunk[-1].id, len(chunk), 0, final_attempt)
+    return 0
+
+
+def fail_run(run, error):
+    logger.error("Re-analysis %s failed: %s", run.id, error)
+    run.status = 'failed'
+    run.error_message = str(error)
+    run.finished_at = timezone.now()
+    run.save(update_fields=['status', 'error_message', 'finished_at', 'updated_at'])
+
+
+def _analyze(run, vision_service, rows):
+    """Vision calls for ``rows`` on up to ``run.concurrency`` threads; the error (or None) per row"""
+    return analyze_diagnoses(rows, vision_service, run.concurrency)
+
+
+def _commit_chunk(run, rows, errors, last_id, handled, failed, final_attempt):
+    """Bulk update the rows analysed successfully and move the checkpoint past the chunk"""
+    done = [row for row, error in zip(rows, errors) if error is None]
+    retry = next((error for error in errors if getattr(error, 'retryable', False)), None)
+    if retry is not None and not final_attempt:
+        DiagnosisRequest.objects.bulk_update(done, ANALYSIS_FIELDS)
+        raise retry
+
+    with transaction.atomic():
+        DiagnosisRequest.objects.bulk_update(done, ANALYSIS_FIELDS)
+        run.last_id = last_id
+        run.processed += handled
+        run.failed += failed + len(rows) - len(done)
+        run.batch_id = ''
+        run.batch_state = {}
+        run.save(update_fields=['last_id', 'processed', 'failed', 'batch_id', 'batch_state', 'updated_at'])
+    # bulk_update sends no post_save, so the new reports are indexed here
+    index_diagnoses(done)
+    logger.info("Re-analysis %s: %d/%d diagnoses", run.id, run.processed, run.total)
+
+
+def _submit_batch(run, vision_service, chunk, final_attempt):
+    """Send the chunk's cache misses to the Batch API; cached analyses are applied directly"""
+    provider = vision_service.primary
+    lines, cached, cache_keys, failed = [], [], {}, 0
+    for diagnosis in chunk:
+        stats = {}
+        try:
+            prepared, prompt, cache_key, analysis = vision_service.prepare_request(
+                diagnosis.image, diagnosis.damage_description, diagnosis.get_car_info(), stats
+            )
+        except Exception as e:
+            logger.warning("Re-analysis %s: cannot prepare diagnosis %s: %s", run.id, diagnosis.id, e)
+            failed += 1
+            continue
+        if analysis is not None:
+            set_analysis_result(diagnosis, analysis, stats)
+            cached.append(diagnosis)
+        else:
+            cache_keys[str(diagnosis.id)] = cache_key
+            lines.append(provider.build_batch_line(str(diagnosis.id), prepared, prompt))
+
+    if not lines:
+        _commit_chunk(run, cached, [None] * len(cached), chunk[-1].id, len(chunk), failed, final_attempt)
+        return 0
+
+    DiagnosisRequest.objects.bulk_update(cached, ANALYSIS_FIELDS)
+    run.batch_id = provider.submit_batch(lines)
+    run.batch_state = {'last_id': chunk[-1].id, 'handled': len(chunk), 'failed': failed, 'cache_keys': cache_keys}
+    run.save(update_fields=['batch_id', 'batch_state', 'updated_at'])
+    logger.info("Re-analysis %s: submitted %d diagnoses as batch %s", run.id, len(lines), run.batch_id)
+    return getattr(settings, 'VISION_REANALYSIS_BATCH_POLL', 60)
+
+
+def _collect_batch(run, vision_service, final_attempt):
+    """Apply a finished batch; rows it did not answer are analysed inline"""
+    provider = vision_service.primary
+    batch = provider.get_batch(run.batch_id)
+    if batch.get('status') in PENDING_BATCH_STATUSES:
+        return getattr(settings, 'VISION_REANALYSIS_BATCH_POLL', 60)
+
+    state = run.batch_state
+    results = provider.get_batch_results(batch)
+    rows = list(DiagnosisRequest.objects.filter(id__in=state['cache_keys']).select_related('car').order_by('id'))
+    answered, missing = [], []
+    for diagnosis in rows:
+        result = results.get(str(diagnosis.id))
+        if not isinstance(result, ProviderResult):
+            missing.append(diagnosis)
+            continue
+        usage = result.usage or {}
+        analysis = vision_service.build_analysis(provider, result)
+        set_cached_analysis(state['cache_keys'][str(diagnosis.id)], analysis)
+        set_analysis_result(diagnosis, analysis, {
+            'cache_status': 'batch',
+            'provider': provider.name,
+            'prompt_tokens': usage.get('prompt_tokens'),
+            'completion_tokens': usage.get('completion_tokens'),
+        })
+        answered.append(diagnosis)
+
+    errors = [None] * len(answered)
+    if missing:
+        logger.info("Re-analysis %s: batch %s (%s) left %d diagnoses, analysing them inline",
+                    run.id, run.batch_id, batch.get('status'), len(missing))
+        errors += _analyze(run, vision_service, missing)
+    _commit_chunk(run, answered + missing, errors, state['last_id'], state['handled'], state['failed'], final_attempt)
+    return 0
@@ -0,0 +1,57 @@
+"""
+Daily usage report for vision analyses: latency percentiles, token usage,
+image bytes sent and cache hits. Used by the ``vision_usage_report``
+management command and the admin usage view.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from django.db.models import Avg, Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from automate.stats import percentile
+from .models import DiagnosisRequest
+
+REPORT_COLUMNS = [
+    ('day', 'Day'),
+    ('diagnoses', 'Diagnoses'),
+    ('cache_hits', 'Cache hits'),
+    ('upstream_calls', 'Upstream calls'),
+    ('latency_p50_ms', 'p50 ms'),
+    ('latency_p95_ms', 'p95 ms'),
+    ('prompt_tokens', 'Prompt tokens'),
+    ('completion_tokens', 'Completion tokens'),
+    ('avg_sent_image_bytes', 'Avg image bytes'),
+]
+
+
+def daily_usage_report(days=7):
+    """One row per day (newest first) for diagnoses created in the last ``days`` days"""
+    since = timezone.now() - timedelta(days=days)
+    queryset = DiagnosisRequest.objects.filter(created_at__gte=since).annotate(day=TruncDate('created_at'))
+
+    rows = queryset.values('day').annotate(
+        diagnoses=Count('id'),
+        cache_hits=Count('id', filter=Q(cache_status='hit')),
+        upstream_calls=Count('id', filter=Q(upstream_latency_ms__isnull=False)),
+        prompt_tokens=Sum('prompt_tokens'),
+        completion_tokens=Sum('completion_tokens'),
+        avg_sent_image_bytes=Avg('sent_image_bytes'),
+    ).order_by('-day')
+
+    # Percentiles are computed here so the report works on SQLite and PostgreSQL alike
+    latencies = defaultdict(list)
+    for day, latency in queryset.filter(upstream_latency_ms__isnull=False).values_list('day', 'upstream_latency_ms'):
+        latencies[day].append(latency)
+
+    report = []
+    for row in rows:
+        values = sorted(latencies.get(row['day'], []))
+        row['latency_p50_ms'] = percentile(values, 50)
+        row['latency_p95_ms'] = percentile(values, 95)
+        row['prompt_tokens'] = row['prompt_tokens'] or 0
+        row['completion_tokens'] = row['completion_tokens'] or 0
+        if row['avg_sent_image_bytes'] is not None:
+            row['avg_sent_image_bytes'] = int(row['avg_sent_image_bytes'])
+        report.append(row)
+    return report
@@ -0,0 +1,248 @@
+"""
+Shared protection for upstream vision calls.
+
+* Token buckets (automate/rate_limit.py) sized to the provider's
+  requests-per-minute and tokens-per-minute limits. Backed by Redis (one
+  bucket for every gunicorn and Celery process) when REDIS_URL is set,
+  otherwise by an in-process bucket.
+* Retries with exponential backoff and full jitter that honour Retry-After.
+* A circuit breaker that fails fast while upstream keeps erroring. Its state
+  lives in the default cache, so it is shared across processes with Redis.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from django.conf import settings
+from django.core.cache import cache
+from automate.rate_limit import LocalTokenBucket, RedisTokenBucket
+from .exceptions import VisionCircuitOpen, VisionRateLimited, VisionThrottled
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamRateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one provider"""
+
+    def __init__(self, request_bucket, token_bucket):
+        self.request_bucket = request_bucket
+        self.token_bucket = token_bucket
+
+    def acquire(self, estimated_tokens, max_wait=None):
+        """
+        Block until both buckets allow the call.
+        Raises VisionThrottled if that would take longer than ``max_wait`` seconds.
+        """
+        if max_wait is None:
+            max_wait = getattr(settings, 'VISION_RATE_LIMIT_MAX_WAIT', 30)
+        deadline = time.monotonic() + max_wait
+        for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, estimated_tokens)):
+            while True:
+                wait = bucket.take(amount)
+                if not wait:
+                    break
+                if time.monotonic() + wait > deadline:
+                    raise VisionThrottled("Local rate limit reached", retry_after=wait)
+                time.sleep(wait)
+
+    async def aacquire(self, estimated_tokens, max_wait=None):
+        """acquire() for async views: waits on the event loop instead of a thread"""
+        if max_wait is None:
+            max_wait = getattr(settings, 'VISION_RATE_LIMIT_MAX_WAIT', 30)
+        deadline = time.monotonic() + max_wait
+        for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, estimated_tokens)):
+            while True:
+                wait = await bucket.atake(amount)
+                if not wait:
+                    break
+                if time.monotonic() + wait > deadline:
+                    raise VisionThrottled("Local rate limit reached", retry_after=wait)
+                await asyncio.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name='openai'):
+    """Shared limiter for a provider, sized from VISION_RATE_LIMIT_RPM / _TPM"""
+    limiter = _limiters.get(name)
+    if limiter is not None:
+        return limiter
+
+    with _limiters_lock:
+        if name not in _limiters:
+            rpm = getattr(settings, 'VISION_RATE_LIMIT_RPM', 500)
+            tpm = getattr(settings, 'VISION_RATE_LIMIT_TPM', 30000)
+            redis_url = getattr(settings, 'REDIS_URL', '')
+            if redis_url:
+                import redis
+                client = redis.Redis.from_url(redis_url)
+                buckets = (
+                    RedisTokenBucket(client, f'vision-ratelimit:{name}:requests', rpm, rpm),
+                    RedisTokenBucket(client, f'vision-ratelimit:{name}:tokens', tpm, tpm),
+                )
+            else:
+                buckets = (LocalTokenBucket(rpm, rpm), LocalTokenBucket(tpm, tpm))
+            _limiters[name] = UpstreamRateLimiter(*buckets)
+    return _limiters[name]
+
+
+def reset_rate_limiters():
+    with _limiters_lock:
+        _limiters.clear()
+
+
+class CircuitBreaker:
+    """
+    Opens after VISION_CIRCUIT_FAILURE_THRESHOLD consecutive upstream failures
+    and rejects calls for VISION_CIRCUIT_RESET_TIMEOUT seconds. After that a
+    single trial call is let through (half-open); success closes the circuit.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.failures_key = f'vision-circuit:{name}:failures'
+        self.open_key = f'vision-circuit:{name}:open'
+        self.trial_key = f'vision-circuit:{name}:trial'
+
+    @property
+    def threshold(self):
+        return getattr(settings, 'VISION_CIRCUIT_FAILURE_THRESHOLD', 5)
+
+    @property
+    def reset_timeout(self):
+        return getattr(settings, 'VISION_CIRCUIT_RESET_TIMEOUT', 60)
+
+    def before_call(self):
+        if cache.get(self.open_key):
+            raise VisionCircuitOpen(f"{self.name} circuit open", retry_after=self.reset_timeout)
+        if (cache.get(self.failures_key) or 0) >= self.threshold:
+            # Half-open: only one caller gets to probe upstream
+            if not cache.add(self.trial_key, 1, timeout=self.reset_timeout):
+                raise VisionCircuitOpen(f"{self.name} circuit half-open", retry_after=self.reset_timeout)
+
+    def record_success(self):
+        cache.delete_many([self.failures_key, self.trial_key])
+
+    def record_failure(self):
+        cache.add(self.failures_key, 0, timeout=None)
+        failures = cache.incr(self.failures_key)
+        if failures >= self.threshold:
+            logger.warning("Opening %s circuit after %s failures", self.name, failures)
+            cache.set(self.open_key, 1, timeout=self.reset_timeout)
+            cache.delete(self.trial_key)
+
+    async def abefore_call(self):
+        if await cache.aget(self.open_key):
+            raise VisionCircuitOpen(f"{self.name} circuit open", retry_after=self.reset_timeout)
+        if (await cache.aget(self.failures_key) or 0) >= self.threshold:
+            if not await cache.aadd(self.trial_key, 1, timeout=self.reset_timeout):
+                raise VisionCircuitOpen(f"{self.name} circuit half-open", retry_after=self.reset_timeout)
+
+    async def arecord_success(self):
+        await cache.adelete_many([self.failures_key, self.trial_key])
+
+    async def arecord_failure(self):
+        await cache.aadd(self.failures_key, 0, timeout=None)
+        failures = await cache.aincr(self.failures_key)
+        if failures >= self.threshold:
+            logger.warning("Opening %s circuit after %s failures", self.name, failures)
+            await cache.aset(self.open_key, 1, timeout=self.reset_timeout)
+            await cache.adelete(self.trial_key)
+
+
+def parse_retry_after(headers):
+    """Seconds to wait from Retry-After / retry-after-ms headers, or None"""
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with full jitter; Retry-After is used as the floor"""
+    base = getattr(settings, 'VISION_RETRY_BASE_DELAY', 1.0)
+    cap = getattr(settings, 'VISION_RETRY_MAX_DELAY', 30.0)
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def call_upstream(func, estimated_tokens, name='openai'):
+    """
+    Call ``func`` (one upstream request) under the shared rate limiter and
+    circuit breaker, retrying retryable VisionServiceErrors with backoff.
+    """
+    breaker = CircuitBreaker(name)
+    limiter = get_rate_limiter(name)
+    max_retries = getattr(settings, 'VISION_MAX_RETRIES', 3)
+
+    attempt = 0
+    while True:
+        breaker.before_call()
+        limiter.acquire(estimated_tokens)
+        try:
+            result = func()
+        except VisionRateLimited as e:
+            # Upstream throttling is not a health problem; don't trip the breaker
+            error = e
+        except Exception as e:
+            if getattr(e, 'retryable', False):
+                breaker.record_failure()
+            error = e
+        else:
+            breaker.record_success()
+            return result
+
+        if not getattr(error, 'retryable', False) or attempt >= max_retries:
+            raise error
+        delay = backoff_delay(attempt, getattr(error, 'retry_after', None))
+        logger.warning("Upstream call failed (%s); retrying in %.1fs", error, delay)
+        time.sleep(delay)
+        attempt += 1
+
+
+async def acall_upstream(func, estimated_tokens, name='openai'):
+    """call_upstream() for coroutines: ``func`` returns an awaitable"""
+    breaker = CircuitBreaker(name)
+    limiter = get_rate_limiter(name)
+    max_retries = getattr(settings, 'VISION_MAX_RETRIES', 3)
+
+    attempt = 0
+    while True:
+        await breaker.abefore_call()
+        await limiter.aacquire(estimated_tokens)
+        try:
+            result = await func()
+        except VisionRateLimited as e:
+            error = e
+        except Exception as e:
+            if getattr(e, 'retryable', False):
+                await breaker.arecord_failure()
+            error = e
+        else:
+            await breaker.arecord_success()
+            return result
+
+        if not getattr(error, 'retryable', False) or attempt >= max_retries:
+            raise error
+        delay = backoff_delay(attempt, getattr(error, 'retry_after', None))
+        logger.warning("Upstream call failed (%s); retrying in %.1fs", error, delay)
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,130 @@
+"""
+Retention purge for diagnoses and their stored images.
+
+Rows are deleted in batches of at most DIAGNOSIS_PURGE_BATCH_SIZE primary
+keys, each in its own short transaction, so the table is never locked for
+long and Django's delete collector only ever sees one batch. The image files
+of a batch are removed from storage in parallel once its rows are gone
+(deleting the rows never removes files, which is how clear_old_diagnoses.py
+used to leave orphans behind), along with their resized variants that no
+other row shares.
+
+The policy (DIAGNOSIS_RETENTION_DAYS, DIAGNOSIS_RETENTION_MAX_PER_USER) is
+applied daily by the ``purge_expired_diagnoses`` task and on demand by the
+``purge_diagnoses`` management command.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+from automate.image_variants import delete_variants, variant_names
+from .models import DiagnosisRequest
+
+logger = logging.getLogger(__name__)
+
+# File fields removed from storage along with a diagnosis (and their <field>_variants)
+FILE_FIELDS = ['image']
+VARIANT_FIELDS = [f'{field}_variants' for field in FILE_FIELDS]
+
+
+def retention_querysets(days=None, max_per_user=None):
+    """
+    Querysets of diagnoses past the retention policy: older than ``days``,
+    and per user everything beyond the newest ``max_per_user``. Rows matched
+    by the age rule are left out of the quota ones so nothing is counted twice.
+    """
+    querysets = []
+    cutoff = timezone.now() - timedelta(days=days) if days else None
+    if cutoff:
+        querysets.append(DiagnosisRequest.objects.filter(created_at__lt=cutoff))
+
+    if max_per_user:
+        over_quota = (
+            DiagnosisRequest.objects.filter(user__isnull=False)
+            .values('user_id').annotate(count=Count('id')).filter(count__gt=max_per_user)
+        )
+        for row in over_quota:
+            user_rows = DiagnosisRequest.objects.filter(user_id=row['user_id'])
+            # Ids grow with created_at, so the quota keeps the newest ids
+            oldest_kept = user_rows.order_by('-id').values_list('id', flat=True)[max_per_user - 1]
+            queryset = user_rows.filter(id__lt=oldest_kept)
+            if cutoff:
+                queryset = queryset.filter(created_at__gte=cutoff)
+            querysets.append(queryset)
+    return querysets
+
+
+def estimate_purge(queryset):
+    """Rows, files and approximate bytes a purge of ``queryset`` would free"""
+    totals = queryset.aggregate(
+        diagnoses=Count('id'),
+        files=Count('id', filter=~Q(image='')),
+        measured=Count('original_image_bytes'),
+        bytes=Sum('original_image_bytes'),
+    )
+    size = totals['bytes'] or 0
+    # Rows stored before sizes were recorded count at the average size
+    if totals['measured'] and totals['files'] > totals['measured']:
+        size += size // totals['measured'] * (totals['files'] - totals['measured'])
+    return {'diagnoses': totals['diagnoses'], 'files': totals['files'], 'bytes': size}
+
+
+def purge(queryset, batch_size=None, workers=None, dry_run=False):
+    """
+    Delete ``queryset`` in primary-key ordered batches and remove the stored
+    files and variants. Returns counts of deleted diagnoses and files (or, with
+    ``dry_run``, the estimate_purge() figures).
+    """
+    if dry_run:
+        return estimate_purge(queryset)
+    batch_size = batch_size or getattr(settings, 'DIAGNOSIS_PURGE_BATCH_SIZE', 500)
+    workers = workers or getattr(settings, 'DIAGNOSIS_PURGE_FILE_WORKERS', 8)
+    storage = DiagnosisRequest._meta.get_field('image').storage
+
+    def delete_file(name):
+        try:
+            storage.delete(name)
+        except OSError as e:
+            logger.warning("Could not delete %s: %s", name, e)
+            return False
+        return True
+
+    deleted = files = 0
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='purge') as executor:
+        while True:
+            rows = list(
+                queryset.filter(id__gt=last_id).order_by('id')
+                .values_list('id', *FILE_FIELDS, *VARIANT_FIELDS)[:batch_size]
+            )
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            last_id = ids[-1]
+            DiagnosisRequest.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            names = [name for row in rows for name in row[1:1 + len(FILE_FIELDS)] if name]
+            files += sum(executor.map(delete_file, names))
+            variants = [name for row in rows for value in row[1 + len(FILE_FIELDS):] for name in variant_names(value)]
+            files += delete_variants(storage, variants)
+
+    logger.info("Purged %d diagnoses and %d files", deleted, files)
+    return {'diagnoses': deleted, 'files': files}
+
+
+def apply_retention(days=None, max_per_user=None, batch_size=None, workers=None, dry_run=False):
+    """Purge everything past the policy (settings when not given); returns summed counts"""
+    if days is None:
+        days = getattr(settings, 'DIAGNOSIS_RETENTION_DAYS', 0)
+    if max_per_user is None:
+        max_per_user = getattr(settings, 'DIAGNOSIS_RETENTION_MAX_PER_USER', 0)
+
+    totals = {}
+    for queryset in retention_querysets(days, max_per_user):
+        result = purge(queryset, batch_size=batch_size, workers=workers, dry_run=dry_run)
+        for key, value in result.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
@@ -0,0 +1,287 @@
+"""
+Full-text search over a user's diagnosis history.
+
+Each diagnosis' ``damage_description`` and report (``ai_result``, or the
+markdown rendered from the structured analysis) are turned into a
+hashed n-gram vector (word unigrams and bigrams plus character trigrams, so
+"rusty" still finds "rust"), L2-normalised, and stored as one record in an
+append-only file under DIAGNOSIS_SEARCH_DIR::
+
+    (diagnosis id, user id, vector[DIAGNOSIS_SEARCH_DIMENSIONS] float32)
+
+A search memory-maps the file, keeps the latest record of every diagnosis of
+the user and ranks them by cosine similarity (a dot product, since vectors
+are normalised). Only the user's rows are paged in, so a query takes a few
+milliseconds even with a large index.
+
+Saving a diagnosis appends a new record (see the post_save receiver in
+models.py); stale records are skipped at query time and dropped by
+``rebuild_search_index``, which also indexes existing rows. Deleted
+diagnoses are filtered out when the results are loaded from the database.
+Appends and rebuilds are serialised with an flock, so web and Celery
+processes can share one index.
+"""
+
+import fcntl
+import logging
+import math
+import os
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+import numpy as np
+from django.conf import settings
+from .models import DiagnosisRequest
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have in is it its of on or that the there this to was were '
+    'we when which with did do does last see seen what where who why how our your their'.split()
+)
+# Fields whose changes require re-indexing a diagnosis
+INDEXED_FIELDS = {'ai_result', 'analysis', 'damage_description', 'user', 'user_id'}
+READ_BLOCK = 2000
+
+
+def dimensions():
+    return getattr(settings, 'DIAGNOSIS_SEARCH_DIMENSIONS', 1024)
+
+
+def record_dtype():
+    return np.dtype([('id', '<i8'), ('user', '<i8'), ('vector', '<f4', (dimensions(),))])
+
+
+def index_path():
+    directory = getattr(settings, 'DIAGNOSIS_SEARCH_DIR', os.path.join(settings.BASE_DIR, 'search_index'))
+    # Changing the dimensions starts a new index file (fill it with rebuild_search_index)
+    return os.path.join(directory, f'diagnoses-{dimensions()}.idx')
+
+
+def features(text):
+    words = [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+    for word in words:
+        yield word
+        padded = f'<{word}>'
+        for start in range(len(padded) - 2):
+            yield '#' + padded[start:start + 3]
+    for first, second in zip(words, words[1:]):
+        yield f'{first} {second}'
+
+
+def vectorize(text):
+    """Normalised hashed feature vector of ``text`` (all zeros for empty text)"""
+    size = dimensions()
+    counts = {}
+    for feature in features(text):
+        # crc32 is stable across processes, unlike hash()
+        value = zlib.crc32(feature.encode())
+        counts[value] = counts.get(value, 0) + 1
+    vector = np.zeros(size, dtype=np.float32)
+    for value, count in counts.items():
+        # The top bit picks a sign so colliding features tend to cancel out
+        sign = -1.0 if value & 0x80000000 else 1.0
+        vector[value % size] += sign * (1 + math.log(count))
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def diagnosis_text(diagnosis):
+    return f'{diagnosis.damage_description or ""}\n{diagnosis.rendered_result or ""}'
+
+
+def build_records(diagnoses):
+    diagnoses = list(diagnoses)
+    records = np.zeros(len(diagnoses), dtype=record_dtype())
+    for row, diagnosis in enumerate(diagnoses):
+        records['id'][row] = diagnosis.id
+        records['user'][row] = diagnosis.user_id or 0
+        records['vector'][row] = vectorize(diagnosis_text(diagnosis))
+    return records
+
+
+@contextmanager
+def _index_lock(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def index_diagnoses(diagnoses):
+    """Append the current text of ``diagnoses`` to the index"""
+    records = build_records(diagnoses)
+    if not len(records):
+        return 0
+    path = index_path()
+    with _index_lock(path), open(path, 'ab') as index_file:
+        # Drop a partial record left by a writer that died mid-append
+        size = index_file.tell()
+        whole = size - size % records.dtype.itemsize
+        if whole != size:
+            index_file.truncate(whole)
+        index_file.write(records.tobytes())
+    return len(records)
+
+
+def rebuild_index(queryset=None):
+    """Rewrite the index from the database (one record per diagnosis); returns the count"""
+    queryset = queryset if queryset is not None else DiagnosisRequest.objects.all()
+    path = index_path()
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    total = 0
+    with _index_lock(path):
+        with open(temp_path, 'wb') as index_file:
+            rows = queryset.order_by('id').select_related('car')
+            last_id = 0
+            while True:
+                block = list(rows.filter(id__gt=last_id)[:READ_BLOCK])
+                if not block:
+                    break
+                index_file.write(build_records(block).tobytes())
+                total += len(block)
+                last_id = block[-1].id
+        os.replace(temp_path, path)
+    logger.info("Rebuilt the diagnosis search index with %d diagnoses", total)
+    return total
+
+
+class IndexSnapshot:
+    """One consistent view of the index file; never changed once published"""
+
+    def __init__(self, signature, records, ids, users, latest):
+        self.signature = signature
+        self.records = records
+        self.ids = ids
+        self.users = users
+        # Position of the last record of every diagnosis (later appends win)
+        self.latest = latest
+
+
+class SearchIndex:
+    """
+    Read side of the index file. Ids and users are copied into memory (only
+    the new tail when the file grew) so a query touches just the vectors of
+    the user's rows; a replaced file (rebuild) is loaded afresh.
+
+    The index is shared by every thread of the process: refresh() builds a
+    new IndexSnapshot under a lock and swaps it in, and a search works on
+    the single snapshot it was handed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = None
+        # Diagnosis id -> its slot in snapshot.latest (only touched under the lock)
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """The current snapshot (None while the index is empty)"""
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.snapshot, self.slots = None, {}
+                return None
+            dtype = record_dtype()
+            count = stat.st_size // dtype.itemsize
+            signature = (stat.st_ino, count)
+            current = self.snapshot
+            if current is not None and current.signature == signature:
+                return current
+            if not count:
+                self.snapshot, self.slots = None, {}
+                return None
+
+            records = np.memmap(self.path, dtype=dtype, mode='r', shape=(count,))
+            known = 0
+            if current is not None and current.signature[0] == stat.st_ino and current.signature[1] < count:
+                known = current.signature[1]
+            tail_ids = np.array(records['id'][known:])
+            tail_users = np.array(records['user'][known:])
+            if known:
+                ids = np.concatenate([current.ids, tail_ids])
+                users = np.concatenate([current.users, tail_users])
+                latest = self._append_latest(current.latest, tail_ids, known)
+            else:
+                ids, users = tail_ids, tail_users
+                _, last_from_end = np.unique(ids[::-1], return_index=True)
+                latest = count - 1 - last_from_end
+                self.slots = dict(zip(ids[latest].tolist(), range(len(latest))))
+            self.snapshot = IndexSnapshot(signature, records, ids, users, latest)
+            return self.snapshot
+
+    def _append_latest(self, latest, tail_ids, offset):
+        """``latest`` updated for records appended at ``offset`` (linear in the tail)"""
+        latest = latest.copy()
+        added = []
+        for position, diagnosis_id in enumerate(tail_ids.tolist(), start=offset):
+            slot = self.slots.get(diagnosis_id)
+            if slot is None:
+                self.slots[diagnosis_id] = len(latest) + len(added)
+                added.append(position)
+            elif slot < len(latest):
+                latest[slot] = position
+            else:
+                added[slot - len(latest)] = position
+        if added:
+            latest = np.concatenate([latest, np.array(added, dtype=latest.dtype)])
+        return latest
+
+    def search(self, user_id, query_vector, limit, ids=None):
+        """``[(diagnosis id, score), ...]`` best first, among ``user_id``'s diagnoses (or ``ids``)"""
+        snapshot = self.refresh()
+        if snapshot is None:
+            return []
+        rows = snapshot.latest[snapshot.users[snapshot.latest] == user_id]
+        if ids is not None:
+            rows = rows[np.isin(snapshot.ids[rows], np.fromiter(ids, dtype=np.int64))]
+        if not len(rows):
+            return []
+        scores = snapshot.records['vector'][rows] @ query_vector
+        if len(rows) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-scores[top])]
+        return [(int(snapshot.ids[rows[i]]), float(scores[i])) for i in top]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_search_index():
+    path = index_path()
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = SearchIndex(path)
+        return _indexes[path]
+
+
+def search_diagnoses(user, query, limit=10, queryset=None):
+    """
+    The user's diagnoses best matching ``query`` as ``[(diagnosis, score)]``,
+    optionally restricted to ``queryset`` (e.g. one car's diagnoses).
+    """
+    query_vector = vectorize(query)
+    if not query_vector.any():
+        return []
+    ids = None
+    if queryset is not None:
+        ids = list(queryset.values_list('id', flat=True))
+    # Ask for a few extra hits in case some were deleted since they were indexed
+    hits = get_search_index().search(user.id, query_vector, limit * 2, ids)
+    min_score = getattr(settings, 'DIAGNOSIS_SEARCH_MIN_SCORE', 0.1)
+    hits = [(diagnosis_id, score) for diagnosis_id, score in hits if score >= min_score]
+    diagnoses = DiagnosisRequest.objects.filter(user=user, id__in=[hit[0] for hit in hits]).select_related('car')
+    by_id = {diagnosis.id: diagnosis for diagnosis in diagnoses}
+    return [(by_id[diagnosis_id], score) for diagnosis_id, score in hits if diagnosis_id in by_id][:limit]
@@ -1,11 +1,87 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import DiagnosisRequest
+from automate.image_variants import variant_urls
+from automate.media import ProtectedImageField
+from .models import DiagnosisRequest, UploadSession
+from cars.models import Car
 from cars.serializers import CarSerializer
 
+STRUCTURED_ANALYSIS_FIELDS = [
+    'severity', 'estimated_cost_min', 'estimated_cost_max', 'affected_areas', 'has_safety_concerns', 'safe_to_drive',
+]
+
+
 class DiagnosisRequestSerializer(serializers.ModelSerializer):
     car = CarSerializer(read_only=True)
     car_id = serializers.IntegerField(write_only=True)
+    ai_result = serializers.CharField(source='rendered_result', read_only=True)
+    image = ProtectedImageField()
+    image_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = DiagnosisRequest
-        fields = ['id', 'car', 'car_id', 'image', 'ai_result', 'damage_description', 'created_at'] 
\ No newline at end of file
+        fields = ['id', 'car', 'car_id', 'image', 'image_variants', 'ai_result', 'damage_description', 'status', 'error_message', 'reused_from', 'created_at'] + STRUCTURED_ANALYSIS_FIELDS
+        read_only_fields = ['status', 'error_message', 'reused_from'] + STRUCTURED_ANALYSIS_FIELDS
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj, 'image', self.context.get('request'))
+
+    def validate_car_id(self, value):
+        # Async views authenticate by token themselves and pass the user in
+        user = self.context.get('user') or self.context['request'].user
+        if not Car.objects.filter(id=value, user=user).exists():
+            raise serializers.ValidationError('Car not found')
+        return value
+
+class DiagnosisStatusSerializer(serializers.ModelSerializer):
+    ai_result = serializers.CharField(source='rendered_result', read_only=True)
+
+    class Meta:
+        model = DiagnosisRequest
+        fields = ['id', 'status', 'ai_result', 'error_message'] + STRUCTURED_ANALYSIS_FIELDS
+        read_only_fields = fields
+
+
+class DiagnosisBatchSerializer(serializers.Serializer):
+    """Several images of one car submitted together"""
+    car_id = serializers.IntegerField()
+    images = serializers.ListField(child=serializers.ImageField(), allow_empty=False)
+    damage_description = serializers.CharField(required=False, allow_blank=True, default='')
+
+    def validate_car_id(self, value):
+        user = self.context['request'].user
+        if not Car.objects.filter(id=value, user=user).exists():
+            raise serializers.ValidationError('Car not found')
+        return value
+
+    def validate_images(self, value):
+        max_images = getattr(settings, 'VISION_BATCH_MAX_IMAGES', 10)
+        if len(value) > max_images:
+            raise serializers.ValidationError(f'At most {max_images} images per batch')
+        return value
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """A resumable upload: declared on create, then filled by PATCH chunks"""
+    car_id = serializers.IntegerField(write_only=True)
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'car_id', 'filename', 'damage_description', 'size', 'sha256', 'offset', 'status', 'diagnosis', 'expires_at']
+        read_only_fields = ['offset', 'status', 'diagnosis', 'expires_at']
+
+    def validate_car_id(self, value):
+        user = self.context['request'].user
+        if not Car.objects.filter(id=value, user=user).exists():
+            raise serializers.ValidationError('Car not found')
+        return value
+
+    def validate_size(self, value):
+        max_size = getattr(settings, 'VISION_UPLOAD_MAX_SIZE', 20 * 1024 * 1024)
+        if not 0 < value <= max_size:
+            raise serializers.ValidationError(f'Uploads must be between 1 and {max_size} bytes')
+        return value
+
+    def validate_sha256(self, value):
+        return value.lower()
@@ -0,0 +1,155 @@
+"""
+Near-duplicate lookup of diagnosis images by perceptual hash.
+
+Each image gets a 64-bit difference hash (dHash), which survives re-encoding,
+resizing and small changes of framing or exposure. For Hamming-distance
+search the hash is also stored as four 16-bit bands in indexed columns
+(multi-index hashing): if two hashes differ in at most ``r`` bits, at least
+one band differs in at most ``r // 4`` bits. A lookup therefore only reads
+rows whose band matches one of the few values within that radius, and the
+exact distance is checked on those candidates.
+"""
+
+from itertools import combinations
+from django.conf import settings
+from django.db.models import Q
+from PIL import Image, ImageOps
+from .analysis import STRUCTURED_FIELDS
+from .models import DiagnosisRequest
+
+HASH_BITS = 64
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+BAND_FIELDS = [f'dhash_band{index}' for index in range(BANDS)]
+# DiagnosisRequest columns set from image_hash_fields()
+HASH_FIELDS = ['image_dhash'] + BAND_FIELDS
+
+
+def compute_dhash(image_file):
+    """64-bit dHash of an image file, or None if Pillow cannot decode it"""
+    image_file.seek(0)
+    try:
+        with Image.open(image_file) as image:
+            image.draft('L', (64, 64))
+            image = ImageOps.exif_transpose(image)
+            pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None
+    finally:
+        image_file.seek(0)
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def to_signed(value):
+    """Store an unsigned 64-bit hash in a signed BigIntegerField"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def split_bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (BAND_BITS * index)) & mask for index in range(BANDS)]
+
+
+def hamming(a, b):
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
+
+
+def image_hash_fields(value):
+    """DiagnosisRequest column values for the dHash ``value`` (None clears them)"""
+    if value is None:
+        return dict.fromkeys(HASH_FIELDS)
+    return {'image_dhash': to_signed(value), **dict(zip(BAND_FIELDS, split_bands(value)))}
+
+
+def _band_neighbours(band, radius):
+    """All band values within ``radius`` bits of ``band``"""
+    values = [band]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), distance):
+            flipped = band
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+def find_similar(queryset, value, max_distance=None, limit=5):
+    """
+    Diagnoses in ``queryset`` whose image is within ``max_distance`` bits of
+    the dHash ``value``, closest first, as (diagnosis, distance) pairs.
+    Narrow ``queryset`` to one user (and car) so the band indexes are used.
+    """
+    if value is None:
+        return []
+    if max_distance is None:
+        max_distance = settings.VISION_SIMILAR_MAX_DISTANCE
+    radius = max_distance // BANDS
+
+    condition = Q()
+    for field, band in zip(BAND_FIELDS, split_bands(value)):
+        condition |= Q(**{f'{field}__in': _band_neighbours(band, radius)})
+
+    matches = []
+    for diagnosis in queryset.filter(condition):
+        distance = hamming(diagnosis.image_dhash, value)
+        if distance <= max_distance:
+            matches.append((diagnosis, distance))
+    matches.sort(key=lambda match: (match[1], -match[0].id))
+    return matches[:limit]
+
+
+def nearest_diagnosis(user_id, value, car_id=None, exclude_id=None):
+    """
+    The user's closest finished diagnosis to the dHash ``value`` as
+    (diagnosis, distance), preferring one of the same car, or None.
+    """
+    queryset = DiagnosisRequest.objects.filter(user_id=user_id, status='done').select_related('car')
+    if exclude_id is not None:
+        queryset = queryset.exclude(id=exclude_id)
+    matches = find_similar(queryset, value)
+    same_car = [match for match in matches if match[0].car_id == car_id]
+    return (same_car or matches or [None])[0]
+
+
+def can_reuse(match, car_id):
+    """Whether the analysis of ``match`` may stand in for a new upload of ``car_id``"""
+    if match is None:
+        return False
+    diagnosis, distance = match
+    return (
+        diagnosis.car_id == car_id
+        and diagnosis.analysis is not None
+        and distance <= settings.VISION_SIMILAR_REUSE_MAX_DISTANCE
+    )
+
+
+def reused_fields(source):
+    """Field values that give a new diagnosis the finished analysis of ``source``"""
+    fields = {field: getattr(source, field) for field in STRUCTURED_FIELDS + ['ai_result']}
+    fields.update(status='done', error_message='', cache_status='similar', reused_from=source)
+    return fields
+
+
+def describe_match(match):
+    """``similar_diagnosis`` payload of create responses"""
+    if match is None:
+        return None
+    diagnosis, distance = match
+    return {
+        'id': diagnosis.id,
+        'car_id': diagnosis.car_id,
+        'distance': distance,
+        'severity': diagnosis.severity,
+        'created_at': diagnosis.created_at.isoformat(),
+    }
@@ -0,0 +1,109 @@
+"""
+Single-flight coalescing of identical diagnosis submissions.
+
+Bursts of identical uploads (double clicks, mobile retries) are keyed by
+user, car and the SHA-256 of the image:
+
+* On create, the first request registers its diagnosis as in flight; the
+  duplicates that arrive while it runs get that diagnosis back at once
+  instead of a new row, so they all poll the same result.
+* Around the analysis itself a short-lived lock marks an identical analysis
+  as running. Nobody waits on it: process_diagnosis re-queues itself and
+  then reads the leader's result from the analysis cache, other callers go
+  ahead with their own call.
+
+State lives in the default cache, so with Redis (REDIS_URL) it is shared by
+every gunicorn worker and Celery process; with LocMem it is per process.
+"""
+
+import hashlib
+import logging
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(image_file):
+    """SHA-256 hex digest of an uploaded or stored Django file"""
+    digest = hashlib.sha256()
+    for chunk in image_file.chunks():
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+def flight_key(user_id, car_id, image_sha256):
+    return f'diagnosis-flight:{user_id}:{car_id}:{image_sha256}'
+
+
+def diagnosis_flight_key(diagnosis):
+    """Single-flight key of a saved diagnosis, computing its image hash if missing"""
+    if not diagnosis.image_sha256:
+        diagnosis.image_sha256 = file_sha256(diagnosis.image)
+    return flight_key(diagnosis.user_id, diagnosis.car_id, diagnosis.image_sha256)
+
+
+def _lock_timeout():
+    return getattr(settings, 'VISION_SINGLEFLIGHT_LOCK_TTL', 120)
+
+
+def join_or_create(key, create):
+    """
+    Return (diagnosis_id, created). ``create()`` is only called by the
+    leader and must return the new diagnosis; followers get the leader's id.
+    """
+    diagnosis_id = cache.get(key)
+    if diagnosis_id is not None:
+        return diagnosis_id, False
+    # Short creation lock so two requests racing past the get() don't both register
+    if not cache.add(f'{key}:create', 1, timeout=30):
+        # The leader is inserting its row right now; rather than wait for its id, create our own
+        logger.info("Single-flight %s is being created elsewhere; not joining", key)
+        return create().id, True
+    try:
+        diagnosis_id = cache.get(key)
+        if diagnosis_id is not None:
+            return diagnosis_id, False
+        diagnosis = create()
+        cache.set(key, diagnosis.id, timeout=getattr(settings, 'VISION_SINGLEFLIGHT_TTL', 300))
+        return diagnosis.id, True
+    finally:
+        cache.delete(f'{key}:create')
+
+
+def finish_flight(key):
+    """The in-flight diagnosis finished; later uploads start a new one"""
+    cache.delete(key)
+
+
+@contextmanager
+def analysis_lock(key):
+    """
+    Take the analysis lock for ``key`` while the upstream call runs, without
+    waiting for it. Yields whether this caller holds it; False means an
+    identical analysis is running elsewhere.
+    """
+    lock_key = f'{key}:analysis'
+    token = uuid.uuid4().hex
+    held = cache.add(lock_key, token, timeout=_lock_timeout())
+    try:
+        yield held
+    finally:
+        if held and cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+
+@asynccontextmanager
+async def aanalysis_lock(key):
+    """analysis_lock() for async views"""
+    lock_key = f'{key}:analysis'
+    token = uuid.uuid4().hex
+    held = await cache.aadd(lock_key, token, timeout=_lock_timeout())
+    try:
+        yield held
+    finally:
+        if held and await cache.aget(lock_key) == token:
+            await cache.adelete(lock_key)
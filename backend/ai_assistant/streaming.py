@@ -0,0 +1,150 @@
+import json
+import logging
+import time
+import httpx
+from asgiref.sync import sync_to_async
+from .analysis import STRUCTURED_FIELDS, apply_analysis, render_analysis_markdown
+from .analysis_cache import get_cached_analysis, make_cache_key, set_cached_analysis
+from .exceptions import VisionRateLimited, VisionServiceError, VisionUpstreamError
+from .http_client import get_async_http_client
+from .image_processing import prepare_image
+from .models import ACCOUNTING_FIELDS
+from .providers import AnalysisRequest, ProviderResult
+from .resilience import CircuitBreaker, get_rate_limiter
+from .tasks import process_diagnosis, queue_diagnosis_variants
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event, data):
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_completion(provider, prepared, prompt, usage=None):
+    """
+    Yield text deltas from ``provider``'s chat completions stream.
+
+    The final usage block (sent when stream_options.include_usage is set) is
+    copied into ``usage`` if a dict is passed.
+    """
+    client = get_async_http_client()
+    breaker = CircuitBreaker(provider.name)
+    await breaker.abefore_call()
+    await get_rate_limiter(provider.name).aacquire(provider.estimate_tokens(prompt))
+    try:
+        async for delta in _stream_chunks(client, provider, prepared, prompt, usage):
+            yield delta
+    except httpx.HTTPError as e:
+        await breaker.arecord_failure()
+        raise VisionUpstreamError(f"{provider.name} request failed: {e}") from e
+    except VisionServiceError as e:
+        if e.retryable and not isinstance(e, VisionRateLimited):
+            await breaker.arecord_failure()
+        raise
+    await breaker.arecord_success()
+
+
+async def _stream_chunks(client, provider, prepared, prompt, usage):
+    async with client.stream(
+        "POST",
+        f"{provider.api_base}/chat/completions",
+        headers=provider.get_request_headers(),
+        json=provider.build_request_payload(prepared, prompt, stream=True),
+    ) as response:
+        if response.status_code != 200:
+            body = await response.aread()
+            raise provider.build_error(response.status_code, response.headers, body)
+
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            if chunk.get('usage') and usage is not None:
+                usage.update(chunk['usage'])
+            for choice in chunk.get('choices') or []:
+                delta = (choice.get('delta') or {}).get('content')
+                if delta:
+                    yield delta
+
+
+async def stream_diagnosis_events(service, diagnosis):
+    """
+    Run the analysis for ``diagnosis`` and yield it to the client as SSE.
+
+    ``chunk`` events relay the raw model output as it arrives (JSON when the
+    provider uses structured output). Once the upstream stream finishes the
+    analysis is parsed and saved, and the final event carries the rendered
+    report. Only the primary provider is streamed (a hedge would duplicate
+    the chunks). If the client disconnects before the result is saved, the
+    diagnosis is re-queued for process_diagnosis.
+    """
+    saved = False
+    try:
+        yield sse_event('diagnosis', {'id': diagnosis.id, 'status': diagnosis.status})
+
+        car_info = diagnosis.get_car_info()
+        provider = service.primary
+        try:
+            if not provider.supports_streaming:
+                request = AnalysisRequest(None, '', diagnosis.damage_description, car_info)
+                result = await provider.aanalyze(request)
+                analysis = service.build_analysis(provider, result)
+                diagnosis.provider = provider.name
+                yield sse_event('chunk', {'text': result.text})
+            else:
+                prepared = await sync_to_async(prepare_image, thread_sensitive=False)(diagnosis.image)
+                prompt = service.build_analysis_prompt(diagnosis.damage_description, car_info)
+                cache_key = make_cache_key(prepared.data, prompt, service.model)
+                analysis = await sync_to_async(get_cached_analysis, thread_sensitive=False)(cache_key)
+                diagnosis.original_image_bytes = prepared.original_bytes
+                diagnosis.cache_status = 'hit' if analysis is not None else 'miss'
+
+                if analysis is not None:
+                    yield sse_event('chunk', {'text': render_analysis_markdown(analysis, car_info)})
+                else:
+                    parts = []
+                    usage = {}
+                    diagnosis.sent_image_bytes = prepared.sent_bytes
+                    diagnosis.provider = provider.name
+                    started = time.monotonic()
+                    async for delta in stream_completion(provider, prepared, prompt, usage):
+                        parts.append(delta)
+                        yield sse_event('chunk', {'text': delta})
+                    diagnosis.upstream_latency_ms = int((time.monotonic() - started) * 1000)
+                    diagnosis.prompt_tokens = usage.get('prompt_tokens')
+                    diagnosis.completion_tokens = usage.get('completion_tokens')
+                    analysis = service.build_analysis(provider, ProviderResult(''.join(parts), usage))
+                    await sync_to_async(set_cached_analysis, thread_sensitive=False)(cache_key, analysis)
+
+            apply_analysis(diagnosis, analysis)
+            diagnosis.status = 'done'
+        except Exception as e:
+            logger.error("Streaming analysis failed for diagnosis %s: %s", diagnosis.id, e)
+            apply_analysis(diagnosis, {})
+            diagnosis.analysis = None
+            diagnosis.status = 'failed'
+            diagnosis.error_message = str(e)
+
+        diagnosis.ai_result = ''
+        await diagnosis.asave(update_fields=['ai_result', 'status', 'error_message'] + ACCOUNTING_FIELDS + STRUCTURED_FIELDS)
+        saved = True
+        await sync_to_async(queue_diagnosis_variants)([diagnosis])
+        yield sse_event(diagnosis.status, {
+            'id': diagnosis.id,
+            'status': diagnosis.status,
+            'ai_result': diagnosis.rendered_result,
+            'severity': diagnosis.severity,
+            'error_message': diagnosis.error_message,
+        })
+    finally:
+        if not saved:
+            # The client went away mid-stream (GeneratorExit / CancelledError):
+            # hand the analysis to a worker instead of leaving the row running
+            logger.warning("Client disconnected from the stream of diagnosis %s, re-queueing it", diagnosis.id)
+            diagnosis.status = 'queued'
+            await diagnosis.asave(update_fields=['status'])
+            await sync_to_async(process_diagnosis.delay)(diagnosis.id)
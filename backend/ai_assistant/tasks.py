@@ -0,0 +1,198 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from celery import shared_task
+from automate.image_variants import schedule_variants, update_variants
+from . import uploads
+from .analysis import STRUCTURED_FIELDS, apply_analysis
+from .exceptions import AnalysisInFlight, VisionCircuitOpen, VisionServiceError, VisionThrottled
+from .models import ACCOUNTING_FIELDS, DiagnosisRequest, ReanalysisRun
+from .openai_vision_service import get_vision_service
+from .resilience import backoff_delay
+from .retention import apply_retention
+from .search import rebuild_index
+from .singleflight import aanalysis_lock, analysis_lock, diagnosis_flight_key, finish_flight
+
+logger = logging.getLogger(__name__)
+
+# Fields set by run_diagnosis_analysis, for save(update_fields=...) / bulk_update
+ANALYSIS_FIELDS = ['ai_result', 'status', 'error_message', 'image_sha256'] + ACCOUNTING_FIELDS + STRUCTURED_FIELDS
+# Raised before anything was sent upstream. call_upstream() already retries
+# upstream failures with backoff, so only these re-queue process_diagnosis
+REQUEUED_ERRORS = (VisionThrottled, VisionCircuitOpen, AnalysisInFlight)
+# Seconds before a diagnosis waiting on an identical analysis looks at the cache again
+IN_FLIGHT_RETRY_DELAY = 5
+
+
+def run_diagnosis_analysis(diagnosis, vision_service=None, defer_duplicate=False):
+    """
+    Run the vision analysis for a diagnosis and set the result fields.
+    The instance is not saved so callers can persist one row or bulk update many.
+
+    Returns the exception if the analysis failed, otherwise None. Failures
+    leave the analysis empty and record the reason in error_message. With
+    ``defer_duplicate``, an identical analysis running elsewhere returns
+    AnalysisInFlight and leaves the fields untouched, so the caller can retry
+    once the leader's result is cached.
+    """
+    vision_service = vision_service or get_vision_service()
+    stats = {}
+    try:
+        with analysis_lock(diagnosis_flight_key(diagnosis)) as held:
+            if not held and defer_duplicate:
+                return AnalysisInFlight("Identical analysis in flight", retry_after=IN_FLIGHT_RETRY_DELAY)
+            analysis = vision_service.analyze_image(
+                diagnosis.image,
+                diagnosis.damage_description,
+                car_info=diagnosis.get_car_info(),
+                stats=stats
+            )
+    except Exception as e:
+        return set_analysis_result(diagnosis, None, stats, e)
+    return set_analysis_result(diagnosis, analysis, stats)
+
+
+def analyze_diagnoses(diagnoses, vision_service, concurrency):
+    """
+    run_diagnosis_analysis() for many rows on up to ``concurrency`` threads;
+    the error (or None) per row. Rows repeating an earlier row's image are
+    analysed after it, so they read its result from the analysis cache.
+    """
+    leaders, repeats, seen = [], [], set()
+    for index, diagnosis in enumerate(diagnoses):
+        key = diagnosis_flight_key(diagnosis)
+        (repeats if key in seen else leaders).append(index)
+        seen.add(key)
+
+    errors = [None] * len(diagnoses)
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(leaders)))) as executor:
+        for indexes in (leaders, repeats):
+            results = executor.map(lambda index: run_diagnosis_analysis(diagnoses[index], vision_service), indexes)
+            for index, error in zip(indexes, results):
+                errors[index] = error
+    return errors
+
+
+async def arun_diagnosis_analysis(diagnosis, vision_service=None):
+    """run_diagnosis_analysis() for async views (``diagnosis.car`` must be loaded)"""
+    vision_service = vision_service or get_vision_service()
+    stats = {}
+    try:
+        async with aanalysis_lock(diagnosis_flight_key(diagnosis)):
+            analysis = await vision_service.aanalyze_image(
+                diagnosis.image,
+                diagnosis.damage_description,
+                car_info=diagnosis.get_car_info(),
+                stats=stats
+            )
+    except Exception as e:
+        return set_analysis_result(diagnosis, None, stats, e)
+    return set_analysis_result(diagnosis, analysis, stats)
+
+
+def set_analysis_result(diagnosis, analysis, stats, error=None):
+    if error is not None:
+        logger.error("AI analysis failed for diagnosis %s: %s", diagnosis.id, error)
+        diagnosis.status = 'failed'
+        diagnosis.error_message = str(error)
+    else:
+        diagnosis.status = 'done'
+        diagnosis.error_message = ''
+
+    # The markdown report is rendered from the structured analysis on read
+    diagnosis.ai_result = ''
+    apply_analysis(diagnosis, analysis or {})
+    diagnosis.analysis = analysis or None
+
+    for field in ACCOUNTING_FIELDS:
+        setattr(diagnosis, field, stats.get(field, '' if field in ('cache_status', 'provider') else None))
+    return error
+
+
+@shared_task(bind=True, max_retries=5)
+def process_diagnosis(self, diagnosis_id):
+    """
+    Run the AI analysis for a queued diagnosis request.
+    This task is enqueued by the diagnosis create view once the upload is saved.
+    Upstream errors are retried inside the vision call; the task is only
+    re-queued with backoff while our own rate limiter or circuit breaker
+    holds the call back.
+    """
+    try:
+        diagnosis = DiagnosisRequest.objects.select_related('car').get(id=diagnosis_id)
+    except DiagnosisRequest.DoesNotExist:
+        return {'status': 'failed', 'reason': 'Diagnosis not found'}
+
+    diagnosis.status = 'running'
+    diagnosis.save(update_fields=['status'])
+
+    retries_left = self.request.retries < self.max_retries
+    error = run_diagnosis_analysis(diagnosis, defer_duplicate=retries_left)
+    if isinstance(error, REQUEUED_ERRORS) and retries_left:
+        diagnosis.status = 'queued'
+        diagnosis.save(update_fields=['status'])
+        raise self.retry(exc=error, countdown=backoff_delay(self.request.retries + 1, error.retry_after))
+
+    diagnosis.save(update_fields=ANALYSIS_FIELDS)
+    finish_flight(diagnosis_flight_key(diagnosis))
+    # Preview sizes for list pages, rendered while this worker has the upload at hand
+    generate_diagnosis_variants(diagnosis_id)
+    return {'status': diagnosis.status, 'diagnosis_id': diagnosis_id}
+
+
+@shared_task
+def generate_diagnosis_variants(diagnosis_id):
+    """Render the resized WebP variants of a diagnosis image"""
+    return update_variants(DiagnosisRequest, diagnosis_id, 'image')
+
+
+def queue_diagnosis_variants(diagnoses):
+    """Queue the variants of diagnoses analysed outside process_diagnosis (reused, batch, async, streamed)"""
+    for diagnosis in diagnoses:
+        schedule_variants(diagnosis, 'image', generate_diagnosis_variants)
+
+
+@shared_task(bind=True, max_retries=5)
+def reanalyze_diagnoses(self, run_id):
+    """
+    Process the next chunk of a ReanalysisRun, then re-enqueue itself until
+    the run is finished. Retryable upstream errors retry the chunk with backoff.
+    """
+    # reanalysis builds on the helpers above
+    from .reanalysis import fail_run, run_step
+
+    run = ReanalysisRun.objects.filter(id=run_id).first()
+    if run is None:
+        return {'status': 'failed', 'reason': 'Re-analysis run not found'}
+
+    try:
+        delay = run_step(run, final_attempt=self.request.retries >= self.max_retries)
+    except VisionServiceError as error:
+        if error.retryable and self.request.retries < self.max_retries:
+            raise self.retry(exc=error, countdown=backoff_delay(self.request.retries + 1, error.retry_after))
+        fail_run(run, error)
+        delay = None
+
+    if delay is not None:
+        reanalyze_diagnoses.apply_async((run_id,), countdown=delay)
+    return {'status': run.status, 'processed': run.processed, 'total': run.total}
+
+
+@shared_task
+def purge_expired_diagnoses():
+    """
+    Daily retention purge (see ai_assistant/retention.py). Does nothing unless
+    DIAGNOSIS_RETENTION_DAYS or DIAGNOSIS_RETENTION_MAX_PER_USER is set.
+    """
+    return apply_retention()
+
+
+@shared_task
+def purge_stale_uploads():
+    """Remove resumable uploads that were never finalized (see ai_assistant/uploads.py)"""
+    return uploads.purge_stale_uploads()
+
+
+@shared_task
+def rebuild_search_index():
+    """Compact the diagnosis search index, dropping records superseded by later saves"""
+    return rebuild_index()
@@ -0,0 +1,1130 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.utils import timezone
+from django.test import AsyncClient, TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APIClient
+from rest_framework import status
+from benchmarks.fake_upstream import FakeVisionUpstream
+from automate.image_variants import generate_variants, update_variants
+from automate.media import media_token, signed_media_url
+from automate.rate_limit import LocalTokenBucket, RedisTokenBucket
+from automate.storage import ContentAddressedStorage
+from cars.models import Car
+from .analysis_cache import get_analysis_cache, get_cache_stats
+from .exceptions import AnalysisInFlight, VisionAuthError, VisionCircuitOpen, VisionThrottled, VisionUpstreamError
+from .hedging import get_latency_tracker, reset_latency_trackers
+from .http_client import reset_http_session
+from .image_processing import prepare_image
+from .models import DiagnosisRequest, ReanalysisRun
+from .openai_vision_service import get_vision_service, reset_vision_service
+from .streaming import stream_diagnosis_events
+from .reanalysis import run_step, start_run
+from .singleflight import diagnosis_flight_key, file_sha256, flight_key
+from .reports import daily_usage_report
+from .retention import apply_retention, purge
+from .search import get_search_index, index_diagnoses, rebuild_index, vectorize
+from .similarity import find_similar, hamming, image_hash_fields
+from .resilience import get_rate_limiter, reset_rate_limiters
+from .tasks import process_diagnosis
+
+MEDIA_ROOT = tempfile.mkdtemp()
+# Diagnoses saved by any test are indexed for search; keep the index out of the tree
+search_index_override = override_settings(DIAGNOSIS_SEARCH_DIR=tempfile.mkdtemp())
+
+
+def setUpModule():
+    search_index_override.enable()
+
+
+def tearDownModule():
+    search_index_override.disable()
+    shutil.rmtree(search_index_override.options['DIAGNOSIS_SEARCH_DIR'], ignore_errors=True)
+
+
+def make_image(name='car.png', size=(64, 48), color=(200, 30, 30), fmt='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=fmt)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=f'image/{fmt.lower()}')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='')
+class TestDiagnosisAPI(APITestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        reset_vision_service()
+        self.user = User.objects.create_user(username='tester', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Toyota', model='Corolla', year=2020, vin='VIN123', owner='Tester One')
+
+    def test_create_queues_analysis(self):
+        url = reverse('diagnosis-list-create')
+        with mock.patch('ai_assistant.views.process_diagnosis.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(url, {'car_id': self.car.id, 'image': make_image()}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'queued')
+        delay.assert_called_once_with(response.data['id'])
+
+    def test_task_runs_analysis_and_status_endpoint(self):
+        diagnosis = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image())
+        result = process_diagnosis(diagnosis.id)
+        self.assertEqual(result['status'], 'done')
+
+        response = self.client.get(reverse('diagnosis-status', args=[diagnosis.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'done')
+        self.assertIn('2020 Toyota Corolla', response.data['ai_result'])
+
+
+class TestVisionHTTPPool(APITestCase):
+    def setUp(self):
+        reset_http_session()
+        reset_vision_service()
+        get_analysis_cache().clear()
+
+    def test_analyses_reuse_one_upstream_connection(self):
+        with FakeVisionUpstream(content='Dent on the rear bumper') as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url):
+                service = get_vision_service()
+                stats = {}
+                first = service.get_image_analysis(make_image(), stats=stats)
+                second = service.get_image_analysis(make_image(color=(0, 0, 255)))
+        self.assertIn('Dent on the rear bumper', first)
+        self.assertIn('Dent on the rear bumper', second)
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertEqual(upstream.connections, 1)
+        self.assertGreater(stats['sent_image_bytes'], 0)
+        self.assertIs(get_vision_service(), service)
+
+
+class TestImagePreprocessing(APITestCase):
+    def test_downscales_and_applies_exif_orientation(self):
+        buffer = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 CW
+        Image.effect_noise((2000, 1000), 64).convert('RGB').save(buffer, format='JPEG', quality=95, exif=exif)
+        upload = SimpleUploadedFile('photo.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+        prepared = prepare_image(upload, max_edge=512, image_format='WEBP', quality=70)
+
+        with Image.open(io.BytesIO(prepared.data)) as image:
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(image.size, (256, 512))
+        self.assertEqual(prepared.media_type, 'image/webp')
+        self.assertEqual(prepared.original_bytes, upload.size)
+        self.assertEqual(prepared.sent_bytes, len(prepared.data))
+        self.assertLess(prepared.sent_bytes, prepared.original_bytes)
+
+
+class TestAnalysisCache(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        get_analysis_cache().clear()
+
+    def test_repeat_upload_is_served_from_cache(self):
+        car_info = {'year': 2020, 'make': 'Toyota', 'model': 'Corolla', 'vin': 'VIN123'}
+        with FakeVisionUpstream(content='Scratch on door') as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url):
+                service = get_vision_service()
+                first_stats, second_stats = {}, {}
+                first = service.get_image_analysis(make_image(), 'scratch', car_info, stats=first_stats)
+                second = service.get_image_analysis(make_image(), 'scratch', car_info, stats=second_stats)
+                # Different car context builds a different prompt
+                service.get_image_analysis(make_image(), 'scratch', {**car_info, 'year': 2018})
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertEqual(first_stats['cache_status'], 'miss')
+        self.assertEqual(second_stats['cache_status'], 'hit')
+        self.assertNotIn('sent_image_bytes', second_stats)
+        self.assertEqual(get_cache_stats()['hits'], 1)
+        self.assertEqual(get_cache_stats()['misses'], 2)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class TestDiagnosisStreaming(TestCase):
+    def setUp(self):
+        reset_vision_service()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='streamer', password='pass12345')
+        self.token = Token.objects.create(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Honda', model='Civic', year=2019, vin='VIN456', owner='Tester')
+
+    async def test_stream_relays_chunks_and_saves_result(self):
+        with FakeVisionUpstream(content='Minor dent on the hood') as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url):
+                response = await self.async_client.post(
+                    reverse('diagnosis-stream'),
+                    {'car_id': self.car.id, 'image': make_image()},
+                    headers={'Authorization': f'Token {self.token.key}'},
+                )
+                self.assertEqual(response['Content-Type'], 'text/event-stream')
+                body = ''.join([chunk.decode() async for chunk in response.streaming_content])
+
+        self.assertTrue(upstream.requests[0]['stream'])
+        self.assertEqual(body.count('event: chunk'), 5)
+        self.assertIn('event: done', body)
+        diagnosis = await DiagnosisRequest.objects.select_related('car').aget(user=self.user)
+        self.assertEqual(diagnosis.status, 'done')
+        self.assertIn('Minor dent on the hood', diagnosis.rendered_result)
+
+    async def test_stream_requires_authentication(self):
+        response = await self.async_client.post(reverse('diagnosis-stream'), {'car_id': self.car.id})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_stream_rejects_another_users_car(self):
+        other = await User.objects.acreate(username='not-the-owner')
+        car = await Car.objects.acreate(user=other, make='Opel', model='Astra', year=2012, owner='Other')
+        response = await self.async_client.post(
+            reverse('diagnosis-stream'),
+            {'car_id': car.id, 'image': make_image()},
+            headers={'Authorization': f'Token {self.token.key}'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'car_id': ['Car not found']})
+        self.assertFalse(await DiagnosisRequest.objects.filter(car=car).aexists())
+
+    async def test_disconnect_mid_stream_requeues_the_diagnosis(self):
+        diagnosis = await DiagnosisRequest.objects.acreate(
+            user=self.user, car=self.car, image=make_image(), status='running'
+        )
+        diagnosis = await DiagnosisRequest.objects.select_related('car').aget(id=diagnosis.id)
+        with FakeVisionUpstream(content='Minor dent on the hood') as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url), \
+                    mock.patch('ai_assistant.streaming.process_diagnosis.delay') as delay:
+                events = stream_diagnosis_events(get_vision_service(), diagnosis)
+                await events.__anext__()
+                self.assertIn('event: chunk', await events.__anext__())
+                await events.aclose()
+
+        delay.assert_called_once_with(diagnosis.id)
+        self.assertEqual((await DiagnosisRequest.objects.aget(id=diagnosis.id)).status, 'queued')
+
+    async def test_session_auth_requires_csrf_token(self):
+        client = AsyncClient(enforce_csrf_checks=True)
+        await client.aforce_login(self.user)
+        for name in ('diagnosis-stream', 'diagnosis-create-async'):
+            response = await client.post(reverse(name), {'car_id': self.car.id, 'image': make_image()})
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            self.assertIn('CSRF', response.json()['detail'])
+        self.assertFalse(await DiagnosisRequest.objects.filter(user=self.user).aexists())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class TestDiagnosisBatch(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='fleet', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Ford', model='Transit', year=2021, vin='VIN789', owner='Fleet')
+
+    def test_batch_fans_out_concurrently(self):
+        images = [make_image(f'side{index}.png', color=(index * 50, 10, 10)) for index in range(4)]
+        with FakeVisionUpstream(content='Panel scratch', delay=0.3) as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url, VISION_BATCH_CONCURRENCY=4):
+                start = time.perf_counter()
+                response = self.client.post(reverse('diagnosis-batch'), {'car_id': self.car.id, 'images': images}, format='multipart')
+                elapsed = time.perf_counter() - start
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(len(upstream.requests), 4)
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(DiagnosisRequest.objects.filter(user=self.user, status='done').count(), 4)
+        self.assertTrue(all('Panel scratch' in result['ai_result'] for result in response.data['results']))
+
+    def test_batch_rejects_other_users_car(self):
+        other = User.objects.create_user(username='other', password='pass12345')
+        car = Car.objects.create(user=other, make='Ford', model='Focus', year=2015, owner='Other')
+        response = self.client.post(reverse('diagnosis-batch'), {'car_id': car.id, 'images': [make_image()]}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(OPENAI_API_KEY='sk-test', VISION_RETRY_BASE_DELAY=0.01, VISION_MAX_RETRIES=2)
+class TestUpstreamResilience(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        reset_rate_limiters()
+        cache.clear()
+        get_analysis_cache().clear()
+
+    def test_retries_429_honouring_retry_after(self):
+        with FakeVisionUpstream(content='Rust spot', responses=[(429, {'Retry-After': '0.2'})]) as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                start = time.perf_counter()
+                result = get_vision_service().get_image_analysis(make_image())
+                elapsed = time.perf_counter() - start
+        self.assertIn('Rust spot', result)
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertGreaterEqual(elapsed, 0.2)
+
+    def test_circuit_opens_and_fails_fast(self):
+        with FakeVisionUpstream(status=503) as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url, VISION_CIRCUIT_FAILURE_THRESHOLD=3):
+                with self.assertRaises(VisionUpstreamError):
+                    get_vision_service().get_image_analysis(make_image())
+                with self.assertRaises(VisionCircuitOpen):
+                    get_vision_service().get_image_analysis(make_image(color=(1, 2, 3)))
+        # 1 call + 2 retries, then the open circuit stops further requests
+        self.assertEqual(len(upstream.requests), 3)
+
+    def test_token_bucket_limits_requests_per_minute(self):
+        bucket = LocalTokenBucket(capacity=2, per_minute=2)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.take(), 30, delta=1)
+
+    @override_settings(MEDIA_ROOT=MEDIA_ROOT)
+    def test_failed_analysis_is_not_stored_as_result(self):
+        user = User.objects.create_user(username='quota', password='pass12345')
+        car = Car.objects.create(user=user, make='Kia', model='Rio', year=2017, owner='Quota')
+        diagnosis = DiagnosisRequest.objects.create(user=user, car=car, image=make_image())
+        with FakeVisionUpstream(status=401) as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                process_diagnosis(diagnosis.id)
+        diagnosis.refresh_from_db()
+        self.assertEqual(diagnosis.status, 'failed')
+        self.assertEqual(diagnosis.ai_result, '')
+        self.assertIn('401', diagnosis.error_message)
+
+    @override_settings(MEDIA_ROOT=MEDIA_ROOT, VISION_RATE_LIMIT_MAX_WAIT=0)
+    def test_only_local_throttling_requeues_the_task(self):
+        user = User.objects.create_user(username='requeue', password='pass12345')
+        car = Car.objects.create(user=user, make='Kia', model='Rio', year=2017, owner='Requeue')
+        diagnosis = DiagnosisRequest.objects.create(user=user, car=car, image=make_image())
+        with FakeVisionUpstream(status=503) as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                # Upstream failures were already retried by the vision call
+                process_diagnosis(diagnosis.id)
+                self.assertEqual(len(upstream.requests), 3)
+                diagnosis.refresh_from_db()
+                self.assertEqual(diagnosis.status, 'failed')
+
+                # Our own bucket is empty: nothing is sent and the task is re-queued
+                while not get_rate_limiter().request_bucket.take():
+                    pass
+                with self.assertRaises(VisionThrottled):
+                    process_diagnosis(diagnosis.id)
+                self.assertEqual(len(upstream.requests), 3)
+        diagnosis.refresh_from_db()
+        self.assertEqual(diagnosis.status, 'queued')
+
+    def test_redis_bucket_is_taken_off_the_event_loop(self):
+        bucket = RedisTokenBucket(mock.Mock(), 'bucket', capacity=1, per_minute=60)
+        callers = []
+        bucket.script = lambda **kwargs: callers.append(threading.get_ident()) or '0'
+        self.assertEqual(asyncio.run(bucket.atake()), 0)
+        self.assertNotEqual(callers, [threading.get_ident()])
+
+
+@override_settings(
+    OPENAI_API_KEY='sk-test', VISION_PROVIDERS=['openai', 'local'], VISION_HEDGE_ENABLED=True,
+    VISION_HEDGE_MIN_SAMPLES=5, VISION_HEDGE_MIN_DELAY=0.05, VISION_MAX_RETRIES=0,
+)
+class TestHedgedProviders(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        reset_rate_limiters()
+        reset_latency_trackers()
+        cache.clear()
+        get_analysis_cache().clear()
+
+    def analyze(self, primary, backup, **settings):
+        with override_settings(OPENAI_API_BASE=primary.url, VISION_LOCAL_API_BASE=backup.url, **settings):
+            stats = {}
+            start = time.perf_counter()
+            result = get_vision_service().get_image_analysis(make_image(), stats=stats)
+            return result, stats, time.perf_counter() - start
+
+    def test_slow_primary_is_hedged_after_p95(self):
+        for sample in (0.1, 0.1, 0.1, 0.1, 0.2):
+            get_latency_tracker('openai').record(sample)
+        with FakeVisionUpstream(content='Slow answer', delay=1.5) as primary, \
+                FakeVisionUpstream(content='Fast answer', delay=0.05) as backup:
+            result, stats, elapsed = self.analyze(primary, backup)
+        self.assertIn('Fast answer', result)
+        self.assertEqual(stats['provider'], 'local')
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(len(backup.requests), 1)
+
+    def test_fast_primary_does_not_fire_backup(self):
+        with FakeVisionUpstream(content='Primary answer') as primary, \
+                FakeVisionUpstream(content='Backup answer') as backup:
+            result, stats, _ = self.analyze(primary, backup, VISION_HEDGE_DEFAULT_DELAY=1)
+        self.assertIn('Primary answer', result)
+        self.assertEqual(stats['provider'], 'openai')
+        self.assertEqual(len(backup.requests), 0)
+
+    def test_failed_primary_falls_back_immediately(self):
+        with FakeVisionUpstream(status=503) as primary, \
+                FakeVisionUpstream(content='Backup answer') as backup:
+            result, stats, elapsed = self.analyze(primary, backup, VISION_HEDGE_DEFAULT_DELAY=5)
+        self.assertIn('Backup answer', result)
+        self.assertEqual(stats['provider'], 'local')
+        self.assertLess(elapsed, 2)
+
+        # The backup's answer is not cached as the primary model's
+        reset_vision_service()
+        with FakeVisionUpstream(content='Primary answer') as primary, \
+                FakeVisionUpstream(content='Backup answer') as backup:
+            result, stats, _ = self.analyze(primary, backup, VISION_HEDGE_DEFAULT_DELAY=5)
+        self.assertIn('Primary answer', result)
+        self.assertEqual(stats['cache_status'], 'miss')
+
+    def test_primary_error_is_raised_when_every_provider_fails(self):
+        # The backup fails first, but the primary's error is the one reported
+        with FakeVisionUpstream(status=401, delay=0.3) as primary, FakeVisionUpstream(status=503) as backup:
+            with self.assertRaises(VisionAuthError):
+                self.analyze(primary, backup, VISION_HEDGE_DEFAULT_DELAY=0.05)
+        self.assertEqual(len(backup.requests), 1)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='sk-test')
+class TestStructuredAnalysis(APITestCase):
+    ANALYSIS = {
+        'vehicle_detected': True,
+        'summary': 'Cracked windscreen',
+        'condition': 'Fair',
+        'severity': 'High',
+        'estimated_cost': {'min': 250, 'max': 600.5, 'currency': 'usd'},
+        'affected_areas': ['windscreen'],
+        'damage_findings': ['Crack across the driver side'],
+        'safety_concerns': ['Obstructed view'],
+        'safe_to_drive': False,
+        'recommendations': ['Replace the windscreen'],
+    }
+
+    def setUp(self):
+        reset_vision_service()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='structured', password='pass12345')
+        self.client.force_authenticate(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Ford', model='Focus', year=2016, owner='Structured')
+
+    def test_structured_fields_are_stored_and_filterable(self):
+        diagnosis = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image())
+        legacy = DiagnosisRequest.objects.create(
+            user=self.user, car=self.car, image=make_image(), status='done', ai_result='Old markdown report'
+        )
+        with FakeVisionUpstream(content=json.dumps(self.ANALYSIS)) as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                process_diagnosis(diagnosis.id)
+        self.assertEqual(upstream.requests[0]['response_format']['type'], 'json_schema')
+
+        diagnosis.refresh_from_db()
+        self.assertEqual(diagnosis.severity, 'high')
+        self.assertEqual(diagnosis.estimated_cost_min, Decimal('250.00'))
+        self.assertEqual(diagnosis.estimated_cost_max, Decimal('600.50'))
+        self.assertEqual(diagnosis.affected_areas, ['windscreen'])
+        self.assertTrue(diagnosis.has_safety_concerns)
+        self.assertIs(diagnosis.safe_to_drive, False)
+        self.assertEqual(diagnosis.ai_result, '')
+
+        url = reverse('car-diagnosis-list', args=[self.car.id])
+        response = self.client.get(url, {'severity': 'high'})
+        results = response.data['results'] if isinstance(response.data, dict) else response.data
+        self.assertEqual([result['id'] for result in results], [diagnosis.id])
+        self.assertIn('Cracked windscreen', results[0]['ai_result'])
+        self.assertIn('**Severity Level**: High', results[0]['ai_result'])
+
+        response = self.client.get(reverse('diagnosis-status', args=[legacy.id]))
+        self.assertEqual(response.data['ai_result'], 'Old markdown report')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='sk-test')
+class TestUsageAccounting(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='usage', password='pass12345')
+        self.car = Car.objects.create(user=self.user, make='Mazda', model='3', year=2021, owner='Usage')
+
+    def test_records_usage_and_reports_per_day(self):
+        usage = {'prompt_tokens': 900, 'completion_tokens': 120, 'total_tokens': 1020}
+        first = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image())
+        second = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image())
+        with FakeVisionUpstream(content='Bumper scuff', delay=0.05, usage=usage) as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                process_diagnosis(first.id)
+                process_diagnosis(second.id)
+
+        first.refresh_from_db()
+        self.assertEqual(first.provider, 'openai')
+        self.assertEqual(first.cache_status, 'miss')
+        self.assertEqual(first.prompt_tokens, 900)
+        self.assertEqual(first.completion_tokens, 120)
+        self.assertGreaterEqual(first.upstream_latency_ms, 50)
+        second.refresh_from_db()
+        self.assertEqual(second.cache_status, 'hit')
+        self.assertIsNone(second.upstream_latency_ms)
+
+        out = io.StringIO()
+        call_command('vision_usage_report', days=1, stdout=out)
+        self.assertIn('p95 ms', out.getvalue())
+        [row] = daily_usage_report(days=1)
+        self.assertEqual((row['diagnoses'], row['cache_hits'], row['upstream_calls']), (2, 1, 1))
+        self.assertEqual(row['prompt_tokens'], 900)
+        self.assertEqual(row['latency_p95_ms'], first.upstream_latency_ms)
+
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'pass12345')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:ai_assistant_diagnosisrequest_usage'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'p50 ms')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='sk-test')
+class TestAsyncDiagnosis(TestCase):
+    def setUp(self):
+        reset_vision_service()
+        reset_rate_limiters()
+        cache.clear()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='async', password='pass12345')
+        self.token = Token.objects.create(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Subaru', model='Outback', year=2018, owner='Async')
+
+    async def test_async_create_analyses_inline(self):
+        with FakeVisionUpstream(content='Hail damage on roof') as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                response = await self.async_client.post(
+                    reverse('diagnosis-create-async'),
+                    {'car_id': self.car.id, 'image': make_image()},
+                    headers={'Authorization': f'Token {self.token.key}'},
+                )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.json()
+        self.assertEqual(data['status'], 'done')
+        self.assertIn('Hail damage on roof', data['ai_result'])
+        diagnosis = await DiagnosisRequest.objects.aget(id=data['id'])
+        self.assertEqual(diagnosis.provider, 'openai')
+
+    async def test_async_duplicate_gets_the_in_flight_diagnosis(self):
+        image = make_image()
+        image_sha256 = file_sha256(image)
+        leader = await DiagnosisRequest.objects.acreate(
+            user=self.user, car=self.car, image=make_image(), image_sha256=image_sha256, status='running'
+        )
+        await cache.aset(flight_key(self.user.id, self.car.id, image_sha256), leader.id)
+        with FakeVisionUpstream(content='Hail damage on roof') as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                response = await self.async_client.post(
+                    reverse('diagnosis-create-async'),
+                    {'car_id': self.car.id, 'image': image},
+                    headers={'Authorization': f'Token {self.token.key}'},
+                )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.json()['id'], leader.id)
+        self.assertEqual(response['X-Diagnosis-Coalesced'], 'true')
+        self.assertEqual(upstream.requests, [])
+
+    async def test_async_create_rejects_other_users_car(self):
+        other = await User.objects.acreate(username='other')
+        car = await Car.objects.acreate(user=other, make='VW', model='Golf', year=2015, owner='Other')
+        response = await self.async_client.post(
+            reverse('diagnosis-create-async'),
+            {'car_id': car.id, 'image': make_image()},
+            headers={'Authorization': f'Token {self.token.key}'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(VISION_RATE_LIMIT_TPM=10 ** 6)
+    async def test_one_event_loop_overlaps_upstream_calls(self):
+        with FakeVisionUpstream(content='Scratch', delay=0.3) as upstream:
+            with override_settings(OPENAI_API_BASE=upstream.url):
+                service = get_vision_service()
+                start = time.perf_counter()
+                results = await asyncio.gather(*[
+                    service.aanalyze_image(make_image(color=(index, 0, 0))) for index in range(20)
+                ])
+                elapsed = time.perf_counter() - start
+        self.assertEqual(len(results), 20)
+        self.assertEqual(len(upstream.requests), 20)
+        # Sequential calls would take 20 * 0.3s
+        self.assertLess(elapsed, 2)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class TestSingleFlight(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        cache.clear()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='flight', password='pass12345')
+        self.client.force_authenticate(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Audi', model='A4', year=2019, owner='Flight')
+
+    @override_settings(OPENAI_API_KEY='')
+    def test_duplicate_upload_joins_in_flight_diagnosis(self):
+        url = reverse('diagnosis-list-create')
+        with mock.patch('ai_assistant.views.process_diagnosis.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                first = self.client.post(url, {'car_id': self.car.id, 'image': make_image()}, format='multipart')
+            with self.captureOnCommitCallbacks(execute=True):
+                second = self.client.post(url, {'car_id': self.car.id, 'image': make_image()}, format='multipart')
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(second['X-Diagnosis-Coalesced'], 'true')
+        self.assertEqual(DiagnosisRequest.objects.count(), 1)
+        delay.assert_called_once_with(first.data['id'])
+
+        # Once the analysis finishes, a new upload starts a new diagnosis
+        process_diagnosis(first.data['id'])
+        with mock.patch('ai_assistant.views.process_diagnosis.delay'):
+            third = self.client.post(url, {'car_id': self.car.id, 'image': make_image()}, format='multipart')
+        self.assertNotEqual(third.data['id'], first.data['id'])
+
+    def test_task_requeues_while_an_identical_analysis_runs(self):
+        diagnosis = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image())
+        lock_key = f'{diagnosis_flight_key(diagnosis)}:analysis'
+        cache.set(lock_key, 'leader')
+        self.addCleanup(cache.delete, lock_key)
+        with FakeVisionUpstream(content='Door ding') as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url):
+                with self.assertRaises(AnalysisInFlight):
+                    process_diagnosis(diagnosis.id)
+        diagnosis.refresh_from_db()
+        self.assertEqual(diagnosis.status, 'queued')
+        self.assertEqual(upstream.requests, [])
+
+    def test_identical_analyses_share_one_upstream_call(self):
+        with FakeVisionUpstream(content='Door ding', delay=0.3) as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url):
+                response = self.client.post(reverse('diagnosis-batch'), {
+                    'car_id': self.car.id,
+                    'images': [make_image('a.png'), make_image('b.png')],
+                }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertTrue(all('Door ding' in result['ai_result'] for result in response.data['results']))
+
+
+def make_scene(name='scene.jpg', crop=0, seed=1, fmt='JPEG'):
+    """A photo-like test image; ``crop`` trims the border to mimic reframing"""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (320, 240), (90, 90, 90))
+    for _ in range(12):
+        x, y = rng.randrange(280), rng.randrange(200)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        image.paste(colour, (x, y, x + rng.randrange(20, 120), y + rng.randrange(20, 100)))
+    if crop:
+        image = image.crop((crop, crop, 320 - crop, 240 - crop)).resize((640, 480))
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=80)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=f'image/{fmt.lower()}')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='')
+class TestSimilarDiagnoses(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        cache.clear()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='similar', password='pass12345')
+        self.client.force_authenticate(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Kia', model='Rio', year=2017, owner='Similar')
+
+    def test_near_duplicate_photo_reuses_prior_analysis(self):
+        url = reverse('diagnosis-list-create')
+        with mock.patch('ai_assistant.views.process_diagnosis.delay'):
+            first = self.client.post(url, {'car_id': self.car.id, 'image': make_scene(fmt='PNG')}, format='multipart')
+        process_diagnosis(first.data['id'])
+
+        with mock.patch('ai_assistant.views.process_diagnosis.delay') as delay, \
+                mock.patch('ai_assistant.tasks.generate_diagnosis_variants.delay') as variants_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                reframed = self.client.post(url, {
+                    'car_id': self.car.id, 'image': make_scene(crop=2), 'reuse_similar': 'true',
+                }, format='multipart')
+                other = self.client.post(url, {'car_id': self.car.id, 'image': make_scene(seed=7)}, format='multipart')
+
+        self.assertEqual(reframed.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(reframed.data['status'], 'done')
+        self.assertEqual(reframed.data['reused_from'], first.data['id'])
+        self.assertEqual(reframed.data['similar_diagnosis']['id'], first.data['id'])
+        self.assertIn('2017 Kia Rio', reframed.data['ai_result'])
+        self.assertEqual(other.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIsNone(other.data['similar_diagnosis'])
+        delay.assert_called_once_with(other.data['id'])
+        # No Celery analysis for the reused row, so its previews are queued when it is saved
+        variants_delay.assert_called_once_with(reframed.data['id'])
+
+        response = self.client.get(reverse('diagnosis-similar', args=[first.data['id']]), {'scope': 'car'})
+        self.assertEqual([match['id'] for match in response.data], [reframed.data['id']])
+
+    def test_band_lookup_matches_brute_force(self):
+        rng = random.Random(3)
+        target = rng.getrandbits(64)
+        values = [target ^ sum(1 << bit for bit in rng.sample(range(64), rng.randrange(12))) for _ in range(200)]
+        values += [rng.getrandbits(64) for _ in range(200)]
+        DiagnosisRequest.objects.bulk_create([
+            DiagnosisRequest(user=self.user, car=self.car, image='x.jpg', **image_hash_fields(value))
+            for value in values
+        ])
+
+        queryset = DiagnosisRequest.objects.filter(user=self.user)
+        found = find_similar(queryset, target, max_distance=8, limit=None)
+        expected = sorted(hamming(value, target) for value in values if hamming(value, target) <= 8)
+        self.assertEqual([distance for _, distance in found], expected)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, VISION_RATE_LIMIT_TPM=10 ** 6)
+class TestReanalysis(APITestCase):
+    def setUp(self):
+        reset_vision_service()
+        reset_rate_limiters()
+        cache.clear()
+        get_analysis_cache().clear()
+        self.user = User.objects.create_user(username='reanalysis', password='pass12345')
+        self.car = Car.objects.create(user=self.user, make='Ford', model='Focus', year=2015, owner='Re')
+        self.diagnoses = [
+            DiagnosisRequest.objects.create(
+                user=self.user, car=self.car, image=make_image(color=(index * 40, 0, 0)),
+                status='done', ai_result='Old prompt report',
+            )
+            for index in range(5)
+        ]
+
+    def test_inline_run_resumes_from_checkpoint(self):
+        with FakeVisionUpstream(content='Cracked windscreen') as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url):
+                run = start_run({'car_id': self.car.id}, chunk_size=2, concurrency=2)
+                self.assertEqual(run_step(run), 0)
+                # The worker dies here; a resumed run starts after the checkpoint
+                run = ReanalysisRun.objects.get(id=run.id)
+                self.assertEqual((run.processed, run.last_id), (2, self.diagnoses[1].id))
+                call_command('reanalyze_diagnoses', resume=run.id, inline=True, stdout=io.StringIO())
+
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.processed, run.total, run.failed), ('done', 5, 5, 0))
+        self.assertEqual(len(upstream.requests), 5)
+        for diagnosis in DiagnosisRequest.objects.select_related('car'):
+            self.assertIn('Cracked windscreen', diagnosis.rendered_result)
+
+    def test_batch_mode_submits_chunk_to_batch_api(self):
+        with FakeVisionUpstream(content='Bent wheel rim', batch_polls=1) as upstream:
+            with override_settings(OPENAI_API_KEY='sk-test', OPENAI_API_BASE=upstream.url, VISION_REANALYSIS_BATCH_POLL=5):
+                run = start_run({'user_id': self.user.id}, mode='batch', chunk_size=10)
+                self.assertEqual(run_step(run), 5)
+                self.assertTrue(run.batch_id)
+                self.assertEqual(run_step(run), 5)
+                self.assertEqual(run_step(run), 0)
+                self.assertIsNone(run_step(run))
+
+        self.assertEqual((run.status, run.processed), ('done', 5))
+        self.assertEqual(len(upstream.batches), 1)
+        self.assertEqual(len(upstream.requests), 5)
+        self.assertEqual(set(DiagnosisRequest.objects.values_list('cache_status', flat=True)), {'batch'})
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class TestRetentionPurge(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='retention', password='pass12345')
+        self.other = User.objects.create_user(username='retention2', password='pass12345')
+        self.car = Car.objects.create(user=self.user, make='Mazda', model='3', year=2016, owner='Ret')
+        self.other_car = Car.objects.create(user=self.other, make='Mazda', model='6', year=2018, owner='Ret2')
+
+        def create(user, car, count):
+            return [
+                DiagnosisRequest.objects.create(user=user, car=car, image=make_image(), original_image_bytes=1000)
+                for _ in range(count)
+            ]
+        self.old = create(self.user, self.car, 3)
+        DiagnosisRequest.objects.filter(id__in=[d.id for d in self.old]).update(
+            created_at=timezone.now() - timedelta(days=400)
+        )
+        self.recent = create(self.user, self.car, 4)
+        self.others = create(self.other, self.other_car, 2)
+        # A kept diagnosis that reused the analysis of one being purged
+        DiagnosisRequest.objects.filter(id=self.recent[-1].id).update(reused_from=self.old[0])
+
+    def test_dry_run_only_estimates(self):
+        totals = apply_retention(days=365, max_per_user=3, dry_run=True)
+        self.assertEqual(totals, {'diagnoses': 4, 'files': 4, 'bytes': 4000})
+        self.assertEqual(DiagnosisRequest.objects.count(), 9)
+
+    def test_purges_by_age_and_quota_with_files(self):
+        purged = self.old + self.recent[:1]
+        paths = [diagnosis.image.path for diagnosis in purged]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        out = io.StringIO()
+        call_command('purge_diagnoses', days=365, max_per_user=3, batch_size=2, stdout=out)
+
+        self.assertIn('Deleted 4 diagnoses and 4 image files', out.getvalue())
+        remaining = set(DiagnosisRequest.objects.values_list('id', flat=True))
+        self.assertEqual(remaining, {d.id for d in self.recent[1:] + self.others})
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        self.assertTrue(os.path.exists(self.others[0].image.path))
+        self.assertIsNone(DiagnosisRequest.objects.get(id=self.recent[-1].id).reused_from_id)
+
+    def test_variants_are_deleted_once_no_row_shares_them(self):
+        shared, kept = self.old[0], self.others[0]
+        for diagnosis in (shared, kept):
+            update_variants(DiagnosisRequest, diagnosis.id, 'image')
+        kept.refresh_from_db()
+        storage = kept.image.storage
+        names = [name for size, name in kept.image_variants.items() if size != 'source']
+        self.assertTrue(names)
+
+        # Identical images share their variants: purging one row keeps them
+        purge(DiagnosisRequest.objects.filter(id=shared.id))
+        self.assertTrue(all(storage.exists(name) for name in names))
+
+        # Replacing the image removes the old variants along with the last reference
+        kept.image = make_image(color=(10, 200, 10))
+        kept.save()
+        update_variants(DiagnosisRequest, kept.id, 'image')
+        self.assertFalse(any(storage.exists(name) for name in names))
+        kept.refresh_from_db()
+        replaced = [name for size, name in kept.image_variants.items() if size != 'source']
+        self.assertEqual(purge(DiagnosisRequest.objects.filter(id=kept.id))['files'], 1 + len(replaced))
+        self.assertFalse(any(storage.exists(name) for name in replaced))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, VISION_UPLOAD_TEMP_DIR=tempfile.mkdtemp(), OPENAI_API_KEY='')
+class TestResumableUpload(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='uploader', password='pass12345')
+        self.client.force_authenticate(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Subaru', model='Impreza', year=2014, owner='Up')
+        self.data = make_scene(fmt='PNG').read()
+
+    def send(self, url, chunk, offset, checksum=None):
+        headers = {'HTTP_UPLOAD_OFFSET': str(offset)}
+        if checksum:
+            headers['HTTP_UPLOAD_CHECKSUM'] = 'sha256 ' + base64.b64encode(checksum).decode()
+        return self.client.patch(url, chunk, content_type='application/offset+octet-stream', **headers)
+
+    def test_chunks_resume_and_finalize_into_diagnosis(self):
+        response = self.client.post(reverse('diagnosis-upload-create'), {
+            'car_id': self.car.id, 'filename': 'dent.png', 'size': len(self.data),
+            'sha256': hashlib.sha256(self.data).hexdigest(), 'damage_description': 'Dent',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        url = response['Location']
+        half = len(self.data) // 2
+
+        first = self.data[:half]
+        self.assertEqual(self.send(url, first, 0, hashlib.sha256(first).digest())['Upload-Offset'], str(half))
+        # A corrupted chunk is rejected and the offset does not move
+        corrupted = self.send(url, b'x' * 10, half, hashlib.sha256(b'y').digest())
+        self.assertEqual(corrupted.status_code, 460)
+        # A stale offset (e.g. a retried chunk) is refused with the offset to resume from
+        self.assertEqual(self.send(url, first, 0).status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.client.head(url)['Upload-Offset'], str(half))
+
+        self.assertEqual(self.send(url, self.data[half:], half).status_code, status.HTTP_204_NO_CONTENT)
+        with mock.patch('ai_assistant.views.process_diagnosis.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                finalized = self.client.post(url + 'finalize/')
+        self.assertEqual(finalized.status_code, status.HTTP_202_ACCEPTED)
+        delay.assert_called_once_with(finalized.data['id'])
+
+        diagnosis = DiagnosisRequest.objects.get(id=finalized.data['id'])
+        self.assertEqual(diagnosis.image_sha256, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(diagnosis.damage_description, 'Dent')
+        with diagnosis.image.open('rb') as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertEqual(os.listdir(settings.VISION_UPLOAD_TEMP_DIR), [])
+        # Finalize is idempotent
+        self.assertEqual(self.client.post(url + 'finalize/').data['id'], diagnosis.id)
+
+    def test_finalize_rejects_incomplete_upload(self):
+        response = self.client.post(reverse('diagnosis-upload-create'), {
+            'car_id': self.car.id, 'filename': 'dent.png', 'size': len(self.data),
+            'sha256': hashlib.sha256(self.data).hexdigest(),
+        }, format='json')
+        url = response['Location']
+        self.send(url, self.data[:100], 0)
+        finalized = self.client.post(url + 'finalize/')
+        self.assertEqual(finalized.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(finalized.data['offset'], 100)
+        self.assertEqual(DiagnosisRequest.objects.count(), 0)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='')
+class TestImageVariants(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='variants', password='pass12345')
+        self.client.force_authenticate(user=self.user)
+        self.car = Car.objects.create(user=self.user, make='Volvo', model='V60', year=2021, owner='Var')
+
+    def test_variants_rendered_after_analysis_and_shared_by_content(self):
+        first = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image(size=(2000, 1500)))
+        second = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image(size=(2000, 1500)))
+        process_diagnosis(first.id)
+        process_diagnosis(second.id)
+
+        response = self.client.get(reverse('diagnosis-detail', args=[first.id]))
+        self.assertEqual(set(response.data['image_variants']), {'128', '512', '1024'})
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.image_variants['512'], second.image_variants['512'])
+        with first.image.storage.open(first.image_variants['512']) as variant, Image.open(variant) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (512, 384)))
+
+    def test_unrenderable_image_is_recorded_and_not_requeued(self):
+        broken = DiagnosisRequest.objects.create(
+            user=self.user, car=self.car, status='done', image=SimpleUploadedFile('broken.png', b'not an image')
+        )
+        variants = update_variants(DiagnosisRequest, broken.id, 'image')
+        self.assertEqual(variants['source'], broken.image.name)
+        self.assertIn('error', variants)
+
+        with mock.patch('ai_assistant.tasks.generate_diagnosis_variants.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(reverse('diagnosis-detail', args=[broken.id]))
+                self.client.get(reverse('diagnosis-list-create'))
+        self.assertEqual(response.data['image_variants'], {})
+        delay.assert_not_called()
+
+
+class TestContentAddressedStorage(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        self.storage = ContentAddressedStorage(location=self.location)
+
+    def test_identical_files_are_stored_once_and_counted(self):
+        data = make_image().read()
+        digest = hashlib.sha256(data).hexdigest()
+        first = self.storage.save('diagnosis_images/car.JPG', SimpleUploadedFile('car.JPG', data))
+        second = self.storage.save('diagnosis_images/other.jpg', SimpleUploadedFile('other.jpg', data))
+
+        self.assertEqual(first, f'diagnosis_images/{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+        self.assertEqual(first, second)
+        self.assertEqual(self.storage.references(first), 2)
+        self.assertEqual(os.listdir(os.path.join(self.location, 'diagnosis_images')), [digest[:2]])
+
+        self.storage.delete(first)
+        self.assertTrue(self.storage.exists(first))
+        self.storage.delete(second)
+        self.assertFalse(self.storage.exists(first))
+        self.assertEqual(os.listdir(os.path.dirname(self.storage.path(first))), [])
+
+    def test_concurrent_saves_keep_the_count(self):
+        data = make_image().read()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            names = set(executor.map(
+                lambda i: self.storage.save('avatars/me.jpg', SimpleUploadedFile('me.jpg', data)), range(16)
+            ))
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertEqual(self.storage.references(name), 16)
+        with self.storage.open(name) as stored:
+            self.assertEqual(stored.read(), data)
+
+    def test_variants_keep_their_names_and_are_rendered_once(self):
+        user = User.objects.create_user(username='cas', password='pass12345')
+        car = Car.objects.create(user=user, make='Kia', model='Ceed', year=2020, owner='Cas')
+        data = make_image(size=(800, 600)).read()
+        digest = hashlib.sha256(data).hexdigest()
+        with mock.patch.object(DiagnosisRequest._meta.get_field('image'), 'storage', self.storage):
+            diagnoses = [
+                DiagnosisRequest.objects.create(user=user, car=car, image=SimpleUploadedFile('car.png', data))
+                for _ in range(2)
+            ]
+            first = generate_variants(diagnoses[0].image)
+            with mock.patch.object(FileSystemStorage, '_save') as save:
+                second = generate_variants(diagnoses[1].image)
+
+        save.assert_not_called()
+        self.assertEqual(first['128'], second['128'])
+        self.assertEqual(first['128'], f'variants/{digest[:2]}/{digest}-128.webp')
+        self.assertTrue(self.storage.exists(first['128']))
+        self.assertEqual(self.storage.references(diagnoses[0].image.name), 2)
+        self.assertFalse([name for name in os.listdir(self.storage.path(f'variants/{digest[:2]}')) if name.endswith('.refs')])
+
+    def test_legacy_flat_file_counts_as_one_reference(self):
+        os.makedirs(os.path.join(self.location, 'avatars'))
+        with open(os.path.join(self.location, 'avatars', 'old.png'), 'wb') as legacy:
+            legacy.write(b'png')
+        self.assertEqual(self.storage.references('avatars/old.png'), 1)
+        self.storage.delete('avatars/old.png')
+        self.assertEqual(os.listdir(os.path.join(self.location, 'avatars')), [])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='', MEDIA_SENDFILE='')
+class TestProtectedMedia(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='media', password='pass12345')
+        self.other = User.objects.create_user(username='media-other', password='pass12345')
+        self.car = Car.objects.create(user=self.user, make='Audi', model='A4', year=2019, owner='Media')
+        self.diagnosis = DiagnosisRequest.objects.create(user=self.user, car=self.car, image=make_image())
+        self.url = signed_media_url(self.diagnosis.image.name)
+        with self.diagnosis.image.open('rb') as image:
+            self.data = image.read()
+
+    def test_only_signed_urls_are_served(self):
+        name = self.diagnosis.image.name
+        plain = reverse('protected-media', args=[name])
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get(plain).status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user=None)
+
+        # A token names one file and expires
+        other = signed_media_url('diagnosis_images/other.png').split('?')[1]
+        self.assertEqual(self.client.get(f'{plain}?{other}').status_code, status.HTTP_404_NOT_FOUND)
+        expired = media_token(name, now=time.time() - 3 * settings.MEDIA_URL_MAX_AGE)
+        self.assertEqual(self.client.get(plain, {'token': expired}).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(plain, {'token': media_token(name) + 'x'}).status_code, status.HTTP_404_NOT_FOUND)
+
+        # No credentials besides the token, as for an <img> tag
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=86400')
+        # The URL stays the same within a window so browsers can cache it
+        self.assertEqual(signed_media_url(name), self.url)
+
+        cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_owner_receives_signed_urls(self):
+        self.client.force_authenticate(user=self.user)
+        image_url = self.client.get(reverse('diagnosis-detail', args=[self.diagnosis.id])).data['image']
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.client.get(image_url).status_code, status.HTTP_200_OK)
+
+        self.client.force_authenticate(user=self.other)
+        response = self.client.get(reverse('diagnosis-detail', args=[self.diagnosis.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '10')
+
+        tail = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(tail.streaming_content), self.data[-5:])
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.data)}-').status_code, 416)
+        # A stale If-Range gets the whole file
+        stale = self.client.get(self.url, HTTP_RANGE='bytes=0-0', HTTP_IF_RANGE='"old"')
+        self.assertEqual(stale.status_code, status.HTTP_200_OK)
+
+    @override_settings(MEDIA_SENDFILE='x-accel-redirect')
+    def test_hashed_variants_are_handed_to_the_proxy(self):
+        digest = 'ab' * 32
+        name = f'variants/ab/{digest}-128.webp'
+        self.diagnosis.image.storage.save(name, SimpleUploadedFile('v.webp', b'webp'))
+        DiagnosisRequest.objects.filter(id=self.diagnosis.id).update(
+            image_variants={'source': self.diagnosis.image.name, '128': name}
+        )
+        response = self.client.get(signed_media_url(name))
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{name}')
+        self.assertEqual(response['ETag'], f'"{digest}"')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, OPENAI_API_KEY='')
+class TestDiagnosisSearch(APITestCase):
+    def setUp(self):
+        self.search_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.search_dir, ignore_errors=True)
+        override = override_settings(DIAGNOSIS_SEARCH_DIR=self.search_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.user = User.objects.create_user(username='search', password='pass12345')
+        self.other = User.objects.create_user(username='search-other', password='pass12345')
+        self.car = Car.objects.create(user=self.user, make='Skoda', model='Octavia', year=2017, owner='Search')
+        self.van = Car.objects.create(user=self.user, make='Ford', model='Transit', year=2015, owner='Search')
+        self.client.force_authenticate(user=self.user)
+
+    def create(self, car, text, user=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return DiagnosisRequest.objects.create(
+                user=user or self.user, car=car, image=make_image(), damage_description=text
+            )
+
+    def search(self, **params):
+        response = self.client.get(reverse('diagnosis-search'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [hit['id'] for hit in response.data]
+
+    def test_search_ranks_the_users_diagnoses(self):
+        rust = self.create(self.car, 'Rusty patch on the rear quarter panel near the wheel arch')
+        dent = self.create(self.car, 'Dent in the front bumper after a parking accident')
+        van_rust = self.create(self.van, 'Surface rust along the sliding door rail')
+        self.create(self.car, 'Rust on the rear quarter panel', user=self.other)
+
+        self.assertEqual(self.search(q='when did we last see rust on the rear quarter panel?')[:2], [rust.id, van_rust.id])
+        self.assertEqual(self.search(q='rust', car=self.van.id), [van_rust.id])
+        self.assertEqual(self.search(q='bumper dent'), [dent.id])
+
+        # Saving new text re-indexes the row; deleted rows drop out
+        dent.damage_description = 'Cracked windscreen'
+        with self.captureOnCommitCallbacks(execute=True):
+            dent.save(update_fields=['damage_description'])
+        self.assertEqual(self.search(q='bumper dent'), [])
+        van_rust.delete()
+        self.assertEqual(self.search(q='rust', car=self.van.id), [])
+
+    def test_rebuild_drops_superseded_records(self):
+        diagnosis = self.create(self.car, 'Scratched door')
+        index = get_search_index()
+        for text in ('Scratched door handle', 'Scratched and dented door'):
+            index.refresh()
+            diagnosis.damage_description = text
+            with self.captureOnCommitCallbacks(execute=True):
+                diagnosis.save()
+        # Appended records update the latest positions incrementally
+        snapshot = index.refresh()
+        self.assertEqual((len(snapshot.ids), snapshot.latest.tolist()), (3, [2]))
+
+        self.assertEqual(rebuild_index(), 1)
+        self.assertEqual(len(index.refresh().ids), 1)
+        self.assertEqual(self.search(q='dented door'), [diagnosis.id])
+
+    def test_concurrent_searches_while_the_index_grows(self):
+        diagnoses = [self.create(self.car, f'Scratch number {number} on the door') for number in range(20)]
+        index = get_search_index()
+        query = vectorize('scratch door')
+
+        def search(_):
+            return index.search(self.user.id, query, 5)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            searches = [executor.submit(search, i) for i in range(200)]
+            for diagnosis in diagnoses:
+                index_diagnoses([diagnosis])
+            results = [future.result() for future in searches]
+        self.assertTrue(all(len(hits) <= 5 for hits in results))
+        snapshot = index.refresh()
+        self.assertEqual(sorted(snapshot.ids[snapshot.latest].tolist()), [d.id for d in diagnoses])
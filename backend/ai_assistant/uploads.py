@@ -0,0 +1,120 @@
+"""
+Resumable, offset-based uploads of diagnosis images (modelled on tus).
+
+1. ``POST uploads/`` declares the car, filename, size and SHA-256 of the image
+   and returns an UploadSession.
+2. ``PATCH uploads/<id>/`` with ``Upload-Offset: <n>`` and the raw bytes as
+   body appends a chunk. An optional ``Upload-Checksum: sha256 <base64>``
+   header verifies the chunk. After a dropped connection, ``HEAD uploads/<id>/``
+   returns the ``Upload-Offset`` to resume from.
+3. ``POST uploads/<id>/finalize/`` checks the whole file against the declared
+   SHA-256 and creates the DiagnosisRequest like a regular upload.
+
+Chunk bodies are streamed from the request to the temp file in small blocks,
+so a worker never holds a whole image in memory. The temp file is truncated
+to the committed offset before each append, which discards bytes written by
+a request that died before its offset was saved.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+from django.conf import settings
+from django.utils import timezone
+from .models import UploadSession
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+# tus status code for a chunk whose checksum does not match
+CHECKSUM_MISMATCH = 460
+
+
+class UploadError(Exception):
+    """A chunk or finalize request the session cannot accept"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_checksum(header):
+    """Digest bytes from an ``Upload-Checksum: sha256 <base64>`` header (None if absent)"""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm.lower() != 'sha256':
+        raise UploadError(f"Unsupported checksum algorithm: {algorithm}")
+    try:
+        return base64.b64decode(value.strip(), validate=True)
+    except ValueError:
+        raise UploadError("Malformed Upload-Checksum header")
+
+
+def append_chunk(session, stream, length, offset, checksum=None):
+    """
+    Append ``length`` bytes read from ``stream`` to the session's temp file at
+    ``offset`` and return the new offset (not saved).
+
+    Without a checksum, a body cut short keeps what arrived, so the client
+    resumes from there. With one, the chunk must arrive whole and match,
+    otherwise it is discarded.
+    """
+    if session.status != 'active':
+        raise UploadError("Upload is already finalized", 409)
+    if offset != session.offset:
+        raise UploadError(f"Upload-Offset {offset} does not match {session.offset}", 409)
+    if length > getattr(settings, 'VISION_UPLOAD_MAX_CHUNK', 5 * 1024 * 1024):
+        raise UploadError("Chunk too large", 413)
+    if offset + length > session.size:
+        raise UploadError("Chunk runs past the declared upload size", 400)
+
+    os.makedirs(os.path.dirname(session.temp_path), exist_ok=True)
+    digest = hashlib.sha256()
+    received = 0
+    with open(session.temp_path, 'r+b' if os.path.exists(session.temp_path) else 'w+b') as temp_file:
+        temp_file.truncate(offset)
+        temp_file.seek(offset)
+        while received < length:
+            block = stream.read(min(BLOCK_SIZE, length - received))
+            if not block:
+                break
+            temp_file.write(block)
+            digest.update(block)
+            received += len(block)
+
+        if checksum is not None and (received != length or digest.digest() != checksum):
+            temp_file.truncate(offset)
+            raise UploadError("Chunk checksum mismatch", CHECKSUM_MISMATCH)
+    return offset + received
+
+
+def verify_upload(session):
+    """Raise UploadError unless every byte has arrived and the file matches ``sha256``"""
+    if session.offset != session.size:
+        raise UploadError(f"Upload incomplete: {session.offset} of {session.size} bytes", 409)
+    digest = hashlib.sha256()
+    with open(session.temp_path, 'rb') as temp_file:
+        for block in iter(lambda: temp_file.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    if digest.hexdigest() != session.sha256:
+        raise UploadError("Upload checksum mismatch", CHECKSUM_MISMATCH)
+
+
+def discard_upload(session):
+    try:
+        os.remove(session.temp_path)
+    except FileNotFoundError:
+        pass
+
+
+def purge_stale_uploads():
+    """Delete expired sessions and their temp files; returns how many were removed"""
+    stale = list(UploadSession.objects.filter(expires_at__lt=timezone.now()))
+    for session in stale:
+        discard_upload(session)
+    UploadSession.objects.filter(id__in=[session.id for session in stale]).delete()
+    if stale:
+        logger.info("Removed %d expired uploads", len(stale))
+    return len(stale)
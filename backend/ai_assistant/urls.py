@@ -3,6 +3,15 @@ from . import views
 
 urlpatterns = [
     path('', views.DiagnosisRequestListCreateView.as_view(), name='diagnosis-list-create'),
+    path('batch/', views.DiagnosisBatchCreateView.as_view(), name='diagnosis-batch'),
+    path('stream/', views.stream_diagnosis, name='diagnosis-stream'),
+    path('search/', views.DiagnosisSearchView.as_view(), name='diagnosis-search'),
+    path('async/', views.create_diagnosis_async, name='diagnosis-create-async'),
+    path('uploads/', views.UploadSessionCreateView.as_view(), name='diagnosis-upload-create'),
+    path('uploads/<uuid:pk>/', views.UploadSessionView.as_view(), name='diagnosis-upload'),
+    path('uploads/<uuid:pk>/finalize/', views.UploadFinalizeView.as_view(), name='diagnosis-upload-finalize'),
     path('<int:pk>/', views.DiagnosisRequestDetailView.as_view(), name='diagnosis-detail'),
+    path('<int:pk>/status/', views.DiagnosisStatusView.as_view(), name='diagnosis-status'),
+    path('<int:pk>/similar/', views.DiagnosisSimilarView.as_view(), name='diagnosis-similar'),
     path('car/<int:car_id>/', views.CarDiagnosisListView.as_view(), name='car-diagnosis-list'),
 ] 
\ No newline at end of file
@@ -1,76 +1,273 @@
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework import generics, status, permissions
+from rest_framework.authentication import CSRFCheck, TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.response import Response
-from .models import DiagnosisRequest
-from .serializers import DiagnosisRequestSerializer
-from .openai_vision_service import OpenAIVisionService
+from cars.models import Car
+from .analysis import STRUCTURED_FIELDS
+from .models import DiagnosisRequest, UploadSession
+from .openai_vision_service import get_vision_service
+from .serializers import (
+    DiagnosisBatchSerializer, DiagnosisRequestSerializer, DiagnosisStatusSerializer, UploadSessionSerializer,
+)
+from .similarity import (
+    can_reuse, compute_dhash, describe_match, find_similar, image_hash_fields, nearest_diagnosis, reused_fields,
+)
+from .search import search_diagnoses
+from .singleflight import file_sha256, finish_flight, flight_key, join_or_create
+from .streaming import stream_diagnosis_events
+from .tasks import (
+    ANALYSIS_FIELDS, analyze_diagnoses, arun_diagnosis_analysis, process_diagnosis, queue_diagnosis_variants,
+)
+from .uploads import CHECKSUM_MISMATCH, UploadError, append_chunk, discard_upload, parse_checksum, verify_upload
+
+def filter_by_analysis(queryset, params):
+    """
+    Apply ``?severity=high`` (comma-separated) and ``?safety_concerns=true``
+    filters; both hit the (car|user, severity, created_at) indexes.
+    """
+    severity = params.get('severity')
+    if severity:
+        queryset = queryset.filter(severity__in=[value.strip().lower() for value in severity.split(',')])
+    if params.get('safety_concerns') in ('true', '1'):
+        queryset = queryset.filter(has_safety_concerns=True)
+    return queryset.select_related('car').order_by('-created_at')
+
+
+def wants_reuse(data):
+    """``reuse_similar`` form flag, defaulting to VISION_REUSE_SIMILAR_ANALYSIS"""
+    value = data.get('reuse_similar')
+    if value is None:
+        return getattr(settings, 'VISION_REUSE_SIMILAR_ANALYSIS', False)
+    return str(value).lower() in ('true', '1')
+
 
 class DiagnosisRequestListCreateView(generics.ListCreateAPIView):
     serializer_class = DiagnosisRequestSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return DiagnosisRequest.objects.filter(user=self.request.user)
+        return filter_by_analysis(DiagnosisRequest.objects.filter(user=self.request.user), self.request.query_params)
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        diagnosis = serializer.save(user=request.user)
-        
-        # Process AI analysis immediately for faster response
+        return submit_diagnosis(request, serializer)
+
+
+def submit_diagnosis(request, serializer, image_sha256=None):
+    """
+    Save a validated DiagnosisRequestSerializer and queue its analysis.
+
+    Near duplicates of an earlier photo can reuse its analysis, and identical
+    uploads made while the first is still being analysed get that diagnosis
+    back instead of a new one.
+    """
+    car_id = serializer.validated_data['car_id']
+    image = serializer.validated_data['image']
+    image_sha256 = image_sha256 or file_sha256(image)
+    hash_fields = image_hash_fields(compute_dhash(image))
+    match = nearest_diagnosis(request.user.id, hash_fields['image_dhash'], car_id=car_id)
+
+    # A near-duplicate of an earlier photo of this car can reuse its analysis
+    if wants_reuse(request.data) and can_reuse(match, car_id):
+        queue_diagnosis_variants([
+            serializer.save(user=request.user, image_sha256=image_sha256, **hash_fields, **reused_fields(match[0]))
+        ])
+        return Response({**serializer.data, 'similar_diagnosis': describe_match(match)}, status=status.HTTP_201_CREATED)
+
+    key = flight_key(request.user.id, car_id, image_sha256)
+
+    def create_diagnosis():
+        diagnosis = serializer.save(user=request.user, status='queued', image_sha256=image_sha256, **hash_fields)
+        # Hand the AI analysis to a Celery worker once the upload is committed
+        transaction.on_commit(lambda: process_diagnosis.delay(diagnosis.id))
+        return diagnosis
+
+    diagnosis_id, created = join_or_create(key, create_diagnosis)
+    diagnosis = None if created else DiagnosisRequest.objects.filter(id=diagnosis_id, user=request.user).first()
+    if diagnosis is None:
+        if not created:
+            finish_flight(key)
+            create_diagnosis()
+        return Response({**serializer.data, 'similar_diagnosis': describe_match(match)}, status=status.HTTP_202_ACCEPTED)
+    response = Response(
+        DiagnosisRequestSerializer(diagnosis, context={'request': request}).data,
+        status=status.HTTP_202_ACCEPTED
+    )
+    response['X-Diagnosis-Coalesced'] = 'true'
+    return response
+
+
+class UploadedImage(File):
+    """
+    A finalized upload on local disk. temporary_file_path() lets image
+    validation read it from disk and FileSystemStorage move it into place
+    instead of copying it through memory.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class UploadSessionCreateView(generics.CreateAPIView):
+    """Start a resumable image upload (see ai_assistant/uploads.py)"""
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def perform_create(self, serializer):
+        ttl = getattr(settings, 'VISION_UPLOAD_TTL', 24 * 3600)
+        serializer.save(user=self.request.user, expires_at=timezone.now() + timedelta(seconds=ttl))
+
+    def get_success_headers(self, data):
+        return {
+            'Location': reverse('diagnosis-upload', args=[data['id']]),
+            'Upload-Offset': '0',
+            'Upload-Length': str(data['size']),
+        }
+
+
+def _upload_headers(session):
+    return {'Upload-Offset': str(session.offset), 'Upload-Length': str(session.size), 'Cache-Control': 'no-store'}
+
+
+class UploadSessionView(generics.RetrieveDestroyAPIView):
+    """
+    ``HEAD``/``GET`` report the offset to resume from, ``PATCH`` appends a
+    chunk at ``Upload-Offset`` and ``DELETE`` abandons the upload.
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user, expires_at__gt=timezone.now())
+
+    def retrieve(self, request, *args, **kwargs):
+        session = self.get_object()
+        return Response(self.get_serializer(session).data, headers=_upload_headers(session))
+
+    def head(self, request, *args, **kwargs):
+        return Response(headers=_upload_headers(self.get_object()))
+
+    def patch(self, request, *args, **kwargs):
         try:
-            vision_service = OpenAIVisionService()
-            
-            # Get car information for context
-            car_info = None
-            if diagnosis.car:
-                car_info = {
-                    'year': diagnosis.car.year,
-                    'make': diagnosis.car.make,
-                    'model': diagnosis.car.model,
-                    'vin': diagnosis.car.vin
-                }
-            
-            ai_result = vision_service.get_image_analysis(
-                diagnosis.image, 
-                diagnosis.damage_description,
-                car_info=car_info
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers.get('Content-Length') or 0)
+            checksum = parse_checksum(request.headers.get('Upload-Checksum'))
+        except (KeyError, ValueError):
+            return Response({'detail': 'Upload-Offset and Content-Length headers are required'}, status=status.HTTP_400_BAD_REQUEST)
+        except UploadError as e:
+            return Response({'detail': str(e)}, status=e.status_code)
+
+        # The row lock serialises concurrent chunks of one upload
+        with transaction.atomic():
+            session = get_object_or_404(self.get_queryset().select_for_update(), pk=kwargs['pk'])
+            try:
+                # Read the body straight off the socket; it is never buffered whole
+                session.offset = append_chunk(session, request.stream, length, offset, checksum)
+            except UploadError as e:
+                return Response({'detail': str(e), 'offset': session.offset}, status=e.status_code, headers=_upload_headers(session))
+            session.save(update_fields=['offset'])
+        return Response(status=status.HTTP_204_NO_CONTENT, headers=_upload_headers(session))
+
+    def perform_destroy(self, instance):
+        discard_upload(instance)
+        instance.delete()
+
+
+class UploadFinalizeView(generics.GenericAPIView):
+    """Turn a complete upload into a diagnosis, like a regular create"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user, expires_at__gt=timezone.now())
+
+    def post(self, request, *args, **kwargs):
+        with transaction.atomic():
+            session = get_object_or_404(self.get_queryset().select_for_update(), pk=kwargs['pk'])
+            if session.status == 'complete':
+                # A retried finalize whose first response was lost
+                diagnosis = get_object_or_404(DiagnosisRequest, id=session.diagnosis_id, user=request.user)
+                return Response(DiagnosisRequestSerializer(diagnosis, context={'request': request}).data)
+            try:
+                verify_upload(session)
+            except UploadError as e:
+                if e.status_code == CHECKSUM_MISMATCH:
+                    # Corrupt somewhere along the way: start over
+                    discard_upload(session)
+                    session.offset = 0
+                    session.save(update_fields=['offset'])
+                return Response({'detail': str(e), 'offset': session.offset}, status=e.status_code, headers=_upload_headers(session))
+
+            with open(session.temp_path, 'rb') as temp_file:
+                serializer = DiagnosisRequestSerializer(data={
+                    'car_id': session.car_id,
+                    'image': UploadedImage(temp_file, name=session.filename),
+                    'damage_description': session.damage_description,
+                }, context={'request': request})
+                if not serializer.is_valid():
+                    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                response = submit_diagnosis(request, serializer, image_sha256=session.sha256)
+
+            session.status = 'complete'
+            session.diagnosis_id = response.data['id']
+            session.save(update_fields=['status', 'diagnosis'])
+        discard_upload(session)
+        return response
+
+
+class DiagnosisBatchCreateView(generics.GenericAPIView):
+    """
+    Analyse several photos of one car in a single request.
+
+    Rows are created with one bulk insert and the vision calls run
+    concurrently (capped by VISION_BATCH_CONCURRENCY), so the response takes
+    about as long as the slowest image rather than the sum of all of them.
+    """
+    serializer_class = DiagnosisBatchSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        car = Car.objects.get(id=data['car_id'])
+
+        diagnoses = DiagnosisRequest.objects.bulk_create([
+            DiagnosisRequest(
+                user=request.user,
+                car=car,
+                image=image,
+                image_sha256=file_sha256(image),
+                damage_description=data['damage_description'],
+                status='running',
+                **image_hash_fields(compute_dhash(image)),
             )
-            
-            # Update the diagnosis with AI result
-            diagnosis.ai_result = ai_result
-            diagnosis.save()
-            
-            # Return updated data with AI result
-            return Response({
-                **serializer.data,
-                'ai_result': ai_result
-            }, status=status.HTTP_201_CREATED)
-            
-        except Exception as e:
-            error_message = f"AI analysis failed: {str(e)}. Please try again."
-            diagnosis.ai_result = error_message
-            diagnosis.save()
-            
-            return Response({
-                **serializer.data,
-                'ai_result': error_message
-            }, status=status.HTTP_201_CREATED)
-
-    def process_ai_diagnosis(self, diagnosis):
-        """Process AI analysis using OpenAI Vision API"""
-        try:
-            vision_service = OpenAIVisionService()
-            ai_result = vision_service.get_image_analysis(diagnosis.image, diagnosis.damage_description)
-            
-            # Update the diagnosis with AI result
-            diagnosis.ai_result = ai_result
-            diagnosis.save()
-            
-        except Exception as e:
-            error_message = f"AI analysis failed: {str(e)}. Please try again."
-            diagnosis.ai_result = error_message
-            diagnosis.save()
+            for image in data['images']
+        ])
 
+        analyze_diagnoses(diagnoses, get_vision_service(), getattr(settings, 'VISION_BATCH_CONCURRENCY', 4))
+
+        DiagnosisRequest.objects.bulk_update(diagnoses, ANALYSIS_FIELDS)
+        queue_diagnosis_variants(diagnoses)
+
+        results = DiagnosisRequestSerializer(diagnoses, many=True, context=self.get_serializer_context()).data
+        return Response({
+            'car_id': car.id,
+            'count': len(diagnoses),
+            'failed': sum(1 for diagnosis in diagnoses if diagnosis.status == 'failed'),
+            'results': results,
+        }, status=status.HTTP_201_CREATED)
 
 
 class DiagnosisRequestDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -80,10 +277,233 @@ class DiagnosisRequestDetailView(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         return DiagnosisRequest.objects.filter(user=self.request.user)
 
+class DiagnosisStatusView(generics.RetrieveAPIView):
+    """Lightweight endpoint the frontend polls while a diagnosis is processed"""
+    serializer_class = DiagnosisStatusSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return DiagnosisRequest.objects.filter(user=self.request.user).select_related('car').only(
+            'id', 'status', 'ai_result', 'error_message', *STRUCTURED_FIELDS,
+            'car__year', 'car__make', 'car__model', 'car__vin',
+        )
+
+class DiagnosisSimilarView(generics.GenericAPIView):
+    """
+    The user's earlier diagnoses whose photo is a near duplicate of this one,
+    closest first. ``?scope=car`` limits the lookup to the same car.
+    """
+    serializer_class = DiagnosisRequestSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return DiagnosisRequest.objects.filter(user=self.request.user)
+
+    def get(self, request, *args, **kwargs):
+        diagnosis = self.get_object()
+        candidates = self.get_queryset().exclude(id=diagnosis.id).select_related('car')
+        if request.query_params.get('scope') == 'car':
+            candidates = candidates.filter(car_id=diagnosis.car_id)
+        matches = find_similar(candidates, diagnosis.image_dhash, limit=10)
+        return Response([
+            {**self.get_serializer(match).data, 'distance': distance}
+            for match, distance in matches
+        ])
+
+
+class DiagnosisSearchView(generics.GenericAPIView):
+    """
+    The user's diagnoses whose description or report best match ``?q=``,
+    best first, each with its ``score`` (cosine similarity, 0-1).
+    ``?car=<id>`` limits the search to one car, ``?limit=`` (max 50) the hits.
+    """
+    serializer_class = DiagnosisRequestSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'detail': 'The q parameter is required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            return Response({'detail': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        scope = None
+        if request.query_params.get('car'):
+            scope = DiagnosisRequest.objects.filter(user=request.user, car_id=request.query_params['car'])
+
+        matches = search_diagnoses(request.user, query, limit=limit, queryset=scope)
+        return Response([
+            {**self.get_serializer(match).data, 'score': round(score, 4)}
+            for match, score in matches
+        ])
+
+
 class CarDiagnosisListView(generics.ListAPIView):
     serializer_class = DiagnosisRequestSerializer
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
         car_id = self.kwargs['car_id']
-        return DiagnosisRequest.objects.filter(car_id=car_id, user=self.request.user) 
\ No newline at end of file
+        return filter_by_analysis(
+            DiagnosisRequest.objects.filter(car_id=car_id, user=self.request.user),
+            self.request.query_params
+        )
+
+
+def _authenticate_token(request):
+    try:
+        result = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+def _csrf_failure(request):
+    """The CSRF failure reason for ``request``, or None (like DRF's SessionAuthentication.enforce_csrf)"""
+    check = CSRFCheck(lambda request: None)
+    check.process_request(request)
+    # DRF's CSRFCheck returns the failure reason instead of a response
+    return check.process_view(request, None, (), {})
+
+
+async def _aget_user(request):
+    """
+    Token auth (as used by the frontend) with session auth as fallback.
+    Returns ``(user, error response)``: the views are csrf_exempt for token
+    clients, so session-authenticated requests must pass the CSRF check here.
+    """
+    user = await sync_to_async(_authenticate_token)(request)
+    if user is not None:
+        return user, None
+    user = await request.auser()
+    if not user.is_authenticated:
+        return user, JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+    reason = await sync_to_async(_csrf_failure)(request)
+    if reason:
+        return user, JsonResponse({'detail': f'CSRF Failed: {reason}'}, status=status.HTTP_403_FORBIDDEN)
+    return user, None
+
+
+def _create_streaming_diagnosis(request, user):
+    serializer = DiagnosisRequestSerializer(data={**request.POST.dict(), **request.FILES.dict()}, context={'user': user})
+    if not serializer.is_valid():
+        return None, serializer.errors
+    image_hash = compute_dhash(serializer.validated_data['image'])
+    diagnosis = serializer.save(user=user, status='running', **image_hash_fields(image_hash))
+    return DiagnosisRequest.objects.select_related('car').get(pk=diagnosis.pk), None
+
+
+@csrf_exempt
+@require_POST
+async def stream_diagnosis(request):
+    """
+    Create a diagnosis and stream the AI analysis back as Server-Sent Events.
+
+    Events: ``diagnosis`` (id), ``chunk`` (text delta) and finally ``done``
+    or ``failed`` with the saved ai_result. Serve under ASGI so waiting on
+    upstream does not hold a worker thread per open stream.
+    """
+    user, error = await _aget_user(request)
+    if error is not None:
+        return error
+
+    diagnosis, errors = await sync_to_async(_create_streaming_diagnosis)(request, user)
+    if errors:
+        return JsonResponse(errors, status=status.HTTP_400_BAD_REQUEST)
+
+    response = StreamingHttpResponse(
+        stream_diagnosis_events(get_vision_service(), diagnosis),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _validate_async_diagnosis(request, user):
+    serializer = DiagnosisRequestSerializer(data={**request.POST.dict(), **request.FILES.dict()}, context={'user': user})
+    serializer.is_valid()
+    return serializer.validated_data, serializer.errors
+
+
+def _serialize_diagnosis(request, diagnosis):
+    return DiagnosisRequestSerializer(diagnosis, context={'request': request}).data
+
+
+@csrf_exempt
+@require_POST
+async def create_diagnosis_async(request):
+    """
+    Create a diagnosis and analyse it inline, fully async.
+
+    The upstream call goes through the event loop's shared httpx client and
+    the ORM calls use Django's async API, so under ASGI one worker holds many
+    in-flight analyses instead of one per thread. Only request validation,
+    the insert under the single-flight lock and image resizing run in threads.
+    Identical uploads made while the first is analysed wait for its result.
+    """
+    user, error = await _aget_user(request)
+    if error is not None:
+        return error
+
+    data, errors = await sync_to_async(_validate_async_diagnosis)(request, user)
+    if errors:
+        return JsonResponse(errors, status=status.HTTP_400_BAD_REQUEST)
+    car = await Car.objects.filter(id=data['car_id'], user=user).afirst()
+    if car is None:
+        return JsonResponse({'car_id': ['Car not found']}, status=status.HTTP_400_BAD_REQUEST)
+
+    image_sha256 = await sync_to_async(file_sha256, thread_sensitive=False)(data['image'])
+    hash_fields = image_hash_fields(await sync_to_async(compute_dhash, thread_sensitive=False)(data['image']))
+    match = await sync_to_async(nearest_diagnosis)(user.id, hash_fields['image_dhash'], car_id=car.id)
+
+    if wants_reuse(request.POST) and can_reuse(match, car.id):
+        diagnosis = await DiagnosisRequest.objects.acreate(
+            user=user,
+            car=car,
+            image=data['image'],
+            image_sha256=image_sha256,
+            damage_description=data.get('damage_description', ''),
+            **hash_fields,
+            **reused_fields(match[0]),
+        )
+        await sync_to_async(queue_diagnosis_variants)([diagnosis])
+        return JsonResponse(
+            {**await sync_to_async(_serialize_diagnosis)(request, diagnosis), 'similar_diagnosis': describe_match(match)},
+            status=status.HTTP_201_CREATED
+        )
+
+    key = flight_key(user.id, car.id, image_sha256)
+
+    def create_diagnosis():
+        return DiagnosisRequest.objects.create(
+            user=user,
+            car=car,
+            image=data['image'],
+            image_sha256=image_sha256,
+            damage_description=data.get('damage_description', ''),
+            status='running',
+            **hash_fields,
+        )
+
+    diagnosis_id, created = await sync_to_async(join_or_create)(key, create_diagnosis)
+    diagnosis = await DiagnosisRequest.objects.select_related('car').filter(id=diagnosis_id, user=user).afirst()
+    if diagnosis is None:
+        await sync_to_async(finish_flight)(key)
+        diagnosis, created = await sync_to_async(create_diagnosis)(), True
+
+    if not created:
+        # A duplicate of an analysis already running: the client polls the leader's diagnosis
+        response = JsonResponse(await sync_to_async(_serialize_diagnosis)(request, diagnosis), status=status.HTTP_202_ACCEPTED)
+        response['X-Diagnosis-Coalesced'] = 'true'
+        return response
+
+    await arun_diagnosis_analysis(diagnosis, get_vision_service())
+    await diagnosis.asave(update_fields=ANALYSIS_FIELDS)
+    await sync_to_async(finish_flight)(key)
+    await sync_to_async(queue_diagnosis_variants)([diagnosis])
+    return JsonResponse(
+        {**await sync_to_async(_serialize_diagnosis)(request, diagnosis), 'similar_diagnosis': describe_match(match)},
+        status=status.HTTP_201_CREATED
+    )
@@ -10,9 +10,21 @@ app.autodiscover_tasks()
 
 # Celery Beat Schedule for periodic tasks
 app.conf.beat_schedule = {
-    'send-maintenance-reminders': {
-        'task': 'maintenance.tasks.send_pending_reminders',
-        'schedule': crontab(hour=9, minute=0),  # Run daily at 9 AM
+    'sweep-due-reminders': {
+        'task': 'maintenance.tasks.sweep_due_reminders',
+        'schedule': crontab(),  # Run every minute; only enqueues work when reminders are due
+    },
+    'purge-expired-diagnoses': {
+        'task': 'ai_assistant.tasks.purge_expired_diagnoses',
+        'schedule': crontab(hour=3, minute=30),  # Run daily at 3:30 AM, off-peak
+    },
+    'purge-stale-uploads': {
+        'task': 'ai_assistant.tasks.purge_stale_uploads',
+        'schedule': crontab(minute=15),  # Run hourly
+    },
+    'rebuild-search-index': {
+        'task': 'ai_assistant.tasks.rebuild_search_index',
+        'schedule': crontab(hour=4, minute=0, day_of_week=0),  # Run weekly, Sunday 4 AM
     },
 }
 
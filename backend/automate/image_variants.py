@@ -0,0 +1,168 @@
+"""
+Resized WebP variants of uploaded images (diagnosis photos, avatars).
+
+Variants are stored next to the media files under ``variants/`` with names
+derived from the SHA-256 of the original, so identical uploads share one set
+and an existing variant is never rendered twice. Each model keeps the names
+in a ``<field>_variants`` JSONField::
+
+    {"source": "diagnosis_images/car.jpg", "128": "variants/ab/ab…-128.webp", ...}
+
+``source`` records which original they were made from, so a replaced image
+gets new variants. Rendering runs in Celery tasks queued where a row's image
+is written, never in the request. An image that cannot be rendered is
+recorded as ``{"source": ..., "error": ...}`` and not tried again.
+
+Rows with identical originals share variant files, so a variant is only
+deleted (when its row is purged or its image replaced) once no row of
+VARIANT_FIELDS refers to it any more.
+"""
+
+import hashlib
+import io
+import logging
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from PIL import Image, ImageOps
+from .media import signed_media_url
+from .storage import plain_storage
+
+logger = logging.getLogger(__name__)
+
+# (model, image field) of every row with a ``<field>_variants`` JSONField
+VARIANT_FIELDS = [
+    ('ai_assistant.DiagnosisRequest', 'image'),
+    ('members.UserProfile', 'avatar'),
+]
+# Variant names are looked up this many at a time
+LOOKUP_BLOCK = 100
+
+
+def variant_sizes():
+    """Longest edge of each variant, largest first"""
+    return sorted(getattr(settings, 'IMAGE_VARIANT_SIZES', [128, 512, 1024]), reverse=True)
+
+
+def variants_outdated(instance, field):
+    """Whether ``instance.<field>`` has no variants yet (or they belong to an older file)"""
+    field_file = getattr(instance, field)
+    variants = getattr(instance, f'{field}_variants') or {}
+    return bool(field_file) and variants.get('source') != field_file.name
+
+
+def schedule_variants(instance, field, task):
+    """Queue ``task(instance.pk)`` once the transaction commits, at most once per few minutes"""
+    if not variants_outdated(instance, field):
+        return
+    key = f'image-variants:{instance._meta.label_lower}:{instance.pk}:{field}'
+    if cache.add(key, 1, timeout=300):
+        transaction.on_commit(lambda: task.delay(instance.pk))
+
+
+def generate_variants(field_file):
+    """Render (or reuse) every variant of ``field_file``; returns the names to store"""
+    # Names are already content-derived, so they are never re-hashed
+    storage = plain_storage(field_file.storage)
+    field_file.open('rb')
+    try:
+        digest = hashlib.sha256()
+        for chunk in field_file.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        field_file.seek(0)
+
+        variants = {'source': field_file.name}
+        with Image.open(field_file) as image:
+            sizes = variant_sizes()
+            image.draft('RGB', (sizes[0], sizes[0]))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB')
+            # Each size is scaled down from the previous (larger) one
+            for size in sizes:
+                name = f'variants/{digest[:2]}/{digest}-{size}.webp'
+                image.thumbnail((size, size), Image.LANCZOS)
+                if not storage.exists(name):
+                    buffer = io.BytesIO()
+                    image.save(buffer, format='WEBP', quality=getattr(settings, 'IMAGE_VARIANT_QUALITY', 80))
+                    name = storage.save(name, ContentFile(buffer.getvalue()))
+                variants[str(size)] = name
+    finally:
+        field_file.close()
+    return variants
+
+
+def variant_names(variants):
+    """The variant file names in a ``<field>_variants`` value"""
+    return [name for size, name in (variants or {}).items() if size not in ('source', 'error')]
+
+
+def referenced_variants(names):
+    """Those of ``names`` that some row still refers to"""
+    names = list(set(names))
+    found = set()
+    for start in range(0, len(names), LOOKUP_BLOCK):
+        block = names[start:start + LOOKUP_BLOCK]
+        for label, field in VARIANT_FIELDS:
+            lookup = Q()
+            for name in block:
+                # Variant keys are sizes, which JSON key lookups would take for array indexes
+                lookup |= Q(**{f'{field}_variants__icontains': f'"{name}"'})
+            rows = apps.get_model(label).objects.filter(lookup).values_list(f'{field}_variants', flat=True)
+            for variants in rows:
+                found.update(variant_names(variants))
+    return found.intersection(names)
+
+
+def delete_variants(storage, names):
+    """Delete the variant files among ``names`` no row refers to any more; returns how many"""
+    names = set(names)
+    if not names:
+        return 0
+    storage = plain_storage(storage)
+    deleted = 0
+    for name in names - referenced_variants(names):
+        try:
+            storage.delete(name)
+        except OSError as e:
+            logger.warning("Could not delete variant %s: %s", name, e)
+            continue
+        deleted += 1
+    return deleted
+
+
+def update_variants(model, pk, field):
+    """Task body: render the variants of one row and store their names"""
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not variants_outdated(instance, field):
+        return None
+    try:
+        variants = generate_variants(getattr(instance, field))
+    except Exception as e:
+        logger.warning("Could not render variants of %s %s: %s", model.__name__, pk, e)
+        # Recorded so the image is not queued again
+        variants = {'source': getattr(instance, field).name, 'error': str(e)[:500]}
+    # update() so saving the names does not fire post_save again
+    model.objects.filter(pk=pk).update(**{f'{field}_variants': variants})
+    # Variants of a replaced image
+    stale = set(variant_names(getattr(instance, f'{field}_variants'))) - set(variant_names(variants))
+    delete_variants(getattr(instance, field).storage, stale)
+    return variants
+
+
+def variant_urls(instance, field, request=None):
+    """``{"128": url, ...}`` for serializers; empty until the variants exist"""
+    field_file = getattr(instance, field)
+    variants = getattr(instance, f'{field}_variants') or {}
+    if not field_file or variants.get('source') != field_file.name:
+        return {}
+    urls = {}
+    for size, name in variants.items():
+        if size in ('source', 'error'):
+            continue
+        urls[size] = signed_media_url(name, request)
+    return urls
@@ -0,0 +1,187 @@
+"""
+Protected media serving.
+
+Every file under MEDIA_URL is served through ProtectedMediaView, and only
+with a signed ``token`` query parameter. Serializers hand out such URLs
+(``signed_media_url``) to the user owning the row that references the file, so
+the token is the proof of ownership and ``<img>`` tags, which cannot send an
+Authorization header, can load them. Tokens name a single file and expire
+after MEDIA_URL_MAX_AGE to twice that; the expiry is rounded to that window so
+a URL stays the same (and browser-cacheable) while it is valid. The bytes are
+then sent by:
+
+* the front proxy, when MEDIA_SENDFILE is ``x-accel-redirect`` (nginx, via an
+  ``internal`` location at MEDIA_ACCEL_PREFIX) or ``x-sendfile`` (Apache,
+  lighttpd), so no Django worker is tied up streaming images
+* a FileResponse otherwise, answering single ``Range`` requests with 206
+
+Responses carry a strong ETag and are answered with 304 when it matches.
+Content-hashed names (content-addressed storage, image variants) never change,
+so they are cached for a year as ``immutable``; other names for a day. Both
+are ``private`` since the files are per user.
+"""
+
+import mimetypes
+import os
+import re
+import time
+from urllib.parse import quote, urlencode
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse
+from django.urls import reverse
+from django.utils.http import quote_etag
+from rest_framework import permissions, serializers
+from rest_framework.views import APIView
+
+SIGNING_SALT = 'automate.media'
+CONTENT_HASH = re.compile(r'(?<![0-9a-f])([0-9a-f]{64})(?![0-9a-f])')
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = 'private, max-age=86400'
+
+
+def media_token(name, now=None):
+    """Signed token allowing its bearer to read ``name`` until the end of the next window"""
+    window = getattr(settings, 'MEDIA_URL_MAX_AGE', 3600)
+    now = int(time.time() if now is None else now)
+    expires = (now // window + 2) * window
+    return signing.dumps({'name': name, 'expires': expires}, salt=SIGNING_SALT)
+
+
+def token_allows(token, name):
+    """Whether ``token`` is a valid, unexpired token for ``name``"""
+    try:
+        payload = signing.loads(token, salt=SIGNING_SALT)
+    except signing.BadSignature:
+        return False
+    return payload.get('name') == name and payload.get('expires', 0) > time.time()
+
+
+def signed_media_url(name, request=None):
+    """URL of ``name`` carrying a token, absolute when ``request`` is given"""
+    url = reverse('protected-media', args=[name]) + '?' + urlencode({'token': media_token(name)})
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+class ProtectedImageField(serializers.ImageField):
+    """ImageField rendered as a signed URL"""
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        return signed_media_url(value.name, self.context.get('request'))
+
+
+def media_etag(storage, name):
+    """The content hash in the name when there is one, otherwise size and mtime"""
+    match = CONTENT_HASH.search(os.path.basename(name))
+    if match:
+        return quote_etag(match.group(1))
+    modified = storage.get_modified_time(name)
+    return quote_etag(f'{storage.size(name):x}-{int(modified.timestamp() * 1e6):x}')
+
+
+def parse_range(header, size):
+    """
+    ``(start, end)`` (inclusive) of a single ``bytes=`` range, None to send
+    the whole file (no, malformed or multi-part ranges) or False if the
+    range cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[6:].strip().partition('-')
+    try:
+        if not start:
+            # Suffix range: the last ``end`` bytes
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+class RangeFile:
+    """Reads at most ``length`` bytes of ``file`` from ``start`` (for FileResponse)"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class ProtectedMediaView(APIView):
+    # The signed token is the credential
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def perform_content_negotiation(self, request, force=False):
+        # Images are not rendered, so any Accept header is fine
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request, name):
+        if not token_allows(request.query_params.get('token', ''), name):
+            raise Http404
+        # Every upload storage keeps its files under MEDIA_ROOT
+        storage = default_storage
+        try:
+            if not storage.exists(name):
+                raise Http404
+        except SuspiciousFileOperation:
+            raise Http404
+
+        etag = media_etag(storage, name)
+        immutable = CONTENT_HASH.search(os.path.basename(name)) is not None
+        headers = {
+            'ETag': etag,
+            'Cache-Control': IMMUTABLE_CACHE_CONTROL if immutable else DEFAULT_CACHE_CONTROL,
+            'Accept-Ranges': 'bytes',
+        }
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return HttpResponse(status=304, headers=headers)
+
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        sendfile = getattr(settings, 'MEDIA_SENDFILE', '')
+        if sendfile == 'x-accel-redirect':
+            prefix = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/')
+            headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(name)
+            return HttpResponse(content_type=content_type, headers=headers)
+        if sendfile == 'x-sendfile':
+            headers['X-Sendfile'] = storage.path(name)
+            return HttpResponse(content_type=content_type, headers=headers)
+
+        size = storage.size(name)
+        byte_range = None
+        # If-Range: only honour the range when the client's copy is current
+        if request.headers.get('If-Range', etag) == etag:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        if byte_range is False:
+            headers['Content-Range'] = f'bytes */{size}'
+            return HttpResponse(status=416, headers=headers)
+
+        file = storage.open(name, 'rb')
+        if byte_range is None:
+            return FileResponse(file, content_type=content_type, headers=headers)
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), status=206,
+                                content_type=content_type, headers=headers)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        return response
@@ -0,0 +1,80 @@
+"""
+Token buckets.
+
+A bucket holds up to ``capacity`` tokens and refills at ``per_minute``;
+``take()`` returns 0 when the tokens were taken, otherwise the seconds until
+they will be there. LocalTokenBucket is per process; RedisTokenBucket keeps
+its state in Redis, updated atomically by a Lua script, so every gunicorn and
+Celery process shares one bucket. Used by the vision rate limiter
+(ai_assistant/resilience.py) and the reminder email pacing
+(maintenance/outbound.py).
+"""
+
+import threading
+import time
+from asgiref.sync import sync_to_async
+
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class LocalTokenBucket:
+    """In-process token bucket (fallback when Redis is not configured)"""
+
+    def __init__(self, capacity, per_minute):
+        self.capacity = float(capacity)
+        self.rate = per_minute / 60.0
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount=1):
+        """Take ``amount`` tokens; return 0 on success or seconds to wait"""
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    async def atake(self, amount=1):
+        return self.take(amount)
+
+
+class RedisTokenBucket:
+    """Cluster-wide token bucket evaluated atomically by a Lua script"""
+
+    def __init__(self, client, key, capacity, per_minute):
+        self.key = key
+        self.capacity = float(capacity)
+        self.rate = per_minute / 60.0
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, amount=1):
+        amount = min(amount, self.capacity)
+        return float(self.script(keys=[self.key], args=[self.capacity, self.rate, amount]))
+
+    async def atake(self, amount=1):
+        # The script is a network round trip; keep it off the event loop
+        return await sync_to_async(self.take, thread_sensitive=False)(amount)
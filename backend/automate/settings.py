@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+from corsheaders.defaults import default_headers
 import os
 from dotenv import load_dotenv
 import sentry_sdk
@@ -171,6 +172,15 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 # Media files (uploaded files)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Store new uploads under SHA-256 sharded paths, keeping identical files once (automate/storage.py)
+MEDIA_CONTENT_ADDRESSED_DIAGNOSIS_IMAGES = os.getenv('MEDIA_CONTENT_ADDRESSED_DIAGNOSIS_IMAGES', 'False') == 'True'
+MEDIA_CONTENT_ADDRESSED_AVATARS = os.getenv('MEDIA_CONTENT_ADDRESSED_AVATARS', 'False') == 'True'
+# Media is served by automate/media.py to holders of a signed URL, valid for MEDIA_URL_MAX_AGE to
+# twice that many seconds. Let the front proxy send the
+# bytes with 'x-accel-redirect' (nginx, internal location at MEDIA_ACCEL_PREFIX) or 'x-sendfile'
+MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '')
+MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/protected-media/')
+MEDIA_URL_MAX_AGE = int(os.getenv('MEDIA_URL_MAX_AGE', '3600'))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -215,6 +225,9 @@ else:
     CORS_ALLOWED_ORIGINS = cors_origins.split(',') if cors_origins else []
 
 CORS_ALLOW_CREDENTIALS = True
+# Resumable upload protocol headers (ai_assistant/uploads.py)
+CORS_ALLOW_HEADERS = (*default_headers, 'upload-offset', 'upload-checksum')
+CORS_EXPOSE_HEADERS = ['Upload-Offset', 'Upload-Length']
 
 # CSRF trusted origins for production
 if not DEBUG:
@@ -226,6 +239,114 @@ if not DEBUG:
 
 # OpenAI Vision API Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+OPENAI_VISION_MODEL = os.getenv('OPENAI_VISION_MODEL', 'gpt-4o')
+# Shared keep-alive connection pool for upstream AI calls (per process)
+OPENAI_HTTP_POOL_SIZE = int(os.getenv('OPENAI_HTTP_POOL_SIZE', 10))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5))
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', 60))
+# Images are downscaled and re-encoded before being sent upstream
+VISION_IMAGE_MAX_EDGE = int(os.getenv('VISION_IMAGE_MAX_EDGE', 1536))
+VISION_IMAGE_FORMAT = os.getenv('VISION_IMAGE_FORMAT', 'JPEG')  # JPEG or WEBP
+VISION_IMAGE_QUALITY = int(os.getenv('VISION_IMAGE_QUALITY', 85))
+# Resized WebP variants of diagnosis photos and avatars (longest edge in px)
+IMAGE_VARIANT_SIZES = [int(size) for size in os.getenv('IMAGE_VARIANT_SIZES', '128,512,1024').split(',')]
+IMAGE_VARIANT_QUALITY = int(os.getenv('IMAGE_VARIANT_QUALITY', 80))
+# Diagnosis history search index (ai_assistant/search.py); rebuild it after changing the dimensions
+DIAGNOSIS_SEARCH_DIR = os.getenv('DIAGNOSIS_SEARCH_DIR', os.path.join(BASE_DIR, 'search_index'))
+DIAGNOSIS_SEARCH_DIMENSIONS = int(os.getenv('DIAGNOSIS_SEARCH_DIMENSIONS', 1024))
+DIAGNOSIS_SEARCH_MIN_SCORE = float(os.getenv('DIAGNOSIS_SEARCH_MIN_SCORE', 0.1))
+# Batch diagnosis endpoint: max images per request and concurrent upstream calls
+VISION_BATCH_MAX_IMAGES = int(os.getenv('VISION_BATCH_MAX_IMAGES', 10))
+VISION_BATCH_CONCURRENCY = int(os.getenv('VISION_BATCH_CONCURRENCY', 4))
+
+# Cache: Redis (shared across web and Celery processes) when REDIS_URL is set,
+# otherwise in-process LocMem. The 'vision' alias stores AI analyses keyed by
+# image content + prompt so re-uploads skip the paid upstream call.
+REDIS_URL = os.getenv('REDIS_URL', '')
+VISION_CACHE_TTL = int(os.getenv('VISION_CACHE_TTL', 7 * 24 * 3600))
+VISION_CACHE_MAX_ENTRIES = int(os.getenv('VISION_CACHE_MAX_ENTRIES', 1000))
+if REDIS_URL:
+    # Size is bounded by the Redis server's maxmemory (use an LRU eviction policy)
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+        'vision': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'vision',
+            'TIMEOUT': VISION_CACHE_TTL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'vision': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'vision',
+            'TIMEOUT': VISION_CACHE_TTL,
+            'OPTIONS': {'MAX_ENTRIES': VISION_CACHE_MAX_ENTRIES},
+        },
+    }
+
+# Upstream protection for vision calls (see ai_assistant/resilience.py).
+# Size the buckets to the provider account's requests/tokens per minute.
+VISION_RATE_LIMIT_RPM = int(os.getenv('VISION_RATE_LIMIT_RPM', 500))
+VISION_RATE_LIMIT_TPM = int(os.getenv('VISION_RATE_LIMIT_TPM', 30000))
+VISION_RATE_LIMIT_MAX_WAIT = float(os.getenv('VISION_RATE_LIMIT_MAX_WAIT', 30))
+VISION_MAX_RETRIES = int(os.getenv('VISION_MAX_RETRIES', 3))
+VISION_RETRY_BASE_DELAY = float(os.getenv('VISION_RETRY_BASE_DELAY', 1))
+VISION_RETRY_MAX_DELAY = float(os.getenv('VISION_RETRY_MAX_DELAY', 30))
+VISION_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('VISION_CIRCUIT_FAILURE_THRESHOLD', 5))
+VISION_CIRCUIT_RESET_TIMEOUT = int(os.getenv('VISION_CIRCUIT_RESET_TIMEOUT', 60))
+
+# Vision providers in order of preference (openai, local, mock); the first
+# usable one is the primary. 'local' is any OpenAI-compatible endpoint.
+VISION_PROVIDERS = [p for p in os.getenv('VISION_PROVIDERS', 'openai').split(',') if p.strip()]
+VISION_LOCAL_API_BASE = os.getenv('VISION_LOCAL_API_BASE', '')
+VISION_LOCAL_API_KEY = os.getenv('VISION_LOCAL_API_KEY', '')
+VISION_LOCAL_MODEL = os.getenv('VISION_LOCAL_MODEL', 'llava')
+# Set to False if the local endpoint rejects json_schema response_format
+VISION_LOCAL_STRUCTURED_OUTPUT = os.getenv('VISION_LOCAL_STRUCTURED_OUTPUT', 'True') == 'True'
+# Hedged requests: when the primary has not answered within its recent p95
+# latency, the next provider is called too and the first answer wins.
+VISION_HEDGE_ENABLED = os.getenv('VISION_HEDGE_ENABLED', 'True') == 'True'
+VISION_HEDGE_PERCENTILE = float(os.getenv('VISION_HEDGE_PERCENTILE', 95))
+VISION_HEDGE_MIN_SAMPLES = int(os.getenv('VISION_HEDGE_MIN_SAMPLES', 20))
+VISION_HEDGE_DEFAULT_DELAY = float(os.getenv('VISION_HEDGE_DEFAULT_DELAY', 8))
+VISION_HEDGE_MIN_DELAY = float(os.getenv('VISION_HEDGE_MIN_DELAY', 0.5))
+# Single-flight: identical uploads (same user, car and image hash) made while
+# the first is in flight share its diagnosis. Shared across processes via Redis.
+VISION_SINGLEFLIGHT_TTL = int(os.getenv('VISION_SINGLEFLIGHT_TTL', 300))
+VISION_SINGLEFLIGHT_LOCK_TTL = int(os.getenv('VISION_SINGLEFLIGHT_LOCK_TTL', 120))
+# Near-duplicate photos: uploads within this many bits (of a 64-bit dHash) of
+# an earlier diagnosis are reported as similar; within the reuse distance the
+# earlier analysis replaces a new AI call when requested (reuse_similar=true).
+VISION_SIMILAR_MAX_DISTANCE = int(os.getenv('VISION_SIMILAR_MAX_DISTANCE', 8))
+VISION_SIMILAR_REUSE_MAX_DISTANCE = int(os.getenv('VISION_SIMILAR_REUSE_MAX_DISTANCE', 4))
+VISION_REUSE_SIMILAR_ANALYSIS = os.getenv('VISION_REUSE_SIMILAR_ANALYSIS', 'False') == 'True'
+# Re-analysis of stored diagnoses (manage.py reanalyze_diagnoses)
+VISION_REANALYSIS_CHUNK_SIZE = int(os.getenv('VISION_REANALYSIS_CHUNK_SIZE', 50))
+VISION_REANALYSIS_CONCURRENCY = int(os.getenv('VISION_REANALYSIS_CONCURRENCY', 4))
+VISION_REANALYSIS_BATCH_POLL = int(os.getenv('VISION_REANALYSIS_BATCH_POLL', 60))
+
+# Diagnosis retention (0 = keep forever); purged daily by Celery beat and by
+# manage.py purge_diagnoses, in batches of DIAGNOSIS_PURGE_BATCH_SIZE rows.
+DIAGNOSIS_RETENTION_DAYS = int(os.getenv('DIAGNOSIS_RETENTION_DAYS', 0))
+DIAGNOSIS_RETENTION_MAX_PER_USER = int(os.getenv('DIAGNOSIS_RETENTION_MAX_PER_USER', 0))
+DIAGNOSIS_PURGE_BATCH_SIZE = int(os.getenv('DIAGNOSIS_PURGE_BATCH_SIZE', 500))
+DIAGNOSIS_PURGE_FILE_WORKERS = int(os.getenv('DIAGNOSIS_PURGE_FILE_WORKERS', 8))
+
+# Resumable diagnosis uploads: chunks are appended to files in this directory
+# (use a shared volume when several hosts serve the API).
+VISION_UPLOAD_TEMP_DIR = os.getenv('VISION_UPLOAD_TEMP_DIR', os.path.join(BASE_DIR, 'upload_tmp'))
+VISION_UPLOAD_MAX_SIZE = int(os.getenv('VISION_UPLOAD_MAX_SIZE', 20 * 1024 * 1024))
+VISION_UPLOAD_MAX_CHUNK = int(os.getenv('VISION_UPLOAD_MAX_CHUNK', 5 * 1024 * 1024))
+VISION_UPLOAD_TTL = int(os.getenv('VISION_UPLOAD_TTL', 24 * 3600))
 
 # Email Configuration for Reminders
 EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'automate.email_backend.GmailEmailBackend')
@@ -236,6 +357,23 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'noreply@automate.app')
 EMAIL_USE_SSL = False  # Use TLS instead of SSL
+# Reminders sent per SMTP connection (maintenance/dispatch.py)
+REMINDER_DISPATCH_CHUNK_SIZE = int(os.getenv('REMINDER_DISPATCH_CHUNK_SIZE', 200))
+# Seconds a dispatch worker may hold claimed reminders before another worker takes them over
+REMINDER_CLAIM_LEASE = int(os.getenv('REMINDER_CLAIM_LEASE', 600))
+# Hour of the reminder date at which reminders are sent, and max concurrent dispatch tasks
+REMINDER_SEND_HOUR = int(os.getenv('REMINDER_SEND_HOUR', 9))
+REMINDER_DISPATCH_WORKERS = int(os.getenv('REMINDER_DISPATCH_WORKERS', 4))
+# Minutes over which users' reminders are spread after their delivery hour
+REMINDER_DELIVERY_WINDOW = int(os.getenv('REMINDER_DELIVERY_WINDOW', 120))
+# Outbound pacing per mail server: messages per second, burst, per day (0: unlimited)
+REMINDER_EMAIL_RATE = float(os.getenv('REMINDER_EMAIL_RATE', 5))
+REMINDER_EMAIL_BURST = int(os.getenv('REMINDER_EMAIL_BURST', 5))
+REMINDER_EMAIL_DAILY_LIMIT = int(os.getenv('REMINDER_EMAIL_DAILY_LIMIT', 0))
+# Retries of failed reminder emails: attempts, then backoff from base to max seconds
+REMINDER_MAX_ATTEMPTS = int(os.getenv('REMINDER_MAX_ATTEMPTS', 5))
+REMINDER_RETRY_BASE_DELAY = int(os.getenv('REMINDER_RETRY_BASE_DELAY', 60))
+REMINDER_RETRY_MAX_DELAY = int(os.getenv('REMINDER_RETRY_MAX_DELAY', 21600))
 
 # SSL/TLS certificate context for email
 import ssl
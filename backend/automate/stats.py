@@ -0,0 +1,14 @@
+"""
+Small statistics helpers shared by the latency tracking in
+ai_assistant/hedging.py and the usage report in ai_assistant/reports.py.
+"""
+
+import math
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list, or None when empty"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
@@ -0,0 +1,163 @@
+"""
+Content-addressed media storage.
+
+ContentAddressedStorage stores each file under the SHA-256 of its bytes,
+sharded two levels deep below the ``upload_to`` directory::
+
+    diagnosis_images/3f/a2/3fa2…e9.jpg
+
+so no directory grows past a few thousand entries and identical uploads are
+kept once. A ``<file>.refs`` sidecar counts how many saves point at the file;
+delete() decrements it and only removes the file at zero. The sidecar is
+updated under an exclusive flock, and files are first written to a temp file
+in the same directory tree and renamed into place, so readers never see a
+partial file and concurrent workers saving the same bytes are safe.
+
+Files written before opting in (flat names without a sidecar) stay readable
+and count as a single reference.
+
+Fields opt in through the callables below (MEDIA_CONTENT_ADDRESSED_* settings).
+Files whose names are already derived from a hash (image variants) are
+written through ``plain_storage()`` so they keep their names.
+"""
+
+import fcntl
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+
+REFS_SUFFIX = '.refs'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is only known once the content is hashed in _save()
+        return name
+
+    def content_name(self, name, digest):
+        """``<upload dir>/<aa>/<bb>/<sha256><ext>`` for a file saved as ``name``"""
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest[:2], digest[2:4], f'{digest}{extension}')
+
+    def _save(self, name, content):
+        directory = os.path.dirname(self.path(name))
+        os.makedirs(directory, exist_ok=True)
+
+        descriptor, temp_path = tempfile.mkstemp(prefix='.upload-', dir=directory)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(descriptor, 'wb') as temp_file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+
+            name = self.content_name(name, digest.hexdigest())
+            full_path = self.path(name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with self._locked_refs(full_path) as refs:
+                count = self._read_refs(refs, full_path)
+                if count == 0 or not os.path.exists(full_path):
+                    if self.file_permissions_mode is not None:
+                        os.chmod(temp_path, self.file_permissions_mode)
+                    os.replace(temp_path, full_path)
+                self._write_refs(refs, count + 1)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return name.replace('\\', '/')
+
+    def delete(self, name):
+        if not name:
+            raise ValueError("The name must be given to delete().")
+        full_path = self.path(name)
+        if not os.path.exists(full_path):
+            return
+        with self._locked_refs(full_path) as refs:
+            count = self._read_refs(refs, full_path) - 1
+            if count > 0:
+                self._write_refs(refs, count)
+                return
+            try:
+                os.remove(full_path)
+            except FileNotFoundError:
+                pass
+            os.remove(full_path + REFS_SUFFIX)
+
+    def references(self, name):
+        """How many saves currently share ``name`` (0 if it does not exist)"""
+        full_path = self.path(name)
+        if not os.path.exists(full_path):
+            return 0
+        with self._locked_refs(full_path) as refs:
+            return self._read_refs(refs, full_path)
+
+    @contextmanager
+    def _locked_refs(self, full_path):
+        """Open and exclusively lock the sidecar of ``full_path``"""
+        refs_path = full_path + REFS_SUFFIX
+        while True:
+            descriptor = os.open(refs_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(descriptor, fcntl.LOCK_EX)
+            # A concurrent delete() may have unlinked the sidecar while we waited
+            if os.fstat(descriptor).st_nlink:
+                break
+            os.close(descriptor)
+        try:
+            yield descriptor
+        finally:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+            os.close(descriptor)
+
+    def _read_refs(self, descriptor, full_path):
+        os.lseek(descriptor, 0, os.SEEK_SET)
+        value = os.read(descriptor, 32).strip()
+        if value:
+            return int(value)
+        # No count yet: an existing file is a legacy upload (or one whose count was lost)
+        return 1 if os.path.exists(full_path) else 0
+
+    def _write_refs(self, descriptor, count):
+        os.ftruncate(descriptor, 0)
+        os.lseek(descriptor, 0, os.SEEK_SET)
+        os.write(descriptor, str(count).encode())
+        os.fsync(descriptor)
+
+
+def plain_storage(storage):
+    """``storage``, or for content-addressed storage a plain one over the same files"""
+    if isinstance(storage, ContentAddressedStorage):
+        return FileSystemStorage(
+            location=storage.location, base_url=storage.base_url,
+            file_permissions_mode=storage.file_permissions_mode,
+            directory_permissions_mode=storage.directory_permissions_mode,
+        )
+    return storage
+
+
+@lru_cache(maxsize=None)
+def content_addressed_storage():
+    return ContentAddressedStorage()
+
+
+def diagnosis_image_storage():
+    """Storage of DiagnosisRequest.image"""
+    if getattr(settings, 'MEDIA_CONTENT_ADDRESSED_DIAGNOSIS_IMAGES', False):
+        return content_addressed_storage()
+    return default_storage
+
+
+def avatar_storage():
+    """Storage of UserProfile.avatar"""
+    if getattr(settings, 'MEDIA_CONTENT_ADDRESSED_AVATARS', False):
+        return content_addressed_storage()
+    return default_storage
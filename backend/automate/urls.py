@@ -17,11 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
 from rest_framework import routers
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
+from .media import ProtectedMediaView
 
 # API Router
 router = routers.DefaultRouter()
@@ -51,6 +51,8 @@ urlpatterns = [
     path('api/auth/', include('members.urls')),
 ]
 
-# Serve media files in development
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) 
\ No newline at end of file
+# User uploads, with an ownership check (the bytes are sent by the proxy in production)
+if settings.MEDIA_URL.startswith('/'):
+    urlpatterns += [
+        path(f"{settings.MEDIA_URL.strip('/')}/<path:name>", ProtectedMediaView.as_view(), name='protected-media'),
+    ] 
\ No newline at end of file
@@ -0,0 +1,4 @@
+"""
+Benchmark scripts and the local service doubles (fake vision upstream, SMTP
+sink) they share with the test suite. Not imported by the apps.
+"""
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Benchmark: diagnoses in flight per worker, sync (WSGI) vs async (ASGI).
+
+Both sides run the same analysis code against a local fake upstream that
+answers after --upstream-delay seconds:
+
+* sync:  analyze_image() on a pool of --threads threads, i.e. one gunicorn
+         sync/gthread worker (each in-flight call holds a thread)
+* async: aanalyze_image() as coroutines on one event loop, i.e. one
+         gunicorn UvicornWorker (in-flight calls only hold a socket)
+
+Usage:
+    python benchmarks/async_diagnosis_load.py --requests 400 --threads 8
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'automate.settings')
+django.setup()
+
+
+def make_image(index):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), (index % 256, index // 256 % 256, 90)).save(buffer, format='JPEG')
+    return SimpleUploadedFile(f'car{index}.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+
+def report(label, timings, elapsed):
+    timings.sort()
+    p50 = statistics.median(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<34} {len(timings) / elapsed:8.1f} req/s  p50={p50:8.1f} ms  p95={p95:8.1f} ms")
+
+
+def run_sync(service, images, threads):
+    def call(image):
+        start = time.perf_counter()
+        service.analyze_image(image)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        timings = list(executor.map(call, images))
+    report(f'sync worker, {threads} threads', timings, time.perf_counter() - start)
+
+
+async def run_async(service, images, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(image):
+        async with semaphore:
+            start = time.perf_counter()
+            await service.aanalyze_image(image)
+            return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    timings = await asyncio.gather(*[call(image) for image in images])
+    report(f'async worker, {concurrency} in flight', list(timings), time.perf_counter() - start)
+
+
+def main():
+    from django.test import override_settings
+    from ai_assistant.analysis_cache import get_analysis_cache
+    from benchmarks.fake_upstream import FakeVisionUpstream
+    from ai_assistant.openai_vision_service import get_vision_service, reset_vision_service
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8, help='threads of the sync worker')
+    parser.add_argument('--concurrency', type=int, default=400, help='in-flight calls on the event loop')
+    parser.add_argument('--upstream-delay', type=float, default=0.5)
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.WARNING)
+
+    with FakeVisionUpstream(delay=args.upstream_delay) as upstream:
+        with override_settings(
+            OPENAI_API_KEY='sk-bench', OPENAI_API_BASE=upstream.url,
+            VISION_RATE_LIMIT_RPM=10 ** 6, VISION_RATE_LIMIT_TPM=10 ** 9,
+        ):
+            reset_vision_service()
+            service = get_vision_service()
+
+            get_analysis_cache().clear()
+            run_sync(service, [make_image(i) for i in range(args.requests)], args.threads)
+
+            get_analysis_cache().clear()
+            asyncio.run(run_async(service, [make_image(i) for i in range(args.requests)], args.concurrency))
+
+    print(f"\nupstream delay {args.upstream_delay * 1000:.0f} ms, {args.requests} diagnoses per run")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions endpoint.
+
+Used by the test suite and the benchmark scripts so upstream
+behaviour (latency, connection reuse) can be measured without calling the
+real API.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeVisionUpstream:
+    """
+    Threaded HTTP/1.1 server answering ``POST /v1/chat/completions``, plus
+    the Files and Batches endpoints used by batch re-analysis (batches
+    complete after ``batch_polls`` status checks).
+    """
+
+    def __init__(self, content="Fake analysis", delay=0.0, status=200, usage=None, chunk_delay=0.0, responses=None,
+                 batch_polls=0):
+        self.content = content
+        self.delay = delay
+        self.chunk_delay = chunk_delay
+        self.status = status
+        # (status, headers) pairs answered first, one per request, before falling back to ``status``
+        self.responses = list(responses or [])
+        self.usage = usage or {'prompt_tokens': 100, 'completion_tokens': 50, 'total_tokens': 150}
+        self.requests = []
+        self.connections = 0
+        self.batch_polls = batch_polls
+        self.files = {}
+        self.batches = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with upstream._lock:
+                    upstream.connections += 1
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                raw = self.rfile.read(length)
+                if self.path.endswith('/files'):
+                    return self.send_json(200, upstream.create_file(raw))
+                body = json.loads(raw or b'{}')
+                if self.path.endswith('/batches'):
+                    return self.send_json(200, upstream.create_batch(body))
+                with upstream._lock:
+                    upstream.requests.append(body)
+                    status, headers = upstream.responses.pop(0) if upstream.responses else (upstream.status, {})
+                if upstream.delay:
+                    time.sleep(upstream.delay)
+                if body.get('stream') and status == 200:
+                    self.send_stream(body)
+                else:
+                    self.send_json(status, upstream.build_response(body, status), headers)
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if parts[-2:-1] == ['batches']:
+                    self.send_json(200, upstream.poll_batch(parts[-1]))
+                elif parts[-1] == 'content':
+                    data = upstream.files[parts[-2]]
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/jsonl')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self.send_json(404, {'error': {'message': 'Not found'}})
+
+            def send_stream(self, body):
+                # Server-Sent Events in the chat completions streaming format
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for event in upstream.build_stream_events(body):
+                    data = f"data: {event}\n\n".encode('utf-8')
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                    self.wfile.flush()
+                    if upstream.chunk_delay:
+                        time.sleep(upstream.chunk_delay)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # Room for load tests that open hundreds of connections at once
+            request_queue_size = 512
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def build_response(self, body, status=200):
+        if status != 200:
+            return {'error': {'message': f'Fake upstream error {status}'}}
+        return {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'model': body.get('model', 'gpt-4o'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.content},
+                'finish_reason': 'stop',
+            }],
+            'usage': self.usage,
+        }
+
+    def create_file(self, raw):
+        # Keep the JSONL lines of the multipart upload
+        lines = [line for line in raw.splitlines() if line.startswith(b'{"custom_id"')]
+        with self._lock:
+            file_id = f'file-{len(self.files) + 1}'
+            self.files[file_id] = b'\n'.join(lines)
+        return {'id': file_id, 'object': 'file', 'purpose': 'batch'}
+
+    def create_batch(self, body):
+        with self._lock:
+            batch_id = f'batch-{len(self.batches) + 1}'
+            self.batches[batch_id] = {
+                'id': batch_id, 'object': 'batch', 'status': 'in_progress',
+                'input_file_id': body['input_file_id'], 'output_file_id': None, 'polls': 0,
+            }
+            return dict(self.batches[batch_id])
+
+    def poll_batch(self, batch_id):
+        with self._lock:
+            batch = self.batches[batch_id]
+            batch['polls'] += 1
+            if batch['status'] == 'in_progress' and batch['polls'] > self.batch_polls:
+                output = []
+                for line in self.files[batch['input_file_id']].splitlines():
+                    item = json.loads(line)
+                    self.requests.append(item['body'])
+                    output.append(json.dumps({
+                        'id': f"req-{item['custom_id']}",
+                        'custom_id': item['custom_id'],
+                        'response': {'status_code': 200, 'body': self.build_response(item['body'])},
+                        'error': None,
+                    }))
+                output_id = f'file-{len(self.files) + 1}'
+                self.files[output_id] = '\n'.join(output).encode('utf-8')
+                batch.update(status='completed', output_file_id=output_id)
+            return dict(batch)
+
+    def build_stream_events(self, body):
+        words = self.content.split(' ')
+        for index, word in enumerate(words):
+            delta = word if index == 0 else f" {word}"
+            yield json.dumps({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}],
+            })
+        yield json.dumps({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'choices': [], 'usage': self.usage})
+        yield '[DONE]'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
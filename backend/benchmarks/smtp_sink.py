@@ -0,0 +1,109 @@
+"""
+Local SMTP sink.
+
+Used by the test suite to run reminder dispatch against a real SMTP
+conversation (Django's smtp backend, connection reuse, per-recipient
+rejections) without sending mail anywhere.
+"""
+
+import socketserver
+import threading
+import time
+from email import message_from_bytes
+
+
+class SMTPSink:
+    """
+    Threaded SMTP server that accepts every message, except for the
+    recipients in ``reject`` (``{address: (code, text)}``, answered to RCPT;
+    a list of replies is used up one per attempt). Records ``messages`` as
+    ``(time received, recipients, email.message.Message)`` and counts
+    ``connections``.
+    """
+
+    def __init__(self, reject=None):
+        self.reject = dict(reject or {})
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def rejection(self, address):
+        with self._lock:
+            reply = self.reject.get(address.lower())
+            if isinstance(reply, list):
+                return reply.pop(0) if reply else None
+            return reply
+
+    def start(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write(line.encode() + b'\r\n')
+
+            def handle(self):
+                with sink._lock:
+                    sink.connections += 1
+                self.reply('220 localhost SMTP sink')
+                recipients = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command, _, argument = line.decode(errors='replace').strip().partition(' ')
+                    command = command.upper()
+                    if command in ('EHLO', 'HELO'):
+                        self.reply('250 localhost')
+                    elif command == 'MAIL':
+                        recipients = []
+                        self.reply('250 OK')
+                    elif command == 'RCPT':
+                        address = argument.partition(':')[2].strip().strip('<>')
+                        rejection = sink.rejection(address)
+                        if rejection:
+                            self.reply(f'{rejection[0]} {rejection[1]}')
+                        else:
+                            recipients.append(address)
+                            self.reply('250 OK')
+                    elif command == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for raw in self.rfile:
+                            if raw in (b'.\r\n', b'.\n'):
+                                break
+                            data.append(raw[1:] if raw.startswith(b'..') else raw)
+                        with sink._lock:
+                            sink.messages.append((time.monotonic(), recipients, message_from_bytes(b''.join(data))))
+                        self.reply('250 OK queued')
+                    elif command in ('RSET', 'NOOP'):
+                        self.reply('250 OK')
+                    elif command == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Command not implemented')
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-call latency of the vision call with and without the shared
+keep-alive connection pool.
+
+Runs against a local fake upstream (benchmarks/fake_upstream.py), so it only
+measures the TCP connect overhead saved; against api.openai.com the saving also
+includes the TLS handshake and is typically much larger.
+
+Usage:
+    python benchmarks/vision_http_pool.py --calls 200
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'automate.settings')
+django.setup()
+
+
+def run(label, call, calls):
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    p50 = statistics.median(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<28} p50={p50:7.3f} ms  p95={p95:7.3f} ms  mean={statistics.mean(timings):7.3f} ms")
+    return p50
+
+
+def main():
+    import requests
+    from benchmarks.fake_upstream import FakeVisionUpstream
+    from ai_assistant.http_client import get_http_session, get_http_timeout, reset_http_session
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    payload = {'model': 'gpt-4o', 'messages': [{'role': 'user', 'content': 'x' * 4096}], 'max_tokens': 1500}
+
+    with FakeVisionUpstream() as upstream:
+        url = f"{upstream.url}/chat/completions"
+
+        # Previous behaviour: module-level requests.post opens a new connection every call
+        upstream.connections = 0
+        fresh = run('requests.post (no pool)', lambda: requests.post(url, json=payload, timeout=60), args.calls)
+        fresh_connections = upstream.connections
+
+        reset_http_session()
+        upstream.connections = 0
+        pooled = run('shared session (pooled)', lambda: get_http_session().post(url, json=payload, timeout=get_http_timeout()), args.calls)
+        pooled_connections = upstream.connections
+
+    print(f"\nconnections opened: no pool={fresh_connections}, pooled={pooled_connections}")
+    print(f"p50 saved per call: {fresh - pooled:.3f} ms ({(1 - pooled / fresh) * 100:.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
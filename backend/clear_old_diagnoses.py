@@ -14,6 +14,7 @@ def clear_old_diagnoses():
     """Clear all old diagnoses from the database"""
     
     from ai_assistant.models import DiagnosisRequest
+    from ai_assistant.retention import purge
     
     print("🗑️ **Clearing old diagnoses from database...**")
     
@@ -22,9 +23,9 @@ def clear_old_diagnoses():
     print(f"📊 Found {old_count} existing diagnoses")
     
     if old_count > 0:
-        # Delete all diagnoses
-        DiagnosisRequest.objects.all().delete()
-        print(f"✅ Deleted {old_count} old diagnoses")
+        # Delete all diagnoses in small batches, removing their image files too
+        totals = purge(DiagnosisRequest.objects.all())
+        print(f"✅ Deleted {totals['diagnoses']} old diagnoses and {totals['files']} image files")
         print("🎉 Database cleared! Only new Google Vision results will show.")
     else:
         print("✅ No old diagnoses found - database is already clean!")
@@ -0,0 +1,231 @@
+"""
+Reminder email dispatch shared by the ``send_pending_reminders`` task, the
+``send_maintenance_reminders`` command and the ``send-reminders`` endpoint.
+
+Any number of workers can dispatch at once. Each claims a chunk of due
+reminders with ``SELECT ... FOR UPDATE SKIP LOCKED``, moving them to
+``sending`` under its own token with a lease of REMINDER_CLAIM_LEASE seconds.
+Rows another worker has locked or claimed are skipped, so no reminder is
+emailed twice. If a worker dies mid-chunk its lease expires and the rows
+become claimable again.
+
+A claimed chunk is loaded with its user, event and car joined in, sent over
+a single SMTP connection (one login) and written back with one bulk_update.
+Users with the ``reminder_digest`` preference get all their due reminders in
+one email: their other claimable reminders are claimed along with the chunk.
+Every message is rendered from the maintenance/reminder_email.txt template.
+
+Sending is paced by maintenance/outbound.py: each message waits for a slot in
+the per-second bucket and counts against the daily budget. Once the budget is
+spent the rest goes back to pending for tomorrow, and claims never take more
+than can be sent within half a lease. A failed reminder is retried at
+``send_at`` (pushed back with exponential backoff) until REMINDER_MAX_ATTEMPTS
+or a permanent SMTP error, then marked ``failed`` with its ``last_error``.
+"""
+
+import logging
+import time
+import uuid
+from functools import lru_cache
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.template.loader import get_template
+from django.utils import timezone
+from . import outbound
+from .models import Reminder
+
+logger = logging.getLogger(__name__)
+
+# Fields written back after a chunk is sent
+DISPATCH_FIELDS = [
+    'status', 'notification_sent_at', 'claimed_by', 'lease_expires_at', 'attempts', 'last_error', 'send_at',
+]
+
+
+def due_reminders(now=None):
+    """Reminders whose send time has come (see maintenance/scheduler.py)"""
+    return Reminder.objects.filter(send_at__lte=now or timezone.now())
+
+
+def claimable():
+    """Pending reminders, and ones whose worker let the lease run out"""
+    return Q(status='pending') | Q(status='sending', lease_expires_at__lt=timezone.now())
+
+
+def claim_reminders(queryset, limit, token, after_id=0):
+    """
+    Move up to ``limit`` (None: all) claimable reminders of ``queryset`` (ids
+    above ``after_id``) to ``sending`` under ``token`` and return them.
+    """
+    lease = timedelta(seconds=getattr(settings, 'REMINDER_CLAIM_LEASE', 600))
+    with transaction.atomic():
+        ids = list(
+            queryset.filter(claimable(), id__gt=after_id)
+            .select_for_update(skip_locked=True)
+            .order_by('id').values_list('id', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        # Filtering again keeps the claim exclusive on backends without row locks (SQLite)
+        Reminder.objects.filter(claimable(), id__in=ids).update(
+            status='sending', claimed_by=token, lease_expires_at=timezone.now() + lease
+        )
+    return list(
+        Reminder.objects.filter(claimed_by=token, status='sending', id__in=ids)
+        .select_related('user__profile', 'maintenance_event__car').order_by('id')
+    )
+
+
+@lru_cache(maxsize=None)
+def reminder_template():
+    # Compiled once per process and shared by every sender
+    return get_template('maintenance/reminder_email.txt')
+
+
+def reminder_message(reminders, connection=None):
+    """One email for ``reminders`` (all of the same user): a single reminder or a digest"""
+    user = reminders[0].user
+    if len(reminders) == 1:
+        subject = f"Maintenance Reminder: {reminders[0].maintenance_event.get_maintenance_type_display()}"
+    else:
+        subject = f"Maintenance Reminders: {len(reminders)} services due"
+    body = reminder_template().render({'user': user, 'reminders': reminders})
+    return EmailMessage(
+        subject=subject,
+        body=body,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[user.email],
+        connection=connection,
+    )
+
+
+def wants_digest(user):
+    profile = getattr(user, 'profile', None)
+    return bool(profile and profile.reminder_digest)
+
+
+def claim_limit(chunk_size):
+    """How many reminders to claim next: None once today's budget is spent"""
+    remaining = outbound.daily_remaining()
+    if remaining == 0:
+        return None
+    # Whatever is claimed must go out well before the lease runs out
+    lease = getattr(settings, 'REMINDER_CLAIM_LEASE', 600)
+    paced = max(int(getattr(settings, 'REMINDER_EMAIL_RATE', 5) * lease / 2), 1)
+    return min(chunk_size, paced, chunk_size if remaining is None else remaining)
+
+
+def dispatch_reminders(queryset=None, chunk_size=None, sleep=time.sleep, heartbeat=None):
+    """
+    Email every claimable reminder in ``queryset`` (default: due_reminders()).
+
+    Reminders whose user has no email address are marked completed; failed
+    sends are rescheduled for a retry or marked failed. Returns the
+    sent/skipped/failed/deferred reminder counts, the number of ``emails``
+    and ``failures`` as ``[(reminder id, error)]``. ``heartbeat()`` is called
+    before every chunk.
+    """
+    queryset = due_reminders() if queryset is None else queryset
+    chunk_size = chunk_size or getattr(settings, 'REMINDER_DISPATCH_CHUNK_SIZE', 200)
+    token = uuid.uuid4().hex
+    result = {'sent': 0, 'skipped': 0, 'failed': 0, 'deferred': 0, 'emails': 0, 'failures': []}
+
+    last_id = 0
+    while True:
+        if heartbeat is not None:
+            heartbeat()
+        limit = claim_limit(chunk_size)
+        if limit is None:
+            logger.info("Daily email limit reached, leaving the remaining reminders for tomorrow")
+            break
+        chunk = claim_reminders(queryset, limit, token, after_id=last_id)
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+        if not _send_chunk(chunk, result, queryset, token, sleep):
+            break
+
+    logger.info(
+        "Reminder dispatch: %d sent, %d skipped, %d failed, %d deferred",
+        result['sent'], result['skipped'], result['failed'], result['deferred'],
+    )
+    return result
+
+
+def _record_failure(reminders, error, result):
+    permanent = outbound.is_permanent(error)
+    max_attempts = getattr(settings, 'REMINDER_MAX_ATTEMPTS', 5)
+    for reminder in reminders:
+        reminder.attempts += 1
+        reminder.last_error = str(error)[:1000]
+        if permanent or reminder.attempts >= max_attempts:
+            reminder.status = 'failed'
+        else:
+            reminder.send_at = timezone.now() + timedelta(seconds=outbound.retry_delay(reminder.attempts))
+    result['failed'] += len(reminders)
+    result['failures'] += [(reminder.id, str(error)) for reminder in reminders]
+
+
+def _send_chunk(chunk, result, queryset, token, sleep):
+    """Send one claimed chunk; False once the daily budget ran out"""
+    digest_users = {reminder.user_id for reminder in chunk if wants_digest(reminder.user)}
+    if digest_users:
+        # Their reminders past this chunk go into the same digest
+        chunk += claim_reminders(queryset.filter(user_id__in=digest_users), None, token)
+
+    groups = {}
+    for reminder in chunk:
+        reminder.claimed_by = ''
+        reminder.lease_expires_at = None
+        # Until sent, a reminder goes back to pending
+        reminder.status = 'pending'
+        if not reminder.user.email:
+            reminder.status = 'completed'
+            result['skipped'] += 1
+        elif reminder.user_id in digest_users:
+            groups.setdefault(reminder.user_id, []).append(reminder)
+        else:
+            groups[('reminder', reminder.id)] = [reminder]
+
+    within_budget = True
+    if groups:
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as e:
+            logger.error("Cannot connect to the mail server: %s", e)
+            for reminders in groups.values():
+                _record_failure(reminders, e, result)
+            groups = {}
+        # One login for the chunk; messages go one by one so a rejected
+        # address does not abort the rest
+        try:
+            for reminders in groups.values():
+                if not within_budget or not outbound.reserve_daily():
+                    # Left pending, without counting an attempt
+                    within_budget = False
+                    result['deferred'] += len(reminders)
+                    continue
+                outbound.wait_for_slot(sleep)
+                try:
+                    connection.send_messages([reminder_message(reminders, connection)])
+                except Exception as e:
+                    logger.warning("Failed to send reminders %s: %s", [reminder.id for reminder in reminders], e)
+                    _record_failure(reminders, e, result)
+                    continue
+                sent_at = timezone.now()
+                for reminder in reminders:
+                    reminder.status = 'sent'
+                    reminder.notification_sent_at = sent_at
+                    reminder.attempts += 1
+                    reminder.last_error = ''
+                result['sent'] += len(reminders)
+                result['emails'] += 1
+        finally:
+            connection.close()
+
+    Reminder.objects.bulk_update(chunk, DISPATCH_FIELDS)
+    return within_budget
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:48
+
+from datetime import datetime, time
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_send_at(apps, schema_editor):
+    # Existing reminders join the sweep at the hour the old ETA tasks used
+    # (a frozen copy of reminder_send_at as it was when this migration was written)
+    Reminder = apps.get_model('maintenance', 'Reminder')
+    send_time = time(hour=getattr(settings, 'REMINDER_SEND_HOUR', 9))
+    batch = []
+    for reminder in Reminder.objects.filter(send_at__isnull=True).only('id', 'reminder_date').iterator(chunk_size=500):
+        reminder.send_at = timezone.make_aware(datetime.combine(reminder.reminder_date, send_time))
+        batch.append(reminder)
+        if len(batch) >= 500:
+            Reminder.objects.bulk_update(batch, ['send_at'])
+            batch = []
+    Reminder.objects.bulk_update(batch, ['send_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maintenance', '0005_reminder_claim_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reminder',
+            name='send_at',
+            field=models.DateTimeField(blank=True, help_text='When the reminder is due to be emailed', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(fields=['status', 'send_at'], name='reminder_status_send_at'),
+        ),
+        migrations.RunPython(backfill_send_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('maintenance', '0006_reminder_send_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reminder',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Delivery attempts so far'),
+        ),
+        migrations.AddField(
+            model_name='reminder',
+            name='last_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='reminder',
+            name='send_at',
+            field=models.DateTimeField(blank=True, help_text='When the reminder is due to be emailed (or retried)', null=True),
+        ),
+        migrations.AlterField(
+            model_name='reminder',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
@@ -1,9 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import User
 from cars.models import Car
-from datetime import timedelta
-from celery import current_app
+import zlib
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils import timezone
+from members.models import UserProfile
 
 class MaintenanceEvent(models.Model):
     MAINTENANCE_TYPES = [
@@ -23,11 +28,42 @@ class MaintenanceEvent(models.Model):
         return f"{self.get_maintenance_type_display()} for {self.car} at {self.mileage} miles on {self.date}"
 
 
+def reminder_send_at(reminder_date, user=None):
+    """
+    The time a reminder for ``reminder_date`` goes out: the user's
+    ``reminder_hour`` (default REMINDER_SEND_HOUR) in their time zone, plus a
+    per-user offset that spreads users over REMINDER_DELIVERY_WINDOW minutes
+    so the mail server never gets everyone at once.
+    """
+    if reminder_date is None:
+        return None
+    profile = getattr(user, 'profile', None) if user is not None else None
+    hour = getattr(settings, 'REMINDER_SEND_HOUR', 9)
+    zone = timezone.get_current_timezone()
+    if profile is not None:
+        if profile.reminder_hour is not None:
+            hour = profile.reminder_hour
+        if profile.time_zone:
+            try:
+                zone = ZoneInfo(profile.time_zone)
+            except (ValueError, ZoneInfoNotFoundError):
+                pass
+    send_at = timezone.make_aware(datetime.combine(reminder_date, time(hour=hour)), zone)
+
+    window = getattr(settings, 'REMINDER_DELIVERY_WINDOW', 120)
+    if user is not None and window > 0:
+        # Stable per user, so a user's reminders (and digest) stay together
+        send_at += timedelta(minutes=zlib.crc32(str(user.pk).encode()) % window)
+    return send_at
+
+
 class Reminder(models.Model):
     REMINDER_STATUS = [
         ("pending", "Pending"),
+        ("sending", "Sending"),
         ("sent", "Sent"),
         ("completed", "Completed"),
+        ("failed", "Failed"),
     ]
     
     maintenance_event = models.OneToOneField(MaintenanceEvent, on_delete=models.CASCADE, related_name='reminder')
@@ -36,24 +72,53 @@ class Reminder(models.Model):
     notification_sent_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reminders')
+    # Set while a dispatch worker holds the reminder in 'sending' (see maintenance/dispatch.py)
+    claimed_by = models.CharField(max_length=32, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    send_at = models.DateTimeField(null=True, blank=True, help_text="When the reminder is due to be emailed (or retried)")
+    attempts = models.PositiveSmallIntegerField(default=0, help_text="Delivery attempts so far")
+    last_error = models.TextField(blank=True)
     
     class Meta:
         ordering = ['reminder_date']
+        indexes = [
+            # The sweeper's lookup: due reminders in a given state
+            models.Index(fields=['status', 'send_at'], name='reminder_status_send_at'),
+        ]
     
     def __str__(self):
         return f"Reminder for {self.maintenance_event} on {self.reminder_date}"
     
-    def schedule_email(self):
-        """Schedule the email to be sent on the reminder date using Celery"""
-        from maintenance.tasks import send_reminder_email
-        
-        # Calculate delay until reminder date at 9 AM
-        reminder_datetime = timezone.make_aware(
-            timezone.datetime.combine(self.reminder_date, timezone.datetime.min.time())
-        ).replace(hour=9, minute=0, second=0)
-        
-        # Schedule the task
-        send_reminder_email.apply_async(
-            args=[self.id],
-            eta=reminder_datetime
-        ) 
\ No newline at end of file
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._scheduled_date = instance.__dict__.get('reminder_date')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Rescheduling moves the reminder to its new time bucket; the sweeper
+        # picks it up from there (see maintenance/scheduler.py). Other saves
+        # keep send_at, which may hold a retry time.
+        update_fields = kwargs.get('update_fields')
+        rescheduled = self.send_at is None or self.reminder_date != getattr(self, '_scheduled_date', None)
+        if update_fields is None and rescheduled:
+            self.send_at = reminder_send_at(self.reminder_date, self.user)
+        elif update_fields is not None and 'reminder_date' in update_fields:
+            self.send_at = reminder_send_at(self.reminder_date, self.user)
+            kwargs['update_fields'] = {*update_fields, 'send_at'}
+        super().save(*args, **kwargs)
+        self._scheduled_date = self.reminder_date
+
+
+@receiver(post_save, sender=UserProfile)
+def reschedule_reminders(sender, instance, **kwargs):
+    """Move pending reminders when the user changes their delivery hour or time zone"""
+    pending = list(Reminder.objects.filter(user_id=instance.user_id, status='pending', attempts=0).select_related('user__profile'))
+    changed = []
+    for reminder in pending:
+        send_at = reminder_send_at(reminder.reminder_date, reminder.user)
+        if send_at != reminder.send_at:
+            reminder.send_at = send_at
+            changed.append(reminder)
+    if changed:
+        Reminder.objects.bulk_update(changed, ['send_at'])
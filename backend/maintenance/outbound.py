@@ -0,0 +1,111 @@
+"""
+Outbound reminder email pacing.
+
+Mail providers throttle senders by messages per second and per day, and
+answer bursts past those limits with 4xx deferrals or temporary blocks. The
+dispatcher in maintenance/dispatch.py therefore takes a slot from a token
+bucket of REMINDER_EMAIL_RATE messages per second (bursts of
+REMINDER_EMAIL_BURST) before every message, and stops for the day once
+REMINDER_EMAIL_DAILY_LIMIT messages have gone out (0: no daily limit).
+
+Both limits are kept per mail server (EMAIL_HOST), shared by every worker:
+the bucket through Redis when REDIS_URL is set (see automate/rate_limit.py),
+the daily count in the default cache.
+
+Failed sends are retried with exponential backoff and jitter
+(``retry_delay``) until REMINDER_MAX_ATTEMPTS; permanent SMTP errors (5xx)
+are not retried.
+"""
+
+import random
+import smtplib
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from automate.rate_limit import LocalTokenBucket, RedisTokenBucket
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def provider():
+    return getattr(settings, 'EMAIL_HOST', '') or 'default'
+
+
+def send_bucket():
+    """Messages-per-second bucket of the current mail server"""
+    name = provider()
+    bucket = _buckets.get(name)
+    if bucket is not None:
+        return bucket
+
+    with _buckets_lock:
+        if name not in _buckets:
+            per_minute = getattr(settings, 'REMINDER_EMAIL_RATE', 5) * 60
+            burst = getattr(settings, 'REMINDER_EMAIL_BURST', 5)
+            redis_url = getattr(settings, 'REDIS_URL', '')
+            if redis_url:
+                import redis
+                client = redis.Redis.from_url(redis_url)
+                _buckets[name] = RedisTokenBucket(client, f'reminder-email:{name}:rate', burst, per_minute)
+            else:
+                _buckets[name] = LocalTokenBucket(burst, per_minute)
+    return _buckets[name]
+
+
+def reset_send_limiter():
+    with _buckets_lock:
+        _buckets.clear()
+
+
+def wait_for_slot(sleep):
+    """Block (through ``sleep``) until the bucket allows one more message"""
+    while True:
+        wait = send_bucket().take()
+        if not wait:
+            return
+        sleep(wait)
+
+
+def _daily_key():
+    return f'reminder-email:{provider()}:sent:{timezone.now().date().isoformat()}'
+
+
+def daily_remaining():
+    """Messages left in today's budget (None when there is no daily limit)"""
+    limit = getattr(settings, 'REMINDER_EMAIL_DAILY_LIMIT', 0)
+    if not limit:
+        return None
+    return max(limit - (cache.get(_daily_key()) or 0), 0)
+
+
+def reserve_daily():
+    """Count one message against today's budget; False once it is used up"""
+    limit = getattr(settings, 'REMINDER_EMAIL_DAILY_LIMIT', 0)
+    if not limit:
+        return True
+    key = _daily_key()
+    cache.add(key, 0, timeout=2 * 24 * 3600)
+    try:
+        return cache.incr(key) <= limit
+    except ValueError:
+        # Expired between add() and incr()
+        cache.add(key, 1, timeout=2 * 24 * 3600)
+        return True
+
+
+def retry_delay(attempts):
+    """Seconds before the next try after ``attempts`` failures, jittered so retries spread out"""
+    base = getattr(settings, 'REMINDER_RETRY_BASE_DELAY', 60)
+    ceiling = min(getattr(settings, 'REMINDER_RETRY_MAX_DELAY', 6 * 3600), base * 2 ** (attempts - 1))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def is_permanent(error):
+    """Whether retrying ``error`` cannot help (5xx replies from the server)"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
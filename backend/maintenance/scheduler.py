@@ -0,0 +1,91 @@
+"""
+Reminder scheduling.
+
+Each reminder stores the moment it is due in ``send_at`` (REMINDER_SEND_HOUR
+on its ``reminder_date``), indexed together with its status, so the database
+holds the schedule instead of broker ETA tasks parked in worker memory.
+Editing the date moves the reminder to its new slot, and deleting or
+completing it simply takes it out of the sweep, so nothing is left to revoke.
+
+The ``sweep_due_reminders`` task runs every minute from Celery Beat. It looks
+up how many claimable reminders are due and enqueues just enough
+``send_pending_reminders`` tasks to send them. Those workers split the due
+reminders between them through the claims in maintenance/dispatch.py.
+Nothing is enqueued once the day's email budget (maintenance/outbound.py) is
+spent.
+
+A paced backlog can take longer than a minute, so every dispatch task holds
+one of REMINDER_DISPATCH_WORKERS slots in the cache while it runs (renewed
+per chunk, expiring with the claim lease if the worker dies). The sweep only
+enqueues as many tasks as there are free slots, and a task that finds none
+exits at once, so dispatchers never pile up behind the rate limit.
+
+Reminders failing with a temporary error are pushed back by moving their
+``send_at``, so retries come round through the same sweep.
+"""
+
+import logging
+import math
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from . import outbound
+from .dispatch import claimable, due_reminders
+
+logger = logging.getLogger(__name__)
+
+
+def due_count():
+    return due_reminders().filter(claimable()).count()
+
+
+def slot_keys():
+    return [f'reminder-dispatch:slot:{slot}' for slot in range(getattr(settings, 'REMINDER_DISPATCH_WORKERS', 4))]
+
+
+def free_slots():
+    keys = slot_keys()
+    # get_many() leaves out the keys of free (expired or released) slots
+    return len(keys) - len(cache.get_many(keys))
+
+
+@contextmanager
+def dispatch_slot():
+    """
+    Hold a free dispatcher slot; yields a callable that renews it (call it
+    per chunk), or None when every slot is taken.
+    """
+    lease = getattr(settings, 'REMINDER_CLAIM_LEASE', 600)
+    token = uuid.uuid4().hex
+    key = next((key for key in slot_keys() if cache.add(key, token, timeout=lease)), None)
+    if key is None:
+        yield None
+        return
+
+    def renew():
+        if cache.get(key) == token:
+            cache.touch(key, lease)
+
+    try:
+        yield renew
+    finally:
+        # Only free the slot if it did not expire and go to another worker
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def sweep(enqueue):
+    """Call ``enqueue()`` once per dispatch worker needed for the due reminders; returns the count due"""
+    due = due_count()
+    if not due:
+        return 0
+    if outbound.daily_remaining() == 0:
+        logger.info("%d reminders due, but the daily email limit is reached", due)
+        return due
+    chunk_size = getattr(settings, 'REMINDER_DISPATCH_CHUNK_SIZE', 200)
+    workers = min(math.ceil(due / chunk_size), free_slots())
+    for _ in range(workers):
+        enqueue()
+    logger.info("%d reminders due, dispatching with %d more workers", due, workers)
+    return due
@@ -1,120 +1,46 @@
 from celery import shared_task
-from django.utils import timezone
-from django.core.mail import send_mail
-from django.conf import settings
+from . import scheduler
+from .dispatch import dispatch_reminders, due_reminders
 from .models import Reminder
 
 
 @shared_task
 def send_reminder_email(reminder_id):
     """
-    Send a single reminder email for a specific maintenance event.
-    This task is scheduled individually when a reminder is created.
+    Send a single reminder email if it is due. Reminders are now sent by the
+    sweeper; this task only serves ETA tasks queued before it existed, which
+    may refer to reminders that were since moved or deleted.
     """
-    try:
-        reminder = Reminder.objects.get(id=reminder_id)
-        user_email = reminder.user.email
-        
-        if not user_email:
-            reminder.status = 'completed'
-            reminder.save()
-            return {'status': 'skipped', 'reason': 'No email address'}
-
-        subject = f"Maintenance Reminder: {reminder.maintenance_event.get_maintenance_type_display()}"
-        message = f"""
-Hello {reminder.user.first_name or reminder.user.username},
-
-This is a reminder for your car maintenance:
-
-Car: {reminder.maintenance_event.car}
-Service Type: {reminder.maintenance_event.get_maintenance_type_display()}
-Scheduled Date: {reminder.maintenance_event.date}
-Notes: {reminder.maintenance_event.notes or 'No additional notes'}
-
-Please schedule your appointment soon.
+    if not Reminder.objects.filter(id=reminder_id).exists():
+        return {'status': 'failed', 'reason': 'Reminder not found'}
 
-Best regards,
-AutoMate Team
-        """
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [user_email],
-            fail_silently=False,
-        )
-        
-        reminder.status = 'sent'
-        reminder.notification_sent_at = timezone.now()
-        reminder.save()
-        
+    result = dispatch_reminders(due_reminders().filter(id=reminder_id))
+    if result['failures']:
+        return {'status': 'failed', 'reason': result['failures'][0][1]}
+    if result['skipped']:
+        return {'status': 'skipped', 'reason': 'No email address'}
+    if result['sent']:
         return {'status': 'sent', 'reminder_id': reminder_id}
-
-    except Reminder.DoesNotExist:
-        return {'status': 'failed', 'reason': 'Reminder not found'}
-    except Exception as e:
-        return {'status': 'failed', 'reason': str(e)}
+    return {'status': 'skipped', 'reason': 'Not due or already sent'}
 
 
 @shared_task
 def send_pending_reminders():
     """
-    Send email reminders for maintenance events scheduled for today or overdue.
-    This task is scheduled to run daily via Celery Beat.
+    Send the reminders that are due. Enqueued by sweep_due_reminders (several
+    at once for a large backlog; they split it through their claims).
     """
-    today = timezone.now().date()
-    pending_reminders = Reminder.objects.filter(
-        reminder_date__lte=today,
-        status='pending'
-    )
-    
-    sent_count = 0
-    failed_count = 0
-
-    for reminder in pending_reminders:
-        try:
-            user_email = reminder.user.email
-            if not user_email:
-                reminder.status = 'completed'
-                reminder.save()
-                continue
-
-            subject = f"Maintenance Reminder: {reminder.maintenance_event.get_maintenance_type_display()}"
-            message = f"""
-Hello {reminder.user.first_name or reminder.user.username},
-
-This is a reminder for your car maintenance:
-
-Car: {reminder.maintenance_event.car}
-Service Type: {reminder.maintenance_event.get_maintenance_type_display()}
-Scheduled Date: {reminder.maintenance_event.date}
-Notes: {reminder.maintenance_event.notes or 'No additional notes'}
-
-Please schedule your appointment soon.
-
-Best regards,
-AutoMate Team
-            """
-            
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [user_email],
-                fail_silently=False,
-            )
-            
-            reminder.status = 'sent'
-            reminder.notification_sent_at = timezone.now()
-            reminder.save()
-            sent_count += 1
-
-        except Exception as e:
-            failed_count += 1
-            print(f'Failed to send reminder {reminder.id}: {str(e)}')
-
+    with scheduler.dispatch_slot() as renew:
+        if renew is None:
+            return {'status': 'skipped', 'reason': 'All dispatcher slots are busy'}
+        result = dispatch_reminders(heartbeat=renew)
     return {
-        'sent': sent_count,
-        'failed': failed_count,
+        'sent': result['sent'],
+        'failed': result['failed'],
     }
+
+
+@shared_task
+def sweep_due_reminders():
+    """Every minute: enqueue dispatch workers for the reminders that are due"""
+    return scheduler.sweep(send_pending_reminders.delay)
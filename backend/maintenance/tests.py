@@ -1,9 +1,22 @@
+from datetime import timedelta
+from unittest import mock
+from zoneinfo import ZoneInfo
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
+from benchmarks.smtp_sink import SMTPSink
 from cars.models import Car
-from .models import MaintenanceEvent
+from .dispatch import claim_reminders, dispatch_reminders, due_reminders
+from . import scheduler
+from .tasks import send_pending_reminders, sweep_due_reminders
+from .models import MaintenanceEvent, Reminder
+from .outbound import reset_send_limiter
 
 class TestMaintenanceAPI(APITestCase):
     def setUp(self):
@@ -33,3 +46,209 @@ class TestMaintenanceAPI(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response['Content-Type'].startswith('text/csv'))
+
+
+class TestReminderDispatch(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='driver', password='pass12345', email='driver@example.com')
+        self.no_email = User.objects.create_user(username='anon', password='pass12345')
+        self.car = Car.objects.create(user=self.user, make='Mazda', model='3', year=2018, vin='VIN456', owner='Driver')
+        today = timezone.now().date()
+        self.reminders = [
+            self.make_reminder(self.user, today - timedelta(days=2)),
+            self.make_reminder(self.user, today - timedelta(days=1)),
+            self.make_reminder(self.no_email, today - timedelta(days=1)),
+            self.make_reminder(self.user, today + timedelta(days=3)),
+        ]
+
+    def make_reminder(self, user, reminder_date):
+        event = MaintenanceEvent.objects.create(
+            user=user, car=self.car, maintenance_type='oil_change', date=reminder_date, mileage=30000
+        )
+        return Reminder.objects.create(user=user, maintenance_event=event, reminder_date=reminder_date)
+
+    def test_due_reminders_sent_in_chunks_over_one_connection_each(self):
+        with mock.patch('maintenance.dispatch.get_connection', wraps=get_connection) as connect:
+            # Per chunk: claim (select + update, in a savepoint), joined load, bulk_update;
+            # then the empty claim
+            with self.assertNumQueries(15):
+                result = dispatch_reminders(chunk_size=2)
+
+        self.assertEqual((result['sent'], result['skipped'], result['failed']), (2, 1, 0))
+        self.assertEqual(connect.call_count, 1)  # the second chunk has nobody to email
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('Oil Change', mail.outbox[0].subject)
+        statuses = dict(Reminder.objects.values_list('id', 'status'))
+        self.assertEqual([statuses[reminder.id] for reminder in self.reminders], ['sent', 'sent', 'completed', 'pending'])
+        self.assertEqual(dispatch_reminders()['sent'], 0)
+
+    def test_failed_send_stays_pending(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=[1, OSError('rejected')]):
+            result = dispatch_reminders()
+        self.assertEqual(result['failures'], [(self.reminders[1].id, 'rejected')])
+        self.assertEqual(Reminder.objects.get(id=self.reminders[1].id).status, 'pending')
+
+    def test_claimed_reminders_are_skipped_until_the_lease_expires(self):
+        claimed = claim_reminders(due_reminders(), 10, 'worker-a')
+        self.assertEqual([reminder.id for reminder in claimed], [reminder.id for reminder in self.reminders[:3]])
+        self.assertEqual({reminder.status for reminder in claimed}, {'sending'})
+
+        # A second worker finds nothing to send while worker-a holds the lease
+        self.assertEqual(dispatch_reminders()['sent'], 0)
+        self.assertEqual(claim_reminders(due_reminders(), 10, 'worker-b'), [])
+
+        # Worker-a died: once the lease runs out the reminders are recovered
+        Reminder.objects.filter(claimed_by='worker-a').update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        result = dispatch_reminders()
+        self.assertEqual((result['sent'], result['skipped']), (2, 1))
+        self.assertFalse(Reminder.objects.filter(status='sending').exists())
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(REMINDER_DISPATCH_CHUNK_SIZE=2, REMINDER_SEND_HOUR=9, REMINDER_DELIVERY_WINDOW=0)
+    def test_sweeper_enqueues_only_what_is_due(self):
+        future = self.reminders[3]
+        self.assertEqual(future.send_at.date(), future.reminder_date)
+        self.assertEqual(timezone.localtime(future.send_at).hour, 9)
+
+        with mock.patch('maintenance.tasks.send_pending_reminders.delay') as delay:
+            self.assertEqual(sweep_due_reminders(), 3)
+        self.assertEqual(delay.call_count, 2)
+
+        # Rescheduling moves the reminder into the due window; deleting takes it out
+        future.reminder_date = timezone.now().date() - timedelta(days=1)
+        future.save(update_fields=['reminder_date'])
+        self.reminders[0].delete()
+        self.assertEqual(due_reminders().filter(status='pending').count(), 3)
+
+        dispatch_reminders()
+        with mock.patch('maintenance.tasks.send_pending_reminders.delay') as delay:
+            self.assertEqual(sweep_due_reminders(), 0)
+        delay.assert_not_called()
+
+    def test_send_reminders_endpoint_queues_the_dispatch(self):
+        self.client.force_login(self.user)
+        with mock.patch('maintenance.views.send_pending_reminders.delay') as delay:
+            response = self.client.post(reverse('send-reminders'))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.json()['due'], 3)
+        delay.assert_called_once_with()
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(REMINDER_DISPATCH_CHUNK_SIZE=1, REMINDER_DISPATCH_WORKERS=2)
+    def test_sweeper_counts_running_dispatchers(self):
+        cache.clear()
+        with scheduler.dispatch_slot() as renew:
+            self.assertIsNotNone(renew)
+            with mock.patch('maintenance.tasks.send_pending_reminders.delay') as delay:
+                sweep_due_reminders()
+            # One dispatcher is still running, so only one more is enqueued
+            self.assertEqual(delay.call_count, 1)
+
+            with scheduler.dispatch_slot():
+                # Every slot is taken: a task started now exits without sending
+                self.assertEqual(send_pending_reminders()['status'], 'skipped')
+                with mock.patch('maintenance.tasks.send_pending_reminders.delay') as delay:
+                    sweep_due_reminders()
+                delay.assert_not_called()
+        self.assertEqual(scheduler.free_slots(), 2)
+        self.assertEqual(send_pending_reminders()['sent'], 2)
+
+    def test_digest_users_get_one_email_for_all_due_reminders(self):
+        self.user.profile.reminder_digest = True
+        self.user.profile.save()
+        van = Car.objects.create(user=self.user, make='Ford', model='Transit', year=2016, vin='VIN789', owner='Driver')
+        self.reminders[1].maintenance_event.car = van
+        self.reminders[1].maintenance_event.save()
+
+        result = dispatch_reminders(chunk_size=1)
+        self.assertEqual((result['sent'], result['skipped'], result['emails']), (2, 1, 1))
+        self.assertEqual(len(mail.outbox), 1)
+        digest = mail.outbox[0]
+        self.assertEqual(digest.subject, 'Maintenance Reminders: 2 services due')
+        self.assertIn('Mazda 3', digest.body)
+        self.assertIn('Ford Transit', digest.body)
+        self.assertEqual(digest.body.count('Service Type: Oil Change'), 2)
+
+
+class TestOutboundPacing(TestCase):
+    def setUp(self):
+        self.sink = SMTPSink().start()
+        self.addCleanup(self.sink.stop)
+        host, port = self.sink.address
+        self.enterContext(self.settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST=host, EMAIL_PORT=port, EMAIL_USE_TLS=False, EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+        ))
+        reset_send_limiter()
+        self.addCleanup(reset_send_limiter)
+        cache.clear()
+
+        yesterday = timezone.now().date() - timedelta(days=1)
+        self.reminders = []
+        for name in ['ann', 'bob', 'cat']:
+            user = User.objects.create_user(username=name, password='pass12345', email=f'{name}@example.com')
+            car = Car.objects.create(user=user, make='Honda', model='Civic', year=2019, vin=f'VIN-{name}', owner=name)
+            event = MaintenanceEvent.objects.create(
+                user=user, car=car, maintenance_type='brake_service', date=yesterday, mileage=40000
+            )
+            self.reminders.append(Reminder.objects.create(user=user, maintenance_event=event, reminder_date=yesterday))
+
+    @override_settings(REMINDER_EMAIL_RATE=4, REMINDER_EMAIL_BURST=1)
+    def test_messages_are_paced_over_one_connection(self):
+        result = dispatch_reminders()
+        self.assertEqual((result['sent'], result['failed']), (3, 0))
+        self.assertEqual(self.sink.connections, 1)
+        received = [message[0] for message in self.sink.messages]
+        # Three messages at four per second with no burst take at least two intervals
+        self.assertGreaterEqual(received[-1] - received[0], 0.45)
+        self.assertEqual(sorted(message[1][0] for message in self.sink.messages),
+                         ['ann@example.com', 'bob@example.com', 'cat@example.com'])
+
+    @override_settings(REMINDER_RETRY_BASE_DELAY=60)
+    def test_temporary_rejection_is_retried_with_backoff(self):
+        self.sink.reject['bob@example.com'] = [(451, 'Mailbox busy, try later')]
+        result = dispatch_reminders()
+        self.assertEqual((result['sent'], result['failed']), (2, 1))
+
+        retry = Reminder.objects.get(id=self.reminders[1].id)
+        self.assertEqual((retry.status, retry.attempts), ('pending', 1))
+        self.assertIn('Mailbox busy', retry.last_error)
+        self.assertGreater(retry.send_at, timezone.now() + timedelta(seconds=25))
+        self.assertEqual(dispatch_reminders()['sent'], 0)  # not due again yet
+
+        Reminder.objects.filter(id=retry.id).update(send_at=timezone.now())
+        self.assertEqual(dispatch_reminders()['sent'], 1)
+        retry.refresh_from_db()
+        self.assertEqual((retry.status, retry.attempts, retry.last_error), ('sent', 2, ''))
+
+    def test_permanent_rejection_is_not_retried(self):
+        self.sink.reject['cat@example.com'] = (550, 'No such user')
+        result = dispatch_reminders()
+        self.assertEqual((result['sent'], result['failed']), (2, 1))
+        failed = Reminder.objects.get(id=self.reminders[2].id)
+        self.assertEqual((failed.status, failed.attempts), ('failed', 1))
+        self.assertIn('No such user', failed.last_error)
+
+    @override_settings(REMINDER_EMAIL_DAILY_LIMIT=2)
+    def test_daily_limit_leaves_the_rest_for_tomorrow(self):
+        self.assertEqual(dispatch_reminders()['sent'], 2)
+        self.assertEqual(len(self.sink.messages), 2)
+        waiting = Reminder.objects.get(status='pending')
+        self.assertEqual(waiting.attempts, 0)
+
+        with mock.patch('maintenance.tasks.send_pending_reminders.delay') as delay:
+            self.assertEqual(sweep_due_reminders(), 1)
+        delay.assert_not_called()
+
+    @override_settings(REMINDER_DELIVERY_WINDOW=0, REMINDER_SEND_HOUR=9)
+    def test_reminders_follow_the_users_local_hour(self):
+        reminder = self.reminders[0]
+        self.assertEqual(timezone.localtime(reminder.send_at).hour, 9)
+
+        profile = reminder.user.profile
+        profile.time_zone = 'America/New_York'
+        profile.reminder_hour = 7
+        profile.save()
+        reminder.refresh_from_db()
+        local = reminder.send_at.astimezone(ZoneInfo('America/New_York'))
+        self.assertEqual((local.date(), local.hour), (reminder.reminder_date, 7))
@@ -1,16 +1,13 @@
 from rest_framework import generics, permissions, status, filters
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from django.shortcuts import get_object_or_404
-from django.utils import timezone
-from django.core.mail import send_mail
-from django.conf import settings
 from django.http import HttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 import csv
+from .scheduler import due_count
+from .tasks import send_pending_reminders
 from .models import MaintenanceEvent, Reminder
 from .serializers import MaintenanceEventSerializer, ReminderSerializer
-from cars.models import Car
 
 class MaintenanceEventListCreateView(generics.ListCreateAPIView):
     serializer_class = MaintenanceEventSerializer
@@ -56,9 +53,8 @@ class ReminderListCreateView(generics.ListCreateAPIView):
         return Reminder.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
-        reminder = serializer.save(user=self.request.user)
-        # Schedule the email to be sent on the reminder date
-        reminder.schedule_email()
+        # Sent by the reminder sweeper once send_at is reached
+        serializer.save(user=self.request.user)
 
 
 class ReminderDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -72,57 +68,15 @@ class ReminderDetailView(generics.RetrieveUpdateDestroyAPIView):
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def send_reminders(request):
-    """Send email reminders for maintenance events due today or overdue"""
-    today = timezone.now().date()
-    pending_reminders = Reminder.objects.filter(
-        reminder_date__lte=today,
-        status='pending'
-    )
-    
-    sent_count = 0
-    for reminder in pending_reminders:
-        try:
-            # Send email to user
-            user_email = reminder.user.email
-            subject = f"Maintenance Reminder: {reminder.maintenance_event.get_maintenance_type_display()}"
-            message = f"""
-Hello {reminder.user.first_name or reminder.user.username},
-
-This is a reminder for your car maintenance:
-
-Car: {reminder.maintenance_event.car}
-Service Type: {reminder.maintenance_event.get_maintenance_type_display()}
-Scheduled Date: {reminder.maintenance_event.date}
-Notes: {reminder.maintenance_event.notes}
-
-Please schedule your appointment soon.
-
-Best regards,
-AutoMate Team
-            """
-            
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [user_email],
-                fail_silently=False,
-            )
-            
-            # Mark reminder as sent
-            reminder.status = 'sent'
-            reminder.notification_sent_at = timezone.now()
-            reminder.save()
-            sent_count += 1
-        except Exception as e:
-            return Response(
-                {'error': f'Failed to send reminder: {str(e)}'},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
-    
+    """
+    Queue the email reminders that are due. Sending is paced (see
+    maintenance/outbound.py), so it runs in a worker rather than the request.
+    """
+    due = due_count()
+    send_pending_reminders.delay()
     return Response(
-        {'message': f'Sent {sent_count} reminder(s)'},
-        status=status.HTTP_200_OK
+        {'message': f"Sending {due} due reminder(s)", 'due': due},
+        status=status.HTTP_202_ACCEPTED
     )
 
 @api_view(['GET'])
@@ -145,9 +99,4 @@ def export_maintenance_csv(request):
             event.notes or '',
         ])
     
-    return response
-    
-    return Response({
-        'message': f'Successfully sent {sent_count} reminders',
-        'count': sent_count
-    }, status=status.HTTP_200_OK) 
\ No newline at end of file
+    return response 
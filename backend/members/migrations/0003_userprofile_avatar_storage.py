@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:36
+
+import automate.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0002_userprofile_avatar_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userprofile',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, storage=automate.storage.avatar_storage, upload_to='avatars/'),
+        ),
+    ]
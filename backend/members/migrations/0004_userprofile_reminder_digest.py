@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0003_userprofile_avatar_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='reminder_digest',
+            field=models.BooleanField(default=False, help_text='Group reminders due together into one email'),
+        ),
+    ]
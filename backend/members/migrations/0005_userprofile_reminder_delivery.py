@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:52
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0004_userprofile_reminder_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='reminder_hour',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Local hour to receive reminders (REMINDER_SEND_HOUR when empty)', null=True, validators=[django.core.validators.MaxValueValidator(23)]),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='time_zone',
+            field=models.CharField(blank=True, help_text='IANA time zone for reminder delivery, e.g. Europe/Berlin', max_length=64),
+        ),
+    ]
@@ -1,19 +1,29 @@
+from django.core.validators import MaxValueValidator
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from automate.image_variants import schedule_variants
+from automate.storage import avatar_storage
 
 class UserProfile(models.Model):
     """Extended user profile with additional information"""
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     phone_number = models.CharField(max_length=20, blank=True)
-    avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    avatar = models.ImageField(upload_to='avatars/', storage=avatar_storage, null=True, blank=True)
+    avatar_variants = models.JSONField(default=dict, blank=True, help_text="Resized WebP copies of the avatar")
     bio = models.TextField(blank=True, max_length=500)
     
     # Notification preferences
     email_notifications = models.BooleanField(default=True)
     sms_notifications = models.BooleanField(default=False)
     reminder_advance_days = models.IntegerField(default=7, help_text="Days before maintenance to send reminder")
+    reminder_digest = models.BooleanField(default=False, help_text="Group reminders due together into one email")
+    time_zone = models.CharField(max_length=64, blank=True, help_text="IANA time zone for reminder delivery, e.g. Europe/Berlin")
+    reminder_hour = models.PositiveSmallIntegerField(
+        null=True, blank=True, validators=[MaxValueValidator(23)],
+        help_text="Local hour to receive reminders (REMINDER_SEND_HOUR when empty)",
+    )
     
     # Account metadata
     created_at = models.DateTimeField(auto_now_add=True)
@@ -38,3 +48,8 @@ def save_user_profile(sender, instance, **kwargs):
     if hasattr(instance, 'profile'):
         instance.profile.save()
 
+@receiver(post_save, sender=UserProfile)
+def queue_avatar_variants(sender, instance, **kwargs):
+    """Render resized avatar variants in the background when the avatar changes"""
+    from .tasks import generate_avatar_variants
+    schedule_variants(instance, 'avatar', generate_avatar_variants)
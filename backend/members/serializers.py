@@ -1,15 +1,24 @@
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from automate.image_variants import variant_urls
+from automate.media import ProtectedImageField
 from .models import UserProfile
 
 class UserProfileSerializer(serializers.ModelSerializer):
+    avatar = ProtectedImageField(required=False, allow_null=True)
+    avatar_variants = serializers.SerializerMethodField()
+
     class Meta:
         model = UserProfile
-        fields = ['phone_number', 'avatar', 'bio', 'email_notifications', 
-                  'sms_notifications', 'reminder_advance_days', 'created_at', 'updated_at']
+        fields = ['phone_number', 'avatar', 'avatar_variants', 'bio', 'email_notifications', 
+                  'sms_notifications', 'reminder_advance_days', 'reminder_digest', 'time_zone', 'reminder_hour', 'created_at', 'updated_at']
         read_only_fields = ['created_at', 'updated_at']
 
+    def get_avatar_variants(self, obj):
+        return variant_urls(obj, 'avatar', self.context.get('request'))
+
 class UserSerializer(serializers.ModelSerializer):
     profile = UserProfileSerializer(read_only=True)
     
@@ -23,11 +32,24 @@ class UserUpdateSerializer(serializers.ModelSerializer):
     email_notifications = serializers.BooleanField(source='profile.email_notifications', required=False)
     sms_notifications = serializers.BooleanField(source='profile.sms_notifications', required=False)
     reminder_advance_days = serializers.IntegerField(source='profile.reminder_advance_days', required=False)
+    reminder_digest = serializers.BooleanField(source='profile.reminder_digest', required=False)
+    time_zone = serializers.CharField(source='profile.time_zone', required=False, allow_blank=True, max_length=64)
+    reminder_hour = serializers.IntegerField(source='profile.reminder_hour', required=False, allow_null=True,
+                                             min_value=0, max_value=23)
     
     class Meta:
         model = User
         fields = ['first_name', 'last_name', 'email', 'phone_number', 'bio', 
-                  'email_notifications', 'sms_notifications', 'reminder_advance_days']
+                  'email_notifications', 'sms_notifications', 'reminder_advance_days', 'reminder_digest',
+                  'time_zone', 'reminder_hour']
+
+    def validate_time_zone(self, value):
+        if value:
+            try:
+                ZoneInfo(value)
+            except (ValueError, ZoneInfoNotFoundError):
+                raise serializers.ValidationError("Unknown time zone.")
+        return value
     
     def update(self, instance, validated_data):
         profile_data = validated_data.pop('profile', {})
@@ -0,0 +1,9 @@
+from celery import shared_task
+from automate.image_variants import update_variants
+from .models import UserProfile
+
+
+@shared_task
+def generate_avatar_variants(profile_id):
+    """Render the resized WebP variants of a profile's avatar"""
+    return update_variants(UserProfile, profile_id, 'avatar')
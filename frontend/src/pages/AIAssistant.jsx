@@ -42,6 +42,10 @@ import { aiAssistantAPI, carsAPI } from '../services/api';
 import DeleteConfirmDialog from '../components/DeleteConfirmDialog';
 
 // Format AI result text into structured JSX
+// Status polling for queued analyses
+const STATUS_POLL_INTERVAL_MS = 2000;
+const STATUS_POLL_TIMEOUT_MS = 5 * 60 * 1000;
+
 const formatAIResult = (text, theme) => {
   if (!text) return null;
 
@@ -255,6 +259,20 @@ function AIAssistant() {
     }
   };
 
+  const waitForDiagnosis = async (diagnosisId) => {
+    // Poll the lightweight status endpoint until the worker is done;
+    // null if it is still not finished after STATUS_POLL_TIMEOUT_MS
+    const deadline = Date.now() + STATUS_POLL_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+      const { data } = await aiAssistantAPI.getStatus(diagnosisId);
+      if (data.status === 'done' || data.status === 'failed') {
+        return data;
+      }
+      await new Promise((resolve) => setTimeout(resolve, STATUS_POLL_INTERVAL_MS));
+    }
+    return null;
+  };
+
   const handleSubmit = async (e) => {
     e.preventDefault();
     if (!selectedCar || selectedCar === '') {
@@ -273,20 +291,22 @@ function AIAssistant() {
     setAiResult('');
 
     try {
-      const formData = new FormData();
-      formData.append('car_id', selectedCar.toString());
-      formData.append('image', selectedImage);
-      if (damageDescription.trim()) {
-        formData.append('damage_description', damageDescription.trim());
-      }
-
-      const response = await aiAssistantAPI.create(formData);
+      // Chunked upload that survives dropped connections
+      const response = await aiAssistantAPI.createResumable(selectedImage, {
+        car_id: selectedCar,
+        damage_description: damageDescription.trim(),
+      });
       
-      // Show success message with AI result
-      if (response.data.ai_result) {
+      // Analysis runs in the background; poll until it finishes
+      const diagnosis = await waitForDiagnosis(response.data.id);
+      if (!diagnosis) {
+        setError('The AI analysis is taking longer than expected. It will appear in your history once it finishes.');
+      } else if (diagnosis.status === 'done') {
         setError(''); // Clear any previous errors
         setSuccess('Image uploaded successfully! AI analysis completed.');
-        setAiResult(response.data.ai_result);
+        setAiResult(diagnosis.ai_result);
+      } else {
+        setError(diagnosis.error_message || 'AI analysis failed. Please try again.');
       }
       
       // Reset form
@@ -13,6 +13,9 @@ function Profile() {
       email_notifications: true,
       sms_notifications: false,
       reminder_advance_days: 3,
+      reminder_digest: false,
+      time_zone: '',
+      reminder_hour: null,
     },
   });
   const [loading, setLoading] = useState(false);
@@ -58,6 +61,9 @@ function Profile() {
         email_notifications: profile.profile?.email_notifications,
         sms_notifications: profile.profile?.sms_notifications,
         reminder_advance_days: profile.profile?.reminder_advance_days,
+        reminder_digest: profile.profile?.reminder_digest,
+        time_zone: profile.profile?.time_zone || '',
+        reminder_hour: profile.profile?.reminder_hour ?? null,
       };
       await authAPI.updateProfile(payload);
       setSuccess('Profile updated successfully');
@@ -163,6 +169,38 @@ function Profile() {
                       onChange={(e) => handleNestedChange('reminder_advance_days', parseInt(e.target.value, 10) || 0)}
                     />
                   </Grid>
+                  <Grid item xs={12} md={6}>
+                    <FormControlLabel
+                      control={
+                        <Switch
+                          checked={!!profile.profile?.reminder_digest}
+                          onChange={(e) => handleNestedChange('reminder_digest', e.target.checked)}
+                        />
+                      }
+                      label="Group Reminders into One Email"
+                    />
+                  </Grid>
+                  <Grid item xs={12} md={6}>
+                    <TextField
+                      fullWidth
+                      label="Time Zone"
+                      placeholder={Intl.DateTimeFormat().resolvedOptions().timeZone}
+                      helperText="e.g. Europe/Berlin; leave empty for the server default"
+                      value={profile.profile?.time_zone || ''}
+                      onChange={(e) => handleNestedChange('time_zone', e.target.value)}
+                    />
+                  </Grid>
+                  <Grid item xs={12} md={6}>
+                    <TextField
+                      fullWidth
+                      label="Reminder Hour"
+                      type="number"
+                      inputProps={{ min: 0, max: 23 }}
+                      helperText="Local hour to receive reminder emails"
+                      value={profile.profile?.reminder_hour ?? ''}
+                      onChange={(e) => handleNestedChange('reminder_hour', e.target.value === '' ? null : parseInt(e.target.value, 10))}
+                    />
+                  </Grid>
                 </Grid>
                 <Box sx={{ mt: 3, display: 'flex', gap: 2 }}>
                   <Button type="submit" variant="contained" color="primary" disabled={loading}>
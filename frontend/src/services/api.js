@@ -59,6 +59,90 @@ export const maintenanceAPI = {
   deleteReminder: (id) => api.delete(`/maintenance/reminders/${id}/`),
 };
 
+// Resumable diagnosis uploads (see backend/ai_assistant/uploads.py)
+const UPLOAD_CHUNK_SIZE = 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 5;
+
+const toHex = (buffer) => Array.from(new Uint8Array(buffer)).map((b) => b.toString(16).padStart(2, '0')).join('');
+// Encoded in 32 KiB slices: spreading a whole chunk into fromCharCode overflows the call stack
+const BASE64_SLICE = 0x8000;
+const toBase64 = (buffer) => {
+  const bytes = new Uint8Array(buffer);
+  let binary = '';
+  for (let start = 0; start < bytes.length; start += BASE64_SLICE) {
+    binary += String.fromCharCode(...bytes.subarray(start, start + BASE64_SLICE));
+  }
+  return btoa(binary);
+};
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+const uploadKey = (file, carId) => `upload:${carId}:${file.name}:${file.size}:${file.lastModified}`;
+
+// Start an upload session, or pick up the one left by an interrupted attempt
+const openUploadSession = async (file, fields) => {
+  const key = uploadKey(file, fields.car_id);
+  const saved = localStorage.getItem(key);
+  if (saved) {
+    try {
+      const { headers } = await api.head(`/ai-assistant/uploads/${saved}/`);
+      return { id: saved, key, offset: Number(headers['upload-offset']) };
+    } catch (error) {
+      localStorage.removeItem(key);
+    }
+  }
+  const sha256 = toHex(await crypto.subtle.digest('SHA-256', await file.arrayBuffer()));
+  const { data } = await api.post('/ai-assistant/uploads/', {
+    ...fields,
+    filename: file.name,
+    size: file.size,
+    sha256,
+  });
+  localStorage.setItem(key, data.id);
+  return { id: data.id, key, offset: 0 };
+};
+
+const uploadChunk = async (url, chunk, offset) => {
+  const body = await chunk.arrayBuffer();
+  const checksum = toBase64(await crypto.subtle.digest('SHA-256', body));
+  const { headers } = await api.patch(url, body, {
+    headers: {
+      'Content-Type': 'application/offset+octet-stream',
+      'Upload-Offset': String(offset),
+      'Upload-Checksum': `sha256 ${checksum}`,
+    },
+  });
+  return Number(headers['upload-offset']);
+};
+
+// Upload in chunks, resuming from the server's offset after network errors
+const createResumable = async (file, fields, onProgress) => {
+  const session = await openUploadSession(file, fields);
+  const url = `/ai-assistant/uploads/${session.id}/`;
+  let { offset } = session;
+  let retries = 0;
+
+  while (offset < file.size) {
+    try {
+      offset = await uploadChunk(url, file.slice(offset, offset + UPLOAD_CHUNK_SIZE), offset);
+      retries = 0;
+      onProgress?.(offset / file.size);
+    } catch (error) {
+      if (retries >= UPLOAD_MAX_RETRIES || error.response?.status === 404) {
+        throw error;
+      }
+      retries += 1;
+      await sleep(500 * 2 ** retries);
+      // The server knows how much of the chunk arrived (409 carries the offset too)
+      const { headers } = await api.head(url);
+      offset = Number(headers['upload-offset']);
+    }
+  }
+
+  const response = await api.post(`${url}finalize/`);
+  localStorage.removeItem(session.key);
+  return response;
+};
+
 // AI Assistant API
 export const aiAssistantAPI = {
   getAll: () => api.get('/ai-assistant/'),
@@ -73,6 +157,9 @@ export const aiAssistantAPI = {
   update: (id, data) => api.put(`/ai-assistant/${id}/`, data),
   delete: (id) => api.delete(`/ai-assistant/${id}/`),
   getByCar: (carId) => api.get(`/ai-assistant/car/${carId}/`),
+  getStatus: (id) => api.get(`/ai-assistant/${id}/status/`),
+  // fields: { car_id, damage_description }; onProgress receives 0..1
+  createResumable,
 };
 
 // Auth API